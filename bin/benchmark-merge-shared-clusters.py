@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import argparse
+import itertools
+
+# compare the union-find PartitionDriver.merge_shared_clusters() with the old pairwise version (copied below), on random partitions with some shared uids
+# example usage:
+#   ./bin/benchmark-merge-shared-clusters.py --n-clusters-list 100:300:1000 --n-shared 50
+
+current_script_dir = os.path.dirname(os.path.realpath(__file__)).replace('/bin', '/python')
+if not os.path.exists(current_script_dir):
+    print 'WARNING current script dir %s doesn\'t exist, so python path may not be correctly set' % current_script_dir
+sys.path.insert(1, current_script_dir)
+import utils
+from clusterpath import ClusterPath
+from partitiondriver import PartitionDriver
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n-clusters-list', default='100:300:1000', help='colon-separated list of numbers of clusters in the partition')
+parser.add_argument('--mean-cluster-size', type=int, default=5)
+parser.add_argument('--n-shared', type=int, default=50, help='number of uids to add to a second (random) cluster, i.e. number of overlaps')
+parser.add_argument('--skip-old', action='store_true', help='only time the new version (the old one is roughly cubic, so it takes forever on big partitions)')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+args.n_clusters_list = utils.get_arg_list(args.n_clusters_list, intify=True)
+
+# ----------------------------------------------------------------------------------------
+def old_merge_shared_clusters(partition):  # the version from before the union-find rewrite, minus the dbg
+    cluster_groups = []
+    for iclust in range(len(partition)):
+        for jclust in range(iclust + 1, len(partition)):
+            if len(set(partition[iclust]) & set(partition[jclust])) > 0:
+                cluster_groups.append(set([iclust, jclust]))
+    while True:
+        no_more_merges = True
+        for cp1, cp2 in itertools.combinations(cluster_groups, 2):
+            if len(cp1 & cp2) > 0:
+                cluster_groups.append(cp1 | cp2)
+                cluster_groups.remove(cp1)
+                cluster_groups.remove(cp2)
+                no_more_merges = False
+                break
+        if no_more_merges:
+            break
+    new_clusters = []
+    for cgroup in cluster_groups:
+        new_clusters.append(list(set([uid for iclust in cgroup for uid in partition[iclust]])))
+    for iclust in sorted([i for cgroup in cluster_groups for i in cgroup], reverse=True):
+        partition.pop(iclust)
+    for nclust in new_clusters:
+        partition.append(nclust)
+
+# ----------------------------------------------------------------------------------------
+def make_partition(n_clusters):
+    partition, iuid = [], 0
+    for _ in range(n_clusters):
+        csize = max(1, int(random.expovariate(1. / args.mean_cluster_size)))
+        partition.append(['uid-%d' % i for i in range(iuid, iuid + csize)])
+        iuid += csize
+    for _ in range(args.n_shared):  # add a random uid to another random cluster
+        random.choice(partition).append('uid-%d' % random.randint(0, iuid - 1))
+    return partition
+
+# ----------------------------------------------------------------------------------------
+random.seed(args.seed)
+print '  n clusters   n merged      new (s)      old (s)'
+for n_clusters in args.n_clusters_list:
+    partition = make_partition(n_clusters)
+
+    cpath = ClusterPath()
+    cpath.add_partition([list(c) for c in partition], -1., 1)
+    start = time.time()
+    PartitionDriver.merge_shared_clusters.im_func(None, cpath)  # doesn't use <self>
+    new_time = time.time() - start
+    new_partition = cpath.partitions[cpath.i_best]
+
+    old_time_str = '-'
+    if not args.skip_old:
+        old_partition = [list(c) for c in partition]
+        start = time.time()
+        old_merge_shared_clusters(old_partition)
+        old_time_str = '%.4f' % (time.time() - start)
+        if set(frozenset(c) for c in new_partition) != set(frozenset(c) for c in old_partition):
+            raise Exception('new and old partitions differ for %d clusters' % n_clusters)
+
+    print '  %8d   %8d   %10.4f   %10s' % (n_clusters, n_clusters - len(new_partition), new_time, old_time_str)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+import sys
+import os
+import gc
+import copy
+import time
+import argparse
+import psutil
+import numpy
+
+# compare the memory used by a regular sw info dict (i.e. a dict for each query) with the columnar version from swinfostore.compact_sw_info()
+# example usage (the sw cache file is in the parameter dir after running cache-parameters):
+#   ./bin/benchmark-sw-info-memory.py --infname _output/example/sw-cache-<hash>.yaml --n-copies 100
+
+current_script_dir = os.path.dirname(os.path.realpath(__file__)).replace('/bin', '/python')
+if not os.path.exists(current_script_dir):
+    print 'WARNING current script dir %s doesn\'t exist, so python path may not be correctly set' % current_script_dir
+sys.path.insert(1, current_script_dir)
+import utils
+import swinfostore
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--infname', required=True, help='sw cache file (or any other annotation output file with single-sequence annotations)')
+parser.add_argument('--n-copies', type=int, default=10, help='make this many copies (with different uids) of each annotation in --infname, to get more realistic sample sizes')
+args = parser.parse_args()
+
+# ----------------------------------------------------------------------------------------
+def deep_size(obj, seen):  # total size of <obj> and everything it refers to (counting each object, e.g. shared or interned strings, only once)
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)  # for numpy arrays that own their data, this includes the data
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(v, seen) for v in obj)
+    elif isinstance(obj, numpy.ndarray):
+        pass
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, a), seen) for a in obj.__slots__)
+    return size
+
+# ----------------------------------------------------------------------------------------
+def rss():
+    gc.collect()
+    return psutil.Process(os.getpid()).memory_info().rss
+
+# ----------------------------------------------------------------------------------------
+_, annotation_list, _ = utils.read_output(args.infname, synth_single_seqs=True)
+annotation_list = [l for l in annotation_list if not l['invalid']]
+
+rss_before = rss()
+sw_info = {'queries' : [], 'passed-queries' : set()}  # the other (non-per-query) keys in a real sw info are the same for both versions, so we leave 'em out
+for icopy in range(args.n_copies):
+    for line in annotation_list:
+        uid = '%s-%d' % (line['unique_ids'][0], icopy)
+        sw_info[uid] = copy.deepcopy(line)  # deep copy so it's like a sample with distinct sequences (at least in terms of memory)
+        sw_info[uid]['unique_ids'] = [uid]
+        sw_info['queries'].append(uid)
+        sw_info['passed-queries'].add(uid)
+dict_rss = rss() - rss_before
+
+start = time.time()
+compact_info = swinfostore.compact_sw_info(sw_info)
+compact_time = time.time() - start
+queries = sw_info['queries']
+dict_size = deep_size([sw_info[q] for q in queries], set())
+compact_size = deep_size([compact_info[q] for q in queries], set())
+
+access_times = {}
+for name, info in [('dict', {q : compact_info[q].copy() for q in queries}), ('compact', compact_info)]:
+    start = time.time()
+    for q in queries:
+        for key in ['naive_seq', 'cdr3_length', 'seqs', 'k_v', 'all_matches']:
+            info[q][key]
+    access_times[name] = time.time() - start
+
+n_queries = len(queries)
+print '  %d queries (%d copies of %d annotations from %s), compacting took %.1fs' % (n_queries, args.n_copies, n_queries / args.n_copies, args.infname, compact_time)
+print '                       total (MB)   per query (kB)'
+print '      dicts              %8.1f       %8.2f' % (dict_size / 1e6, dict_size / 1e3 / n_queries)
+print '      columnar           %8.1f       %8.2f' % (compact_size / 1e6, compact_size / 1e3 / n_queries)
+print '    dict version uses %.1fx more memory (rss increased by %.1f MB when adding the dicts)' % (float(dict_size) / compact_size, dict_rss / 1e6)
+print '    access time for five keys from each query: %.3fs (dict)  %.3fs (columnar)' % (access_times['dict'], access_times['compact'])
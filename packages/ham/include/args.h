@@ -52,6 +52,7 @@ public:
   bool cache_naive_hfracs() { return cache_naive_hfracs_arg_.getValue(); }
   bool only_cache_new_vals() { return only_cache_new_vals_arg_.getValue(); }
   bool write_logprob_for_each_partition() { return write_logprob_for_each_partition_arg_.getValue(); }
+  bool server() { return server_arg_.getValue(); }
  
   // command line arguments
   vector<string> algo_strings_;
@@ -62,7 +63,7 @@ public:
   ValueArg<float> hamming_fraction_bound_lo_arg_, hamming_fraction_bound_hi_arg_, logprob_ratio_threshold_arg_, max_logprob_drop_arg_;
   ValueArg<int> debug_arg_, naive_hamming_cluster_arg_, biggest_naive_seq_cluster_to_calculate_arg_, biggest_logprob_cluster_to_calculate_arg_, n_partitions_to_write_arg_;
   ValueArg<unsigned> n_final_clusters_arg_, min_largest_cluster_size_arg_, max_cluster_size_arg_, random_seed_arg_;
-  SwitchArg no_chunk_cache_arg_, partition_arg_, dont_rescale_emissions_arg_, cache_naive_seqs_arg_, cache_naive_hfracs_arg_, only_cache_new_vals_arg_, write_logprob_for_each_partition_arg_;
+  SwitchArg no_chunk_cache_arg_, partition_arg_, dont_rescale_emissions_arg_, cache_naive_seqs_arg_, cache_naive_hfracs_arg_, only_cache_new_vals_arg_, write_logprob_for_each_partition_arg_, server_arg_;
 
   // arguments read from csv input file
   map<string, vector<string> > strings_;
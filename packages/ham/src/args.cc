@@ -39,6 +39,7 @@ Args::Args(int argc, const char * argv[]):
   cache_naive_hfracs_arg_("", "cache-naive-hfracs", "cache naive hamming fraction between sequence sets (in addition to log probs and naive seqs)", false),
   only_cache_new_vals_arg_("", "only-cache-new-vals", "only write sequence sets with newly-calculated values to cache file", false),
   write_logprob_for_each_partition_arg_("", "write-logprob-for-each-partition", "By default, we don't know the total logprob of each partition (since many merges are by naive hfrac). This argument tells us that this is the last time through (with one process) and we want to know the total probability of each partition.", false),
+  server_arg_("", "server", "after running the job specified on the command line, keep the germline info and hmms in memory and run further jobs read from stdin (one line of command line arguments per job) until stdin is closed", false),
   str_headers_ {},
   int_headers_ {"k_v_min", "k_v_max", "k_d_min", "k_d_max", "cdr3_length"},
   float_headers_ {"mut_freq"},
@@ -79,6 +80,7 @@ Args::Args(int argc, const char * argv[]):
     cmd.add(write_logprob_for_each_partition_arg_);
     cmd.add(partition_arg_);
     cmd.add(dont_rescale_emissions_arg_);
+    cmd.add(server_arg_);
 
     cmd.parse(argc, argv);
 
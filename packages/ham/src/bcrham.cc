@@ -22,33 +22,61 @@ using namespace std;
 
 // ----------------------------------------------------------------------------------------
 vector<vector<Sequence> > GetSeqs(Args &args, Track *trk);
+void run_job(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk);
 void run_algorithm(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> > &qry_seq_list, Args &args);
 
 // ----------------------------------------------------------------------------------------
 int main(int argc, const char * argv[]) {
-  clock_t run_start(clock());
   Args args(argc, argv);
-  srand(args.random_seed());
 
   // init some infrastructure
   vector<string> characters {"A", "C", "G", "T"};
   Track track("NUKES", characters, args.ambig_base());
   GermLines gl(args.datadir(), args.locus());
   HMMHolder hmms(args.hmmdir(), gl, &track);
-  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, &track));
+
+  run_job(hmms, gl, args, &track);
+  if(!args.server())
+    return 0;
+
+  // server mode: keep <gl> and <hmms> (which only reads each hmm file the first time it's needed) around, and run one job for each line on stdin (each line has the same command line arguments as a regular bcrham run)
+  string line;
+  while(getline(cin, line)) {
+    if(line.size() == 0)
+      continue;
+    vector<string> argstrs(PythonSplit(line));
+    vector<const char*> job_argv{argv[0]};
+    for(auto &astr : argstrs)
+      job_argv.push_back(astr.c_str());
+    Args job_args(job_argv.size(), job_argv.data());
+    if(job_args.hmmdir() != args.hmmdir() || job_args.datadir() != args.datadir() || job_args.locus() != args.locus() || job_args.ambig_base() != args.ambig_base())
+      throw runtime_error("bcrham server got a job with different --hmmdir, --datadir, --locus, or --ambig-base than it was started with\n");
+    run_job(hmms, gl, job_args, &track);
+  }
+  return 0;
+}
+
+// ----------------------------------------------------------------------------------------
+void run_job(HMMHolder &hmms, GermLines &gl, Args &args, Track *trk) {
+  clock_t run_start(clock());
+  srand(args.random_seed());
+  vector<vector<Sequence> > qry_seq_list(GetSeqs(args, trk));
 
   if(args.cache_naive_seqs()) {
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk);
     glom.CacheNaiveSeqs();
   } else if(args.partition()) {  // NOTE this is kind of hackey -- there's some code duplication between Glomerator and the loop below... but only a little, and they're doing fairly different things, so screw it for the time being
-    Glomerator glom(hmms, gl, qry_seq_list, &args, &track);
+    Glomerator glom(hmms, gl, qry_seq_list, &args, trk);
     glom.Cluster();
   } else {
     run_algorithm(hmms, gl, qry_seq_list, args);
   }
 
   printf("        time: bcrham %.1f\n", ((clock() - run_start) / (double)CLOCKS_PER_SEC));
-  return 0;
+  if(args.server()) {  // tell the python side that this job's stdout is complete
+    printf("    bcrham server: job finished\n");
+    fflush(stdout);
+  }
 }
 
 // ----------------------------------------------------------------------------------------
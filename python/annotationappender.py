@@ -0,0 +1,105 @@
+import os
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class AnnotationAppender(object):
+    """
+    Append the annotations from a series of annotation output files (e.g. one for each chunk of a large input file) to a single output file.
+    The annotations are copied directly from file to file, i.e. we never parse them or have more than a block of them in memory at once.
+    Everything other than the annotations (version info and germline info) is taken from the first file, and since we don't know how to combine partitions, it's only for annotation (not partition) output.
+    NOTE for .yaml files, this only works for json-style files (i.e. not --write-full-yaml-output) with the events written last (which is how we write them).
+    """
+    block_size = 2**20
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, outfname):
+        self.outfname = outfname
+        self.suffix = utils.getsuffix(outfname)
+        if self.suffix not in ['.csv', '.yaml']:
+            raise Exception('unhandled annotation file suffix %s' % self.suffix)
+        if os.path.exists(outfname):
+            os.remove(outfname)
+        elif not os.path.exists(os.path.dirname(os.path.abspath(outfname))):
+            os.makedirs(os.path.dirname(os.path.abspath(outfname)))
+        self.outfile = open(outfname, 'w')
+        self.n_files = 0
+        self.csv_header = None
+        self.n_nonempty_files = 0  # number of files with at least one event (for .yaml files, so we know whether we need a comma)
+
+    # ----------------------------------------------------------------------------------------
+    def copy_bytes(self, infile, n_bytes=None):  # copy <n_bytes> (or everything, if it's None) from the current position in <infile> to the output file
+        while n_bytes is None or n_bytes > 0:
+            block = infile.read(self.block_size if n_bytes is None else min(self.block_size, n_bytes))
+            if block == '':
+                break
+            self.outfile.write(block)
+            if n_bytes is not None:
+                n_bytes -= len(block)
+
+    # ----------------------------------------------------------------------------------------
+    def append(self, fname):
+        if utils.getsuffix(fname) != self.suffix:
+            raise Exception('can\'t append %s to %s, since they have different suffixes' % (fname, self.outfname))
+        if self.suffix == '.csv':
+            self.append_csv(fname)
+        else:
+            self.append_json(fname)
+        self.n_files += 1
+
+    # ----------------------------------------------------------------------------------------
+    def append_csv(self, fname):
+        with open(fname) as infile:
+            header = infile.readline()
+            if self.csv_header is None:
+                self.csv_header = header
+                self.outfile.write(header)
+            elif header != self.csv_header:
+                raise Exception('csv header in %s doesn\'t match the one in the first file we appended:\n    %s\n    %s' % (fname, header.strip(), self.csv_header.strip()))
+            self.copy_bytes(infile)
+
+    # ----------------------------------------------------------------------------------------
+    def find_events_array(self, fname, infile, events_offset):  # return the file offsets just after the events array's '[' and of its ']' (i.e. the bounds of the events themselves)
+        infile.seek(events_offset)
+        head = infile.read(64)
+        if head.lstrip()[:1] != '[':
+            raise Exception('expected start of events array at offset %d in %s' % (events_offset, fname))
+        start = events_offset + len(head) - len(head.lstrip()) + 1
+        tail_offset = max(0, os.path.getsize(fname) - 64)
+        infile.seek(tail_offset)
+        tail = infile.read().rstrip()
+        if tail[-1:] != '}' or tail[:-1].rstrip()[-1:] != ']':  # the events are the last thing in the file, so it should end with ']}'
+            raise Exception('%s doesn\'t end with the events array' % fname)
+        end = tail_offset + len(tail[:-1].rstrip()) - 1
+        return start, end
+
+    # ----------------------------------------------------------------------------------------
+    def append_json(self, fname):
+        sections, events_offset = utils.read_json_output_sections(fname)
+        if events_offset is None:
+            raise Exception('%s isn\'t a json-style yaml file (maybe it was written with --write-full-yaml-output?)' % fname)
+        if any(k not in sections for k in ['version-info', 'germline-info', 'partitions']):
+            raise Exception('events aren\'t the last section in %s' % fname)
+        if len(sections['partitions']) > 0:
+            raise Exception('can\'t append files with partitions (%s)' % fname)
+        with open(fname) as infile:
+            start, end = self.find_events_array(fname, infile, events_offset)
+            if self.n_files == 0:  # take everything before the events from the first file
+                infile.seek(0)
+                self.copy_bytes(infile, n_bytes=start)
+            infile.seek(start)
+            if infile.read(min(64, end - start)).strip() == '':  # no events in this file
+                return
+            if self.n_nonempty_files > 0:
+                self.outfile.write(', ')  # same separator that json.dump() uses
+            infile.seek(start)
+            self.copy_bytes(infile, n_bytes=end - start)
+            self.n_nonempty_files += 1
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        if self.n_files == 0:  # we don't have the germline info (or csv header), so there isn't anything sensible to write
+            raise Exception('no files appended to %s' % self.outfname)
+        if self.suffix == '.yaml':
+            self.outfile.write(']}')
+        self.outfile.close()
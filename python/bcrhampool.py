@@ -0,0 +1,107 @@
+import os
+import sys
+import select
+import subprocess
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class BcrhamPool(object):
+    """ Keep a set of bcrham processes (run with --server) alive across clustering steps, so each one only reads the germline info and hmm files once. """
+    finished_str = 'bcrham server: job finished'  # bcrham prints this to stdout at the end of each job (has to match bcrham.cc)
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, workdir, debug=None):
+        self.workdir = workdir
+        self.debug = debug
+        self.procs = []  # index is iproc, entry is None if that server isn't running
+
+    # ----------------------------------------------------------------------------------------
+    def errfname(self, iproc):
+        return '%s/bcrham-server-%d.err' % (self.workdir, iproc)
+
+    # ----------------------------------------------------------------------------------------
+    def start_server(self, iproc, cmd_str):  # the first job is passed on the command line, so bcrham reads the glfo and hmms from the same arguments as when it's not a server
+        errfile = open(self.errfname(iproc), 'w')
+        proc = subprocess.Popen((cmd_str + ' --server').split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errfile)
+        errfile.close()
+        return {'proc' : proc, 'err_offset' : 0}
+
+    # ----------------------------------------------------------------------------------------
+    def stop_server(self, iproc):
+        if self.procs[iproc] is None:
+            return
+        proc = self.procs[iproc]['proc']
+        proc.stdin.close()  # bcrham exits when it hits the end of stdin
+        proc.wait()
+        proc.stdout.close()
+        os.remove(self.errfname(iproc))
+        self.procs[iproc] = None
+        if proc.returncode != 0:
+            print '    %s bcrham server %d exited with %d' % (utils.color('yellow', 'warning'), iproc, proc.returncode)
+
+    # ----------------------------------------------------------------------------------------
+    def read_new_stderr(self, iproc):
+        with open(self.errfname(iproc)) as errfile:
+            errfile.seek(self.procs[iproc]['err_offset'])
+            errstr = errfile.read()
+        self.procs[iproc]['err_offset'] += len(errstr)
+        return errstr
+
+    # ----------------------------------------------------------------------------------------
+    def fail(self, iproc, cmdfo, outstr):
+        proc = self.procs[iproc]['proc']
+        proc.wait()
+        errstr = self.read_new_stderr(iproc)
+        print '    bcrham server %d failed with %d' % (iproc, proc.returncode)
+        for strtype, tstr in [('out', outstr), ('err', errstr)]:
+            if tstr.strip() != '':
+                print '        %s tail:' % strtype
+                print utils.pad_lines('\n'.join(tstr.strip().split('\n')[-30:]), padwidth=12)
+        os.remove(self.errfname(iproc))
+        self.procs[iproc] = None
+        self.close()
+        raise Exception('bcrham server failed on cmd\n    %s\nlook for output in %s' % (cmdfo['cmd_str'], cmdfo['workdir']))
+
+    # ----------------------------------------------------------------------------------------
+    def run(self, cmdfos):
+        """ Run the job in each of <cmdfos> (same format as for utils.run_cmds()) on the server with the same index, starting servers as needed. Servers with index beyond len(<cmdfos>) are shut down, since the number of procs never increases between clustering steps. """
+        while len(self.procs) < len(cmdfos):
+            self.procs.append(None)
+        for iproc in range(len(cmdfos), len(self.procs)):
+            self.stop_server(iproc)
+        self.procs = self.procs[:len(cmdfos)]
+
+        for iproc, cmdfo in enumerate(cmdfos):
+            if self.procs[iproc] is None:
+                self.procs[iproc] = self.start_server(iproc, cmdfo['cmd_str'])
+            else:
+                self.procs[iproc]['proc'].stdin.write(' '.join(cmdfo['cmd_str'].split()[1:]) + '\n')  # job line is the command line without the binary
+                self.procs[iproc]['proc'].stdin.flush()
+
+        # read stdout from all of 'em as it arrives (we can't just block on each one in turn, since any of the others could fill their pipe buffer and stall)
+        outstrs = {iproc : '' for iproc in range(len(cmdfos))}
+        fd_iprocs = {self.procs[iproc]['proc'].stdout.fileno() : iproc for iproc in range(len(cmdfos))}
+        while len(fd_iprocs) > 0:
+            ready_fds, _, _ = select.select(list(fd_iprocs), [], [])
+            for fd in ready_fds:
+                iproc = fd_iprocs[fd]
+                chunk = os.read(fd, 65536)
+                if chunk == '':  # eof, i.e. bcrham exited without finishing the job
+                    self.fail(iproc, cmdfos[iproc], outstrs[iproc])
+                outstrs[iproc] += chunk
+                if self.finished_str in outstrs[iproc]:
+                    del fd_iprocs[fd]
+
+        for iproc, cmdfo in enumerate(cmdfos):
+            if not os.path.exists(cmdfo['outfname']):
+                self.fail(iproc, cmdfo, outstrs[iproc])
+            outstr = '\n'.join(l for l in outstrs[iproc].split('\n') if self.finished_str not in l)
+            utils.process_out_err(extra_str='' if len(cmdfos) == 1 else str(iproc), dbgfo=cmdfo.get('dbgfo'), debug=self.debug, out=outstr, err=self.read_new_stderr(iproc))
+        sys.stdout.flush()
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        for iproc in range(len(self.procs)):
+            self.stop_server(iproc)
+        self.procs = []
@@ -119,7 +119,9 @@ class ClusterPath(object):
                 lines = [line for line in reader]  # not sure that I really need this step
             self.readlines(lines, process_csv=True)
         elif utils.getsuffix(fname) == '.yaml':
-            utils.read_yaml_output(fname, cpath=self)
+            utils.read_yaml_output(fname, cpath=self, skip_annotations=True)
+        elif utils.getsuffix(fname) == '.db':
+            utils.read_db_output(fname, cpath=self, skip_annotations=True)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
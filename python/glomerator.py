@@ -1,11 +1,12 @@
-import itertools
 import os
 import sys
 import math
 import csv
 import time
+import numpy
 
 import utils
+import hammingutils
 from clusterpath import ClusterPath
 
 # ----------------------------------------------------------------------------------------
@@ -20,56 +21,60 @@ class Glomerator(object):
     def naive_seq_glomerate(self, naive_seqs, n_clusters, debug=False):
         """ Perform hierarchical agglomeration (with naive hamming distance as the distance), stopping at <n_clusters> """
         start = time.time()
-        clusters = [[names,] for names in naive_seqs.keys()]
-
-        seqs_per_cluster = float(len(clusters)) / n_clusters
+        seqs_per_cluster = float(len(naive_seqs)) / n_clusters
         max_per_cluster = int(math.ceil(seqs_per_cluster))
         if debug:
             print '  max %d per cluster' % max_per_cluster
 
-        distances = {}  # cache the calculated fractional hamming distances
+        # work with integer indices into <queries>: each index starts as a singleton cluster, and when two clusters merge the lower index keeps the merged cluster (the other is set inactive)
+        queries = list(naive_seqs)
+        members = [[q, ] for q in queries]
+        sizes = numpy.ones(len(queries), dtype=int)
+        active = numpy.ones(len(queries), dtype=bool)
+        distances = hammingutils.pairwise_hamming_fractions([naive_seqs[q] for q in queries])  # min-linkage (i.e. smallest naive hamming fraction between any two members) distances between clusters, updated as we merge
+        numpy.fill_diagonal(distances, float('inf'))
+        nearest_index = numpy.zeros(len(queries), dtype=int)  # for each cluster, the closest cluster that it's allowed to merge with...
+        nearest_distance = numpy.full(len(queries), float('inf'))  # ...and the distance to it (inf if there aren't any)
 
         # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
-                    continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
+        def update_nearest(iclust):
+            allowed = active.copy()
+            allowed[iclust] = False
+            if not glomerate.merge_whatever_you_got:  # skip clusters that would make a merged cluster that's too big
+                allowed &= sizes + sizes[iclust] <= max_per_cluster
+            if not allowed.any():
+                nearest_distance[iclust] = float('inf')
+                return
+            row = numpy.where(allowed, distances[iclust], float('inf'))
+            nearest_index[iclust] = numpy.argmin(row)
+            nearest_distance[iclust] = row[nearest_index[iclust]]
 
         # ----------------------------------------------------------------------------------------
         def glomerate():
             if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters_to_merge = get_clusters_to_merge()
-            if clusters_to_merge is None:  # if we didn't find a suitable pair
+                print '    current ', ' '.join([str(sizes[i]) for i in numpy.flatnonzero(active)])
+            iclust = numpy.argmin(numpy.where(active, nearest_distance, float('inf')))  # the pair of clusters with the smallest distance is the cluster with the smallest nearest distance, plus its nearest cluster
+            if math.isinf(nearest_distance[iclust]):  # if we didn't find a suitable pair
                 if debug:
                     print '    didn\'t find shiznitz'
-                glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
-                if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
+                glomerate.merge_whatever_you_got = True  # from now on, merge whatever's best regardless of size
+                for ic in numpy.flatnonzero(active):
+                    update_nearest(ic)
+                return
+            iclust, jclust = sorted([iclust, nearest_index[iclust]])
+            if debug:
+                print '    merging', sizes[iclust], sizes[jclust]
+            members[iclust] += members[jclust]
+            sizes[iclust] += sizes[jclust]
+            active[jclust] = False
+            nearest_distance[jclust] = float('inf')
+            distances[iclust] = numpy.minimum(distances[iclust], distances[jclust])  # min linkage
+            distances[:, iclust] = distances[iclust]
+            distances[iclust, iclust] = float('inf')
+            # distances to the merged cluster can't be smaller than anybody's current nearest distance, and only <iclust> got bigger, so we only need to update clusters whose nearest cluster was one of the two we merged
+            for ic in numpy.flatnonzero(active & ((nearest_index == iclust) | (nearest_index == jclust))):
+                update_nearest(ic)
+            update_nearest(iclust)
 
         # ----------------------------------------------------------------------------------------
         def homogenize():
@@ -92,9 +97,12 @@ class Glomerator(object):
         # da bizniz
         glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
 
-        while len(clusters) > n_clusters:
+        for iclust in range(len(queries)):
+            update_nearest(iclust)
+        while active.sum() > n_clusters:
             glomerate()
-        
+        clusters = [members[i] for i in numpy.flatnonzero(active)]
+
         if len(clusters) > 1:  # homogenize if partition is non-trivial
             clusters.sort(key=len)
 
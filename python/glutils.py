@@ -8,6 +8,8 @@ import random
 import re
 import numpy
 import glob
+import hashlib
+import shutil
 from collections import OrderedDict
 import csv
 from subprocess import check_call, Popen, PIPE
@@ -17,6 +19,7 @@ import indelutils
 
 # ----------------------------------------------------------------------------------------
 glfo_dir = 'germline-sets'  # always put germline info into a subdir with this name
+glfo_store_dir = 'germline-set-store'  # subdir of the workdir in which we write each distinct germline set once (see get_stored_gldir())
 
 # setting defaults here so that bin/test-germline-inference.py and bin/partis don't have to both have defaults in them
 default_n_genes_per_region = '42:18:6'
@@ -1070,6 +1073,42 @@ def remove_glfo_files(gldir, locus, print_warning=True):
     if len(os.listdir(gldir)) == 0:  # if there aren't any other locus dirs in here, remove the parent dir as well
         os.rmdir(gldir)
 
+# ----------------------------------------------------------------------------------------
+def glfo_hash(glfo):  # hash of everything that write_glfo() writes, in the same order (so identical glfos with their genes in a different order, e.g. from a deepcopy, get separate dirs, but we never hand a subprocess files in a different order to what it would've gotten before)
+    glfo_strs = [glfo['locus']]
+    for region in utils.getregions(glfo['locus']):
+        glfo_strs += ['%s:%s' % (g, s) for g, s in glfo['seqs'][region].items()]
+    for region, codon in sorted(utils.conserved_codons[glfo['locus']].items()):
+        glfo_strs += ['%s:%d' % (g, p) for g, p in glfo[codon + '-positions'].items()]
+    return hashlib.md5(' '.join(glfo_strs)).hexdigest()
+
+# ----------------------------------------------------------------------------------------
+def get_stored_gldir(storedir, glfo, debug=False):
+    """
+    Return a germline dir with the contents of <glfo> in <storedir>, writing it only if we haven't already written an identical germline set there.
+    Each germline set goes in a subdir named by the hash of its contents, so repeated calls with the same (or an identical) glfo just return the path, and dirs never need to be rewritten or removed until we're done with <storedir>.
+    """
+    gldir = storedir + '/' + glfo_hash(glfo)
+    if os.path.exists(gldir):
+        return gldir
+    if debug:
+        print '  writing glfo to store dir %s' % gldir
+    tmpdir = gldir + '.tmp'  # write to a temporary dir and then move it, so a dir with the final name is always complete (e.g. if we crash in the middle)
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    write_glfo(tmpdir, glfo)
+    os.rename(tmpdir, gldir)
+    return gldir
+
+# ----------------------------------------------------------------------------------------
+def remove_glfo_store(storedir, locus):
+    if not os.path.exists(storedir):
+        return
+    for gldir in [storedir + '/' + d for d in os.listdir(storedir)]:
+        remove_glfo_files(gldir, locus)  # also removes <gldir>, and removes <storedir> after the last one
+    if os.path.exists(storedir):  # i.e. if there were no germline sets in it
+        os.rmdir(storedir)
+
 # ----------------------------------------------------------------------------------------
 def get_alleles_per_gene_weights(n_alleles_per_gene):  # given desired mean alleles per gene, figure out the required probability for 1 and 2 alleles
     if n_alleles_per_gene == 1.:
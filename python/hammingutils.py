@@ -0,0 +1,69 @@
+import numpy
+
+import utils
+
+# vectorized versions of utils.hamming_distance() and utils.hamming_fraction(), for when you need distances between one sequence and many others, or between all pairs in a list
+# NOTE same conventions as the scalar versions: sequences must all be the same length, and positions at which either sequence has an ambiguous base or a gap (or, with <amino_acid>, just a gap) don't count toward either the distance or the length
+
+# ----------------------------------------------------------------------------------------
+def encode_seqs(seqs, amino_acid=False):
+    """ Return a uint8 array (one row per sequence in <seqs>) of the sequences' characters, and a boolean array that's True at positions that aren't ambiguous bases or gaps. """
+    if len(seqs) == 0:
+        return numpy.zeros((0, 0), dtype=numpy.uint8), numpy.zeros((0, 0), dtype=bool)
+    seq_len = len(seqs[0])
+    if any(len(s) != seq_len for s in seqs):
+        raise Exception('unequal length sequences: %s' % ' '.join(str(l) for l in sorted(set(len(s) for s in seqs))))
+    codes = numpy.frombuffer(str(''.join(seqs)), dtype=numpy.uint8).reshape(len(seqs), seq_len)
+    skip_chars = utils.gap_chars if amino_acid else utils.ambiguous_bases + utils.gap_chars
+    skip_codes = numpy.frombuffer(''.join(skip_chars), dtype=numpy.uint8)
+    unambiguous = ~numpy.isin(codes, skip_codes)
+    return codes, unambiguous
+
+# ----------------------------------------------------------------------------------------
+def get_fractions(distances, lengths):  # zero where there aren't any unambiguous positions (like utils.hamming_fraction())
+    fractions = numpy.zeros(distances.shape)
+    nonzero = lengths > 0
+    fractions[nonzero] = distances[nonzero] / lengths[nonzero].astype(float)
+    return fractions
+
+# ----------------------------------------------------------------------------------------
+def hamming_distances(seq, seqs, amino_acid=False, return_len_excluding_ambig=False):
+    """ Return an array with the hamming distance between <seq> and each sequence in <seqs> (and optionally also an array with the number of positions that were compared). """
+    codes, unambiguous = encode_seqs([seq] + list(seqs), amino_acid=amino_acid)
+    compared = unambiguous[1:] & unambiguous[0]
+    distances = ((codes[1:] != codes[0]) & compared).sum(axis=1)
+    if return_len_excluding_ambig:
+        return distances, compared.sum(axis=1)
+    else:
+        return distances
+
+# ----------------------------------------------------------------------------------------
+def hamming_fractions(seq, seqs, amino_acid=False):
+    """ Return an array with the hamming fraction between <seq> and each sequence in <seqs>. """
+    distances, lengths = hamming_distances(seq, seqs, amino_acid=amino_acid, return_len_excluding_ambig=True)
+    return get_fractions(distances, lengths)
+
+# ----------------------------------------------------------------------------------------
+def pairwise_hamming_distances(seqs, amino_acid=False, return_len_excluding_ambig=False):
+    """
+    Return the (symmetric) matrix of hamming distances between all pairs of sequences in <seqs> (and optionally also the matrix of the number of positions compared for each pair).
+    Rather than comparing each pair, this one-hot encodes the unambiguous characters, so the number of matching positions and the number of compared positions are both just matrix products.
+    """
+    codes, unambiguous = encode_seqs(seqs, amino_acid=amino_acid)
+    unambig_floats = unambiguous.astype(numpy.float32)  # float32 is exact up to 2^24, i.e. much longer than any sequence
+    lengths = unambig_floats.dot(unambig_floats.T)
+    n_matches = numpy.zeros(lengths.shape, dtype=numpy.float32)
+    for code in numpy.unique(codes[unambiguous]):
+        onehot = ((codes == code) & unambiguous).astype(numpy.float32)
+        n_matches += onehot.dot(onehot.T)
+    distances = numpy.rint(lengths - n_matches).astype(int)
+    if return_len_excluding_ambig:
+        return distances, numpy.rint(lengths).astype(int)
+    else:
+        return distances
+
+# ----------------------------------------------------------------------------------------
+def pairwise_hamming_fractions(seqs, amino_acid=False):
+    """ Return the (symmetric) matrix of hamming fractions between all pairs of sequences in <seqs>. """
+    distances, lengths = pairwise_hamming_distances(seqs, amino_acid=amino_acid, return_len_excluding_ambig=True)
+    return get_fractions(distances, lengths)
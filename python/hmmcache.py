@@ -0,0 +1,96 @@
+import os
+import csv
+import sqlite3
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class HmmCache(object):
+    """ Indexed (sqlite) store of the info in bcrham's hmm cache files (naive seqs, logprobs, etc. for each cluster), so we can look things up by cluster or by uid without reading the whole csv.
+    Keyed by the *set* of uids in each cluster (i.e. the sorted, colon-joined uids), so the same cluster with its uids in a different order gets one entry.
+    bcrham still reads and writes csv cache files, so new rows have to be added in here (with add_csv()) after each bcrham run.
+    Several processes can add to the same db file at once (sqlite serializes the transactions), since each add_csv() is one transaction. """
+    columns = [h for h in utils.partition_cachefile_headers if h != 'unique_ids']
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, dbfname):
+        self.dbfname = dbfname
+        self.conn = sqlite3.connect(dbfname, timeout=600)  # if another process is writing, wait (up to ten minutes) for it to finish rather than failing
+        self.conn.text_factory = str
+        self.conn.execute('create table if not exists clusters (key text primary key, unique_ids text, %s)' % ', '.join('%s text' % c for c in self.columns))
+        self.conn.execute('create table if not exists uids (uid text, key text)')  # one row for each uid in each cluster, so we can find all the clusters containing a uid
+        self.conn.execute('create index if not exists uid_index on uids (uid)')
+        self.conn.commit()
+
+    # ----------------------------------------------------------------------------------------
+    def get_key(self, uids):
+        return ':'.join(sorted(uids))
+
+    # ----------------------------------------------------------------------------------------
+    def add_rows(self, rows):  # <rows>: iterable of dicts with keys from utils.partition_cachefile_headers and (unprocessed, i.e. string) values, e.g. from a csv.DictReader on a cache file
+        n_new, n_updated = 0, 0
+        with self.conn:  # one transaction (commits at the end, or rolls back if there's an exception)
+            for row in rows:
+                uids = row['unique_ids'].split(':')
+                key = self.get_key(uids)
+                vals = [row.get(c, '') or '' for c in self.columns]
+                cursor = self.conn.execute('insert or ignore into clusters values (?, ?, %s)' % ', '.join('?' for _ in self.columns), [key, row['unique_ids']] + vals)
+                if cursor.rowcount == 1:
+                    self.conn.executemany('insert into uids values (?, ?)', [(uid, key) for uid in set(uids)])
+                    n_new += 1
+                else:  # already have this cluster (bcrham often writes a line with only a logprob, and a separate one with only a naive seq), so fill in with any non-empty new values
+                    self.conn.execute('update clusters set %s where key = ?' % ', '.join('%s = coalesce(nullif(?, \'\'), %s)' % (c, c) for c in self.columns), vals + [key])
+                    n_updated += 1
+        return n_new, n_updated
+
+    # ----------------------------------------------------------------------------------------
+    def add_csv(self, fname, debug=False):
+        with open(fname) as cachefile:
+            reader = csv.DictReader(cachefile)
+            if reader.fieldnames is None:  # empty file
+                return
+            if set(reader.fieldnames) != set(utils.partition_cachefile_headers):
+                raise Exception('unexpected header in hmm cache file %s: %s' % (fname, reader.fieldnames))
+            n_new, n_updated = self.add_rows(reader)
+        if debug:
+            print '      added %d new (%d updated) clusters from %s to hmm cache db' % (n_new, n_updated, fname)
+
+    # ----------------------------------------------------------------------------------------
+    def rowdict(self, dbrow):
+        return dict(zip(['unique_ids'] + self.columns, dbrow))
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, uids):  # returns the (unprocessed) row for the cluster with exactly the uids in <uids>, or None if it isn't there
+        dbrow = self.conn.execute('select unique_ids, %s from clusters where key = ?' % ', '.join(self.columns), [self.get_key(uids)]).fetchone()
+        return None if dbrow is None else self.rowdict(dbrow)
+
+    # ----------------------------------------------------------------------------------------
+    def get_overlapping(self, uids):  # returns rows for all clusters that contain any of the uids in <uids>
+        keys = set()
+        for uid in uids:
+            keys |= set(k for k, in self.conn.execute('select key from uids where uid = ?', [uid]))
+        return [self.rowdict(self.conn.execute('select unique_ids, %s from clusters where key = ?' % ', '.join(self.columns), [k]).fetchone()) for k in keys]
+
+    # ----------------------------------------------------------------------------------------
+    def naive_seqs(self, uids):  # return dict with the cached naive seq for each singleton in <uids> (skipping any that we don't have)
+        naive_seqs = {}
+        for uid in uids:  # since the key is the primary key, each one's just a lookup in the index
+            dbrow = self.conn.execute('select naive_seq from clusters where key = ?', [uid]).fetchone()
+            if dbrow is not None and dbrow[0] != '':
+                naive_seqs[uid] = dbrow[0]
+        return naive_seqs
+
+    # ----------------------------------------------------------------------------------------
+    def iterrows(self):
+        for dbrow in self.conn.execute('select unique_ids, %s from clusters' % ', '.join(self.columns)):
+            yield self.rowdict(dbrow)
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return self.conn.execute('select count(*) from clusters').fetchone()[0]
+
+    # ----------------------------------------------------------------------------------------
+    def close(self, remove=False):
+        self.conn.close()
+        if remove and os.path.exists(self.dbfname):
+            os.remove(self.dbfname)
@@ -0,0 +1,167 @@
+import json
+import re
+
+# ----------------------------------------------------------------------------------------
+class JsonStreamReader(object):
+    """
+    Incrementally parse a json file, one value at a time, rather than reading (and parsing) the whole thing into memory at once.
+    You walk through the file by hand: iter_object_keys() and iter_array() yield the keys/elements of the object/array at the current position, and decode_value() parses (and returns) a whole value.
+    NOTE after each key that iter_object_keys() yields, you have to consume its value (with decode_value(), iter_array(), or skip_value()) before asking for the next key.
+    """
+    whitespace = ' \t\n\r'
+    number_tail = re.compile(r'[0-9.eE+-]*\Z')  # characters that could continue a number, running to the end of the buffer
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, fname, chunk_size=2**20):
+        self.fname = fname
+        self.jsonfile = open(fname)
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''  # chunk of the file that we're currently parsing...
+        self.pos = 0  # ...our position in it...
+        self.buf_offset = 0  # ...and the file offset of its first character
+
+    # ----------------------------------------------------------------------------------------
+    def read_more(self, min_size=0):  # drop the part of the buffer that we've already parsed, and add at least <min_size> (and at least self.chunk_size) more characters from the file (returns False at eof)
+        chunk = self.jsonfile.read(max(self.chunk_size, min_size))
+        if chunk == '':
+            return False
+        self.buf_offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    # ----------------------------------------------------------------------------------------
+    def peek(self):  # skip whitespace, and return the next character (None at eof)
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                return None
+
+    # ----------------------------------------------------------------------------------------
+    def expect(self, chars):  # consume the next (non-whitespace) character, which must be one of <chars>, and return it
+        char = self.peek()
+        if char is None or char not in chars:
+            raise Exception('expected one of \'%s\' at offset %d in %s, but got %s' % (chars, self.tell(), self.fname, 'eof' if char is None else '\'%s\'' % char))
+        self.pos += 1
+        return char
+
+    # ----------------------------------------------------------------------------------------
+    def decode_value(self):  # parse and return the whole value at the current position
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:  # probably because the value runs past the end of the buffer, so double the buffer size and try again
+                if not self.read_more(2 * (len(self.buf) - self.pos)):
+                    raise
+                continue
+            if self.number_tail.match(self.buf, end) and self.read_more(2 * (len(self.buf) - self.pos)):  # a number at (or, if it got cut off after e.g. a '.' or 'e', just before) the end of the buffer might have more digits in the next chunk
+                continue
+            self.pos = end
+            return value
+
+    # ----------------------------------------------------------------------------------------
+    def iter_object_keys(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(':')
+            yield key  # caller consumes the value
+            if self.expect(',}') == '}':
+                return
+
+    # ----------------------------------------------------------------------------------------
+    def iter_array(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self.expect(',]') == ']':
+                return
+
+    # ----------------------------------------------------------------------------------------
+    def skip_value(self):  # arrays are skipped an element at a time, so skipping a big array doesn't need much memory (although we still have to parse it)
+        if self.peek() == '[':
+            for _ in self.iter_array():
+                pass
+        else:
+            self.decode_value()
+
+    # ----------------------------------------------------------------------------------------
+    def tell(self):
+        return self.buf_offset + self.pos
+
+    # ----------------------------------------------------------------------------------------
+    def seek(self, offset):
+        self.jsonfile.seek(offset)
+        self.buf, self.pos, self.buf_offset = '', 0, offset
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        self.jsonfile.close()
+
+# ----------------------------------------------------------------------------------------
+class JsonStreamWriter(object):
+    """
+    Write a json file incrementally, one value at a time, rather than building the whole thing in memory and writing it with a single json.dump().
+    You walk through the structure by hand: start_object()/end_object() and start_array()/end_array() open and close containers, write_key() writes the key for the next value in an object, and write_value() writes a whole value.
+    Output is identical to what json.dump() would write for the same structure (with default separators), so it can be read by anything that reads json.dump() files, e.g. JsonStreamReader.
+    """
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, jsonfile):
+        self.jsonfile = jsonfile
+        self.n_items = []  # for each object/array that we're currently inside, the number of items we've written to it so far
+        self.after_key = False  # True if we just wrote an object key, so the next value doesn't need a separator
+
+    # ----------------------------------------------------------------------------------------
+    def start_item(self):  # write a separator, if needed, before the next key or value
+        if self.after_key:
+            self.after_key = False
+            return
+        if len(self.n_items) > 0:
+            if self.n_items[-1] > 0:
+                self.jsonfile.write(', ')
+            self.n_items[-1] += 1
+
+    # ----------------------------------------------------------------------------------------
+    def write_key(self, key):
+        self.start_item()
+        self.jsonfile.write(json.dumps(key) + ': ')
+        self.after_key = True
+
+    # ----------------------------------------------------------------------------------------
+    def write_value(self, value):
+        self.start_item()
+        self.jsonfile.write(json.dumps(value))
+
+    # ----------------------------------------------------------------------------------------
+    def start_container(self, char):
+        self.start_item()
+        self.jsonfile.write(char)
+        self.n_items.append(0)
+
+    # ----------------------------------------------------------------------------------------
+    def end_container(self, char):
+        if len(self.n_items) == 0 or self.after_key:
+            raise Exception('can\'t close \'%s\' here (not in a container, or missing the value for the last key)' % char)
+        self.n_items.pop()
+        self.jsonfile.write(char)
+
+    # ----------------------------------------------------------------------------------------
+    def start_object(self):
+        self.start_container('{')
+    def end_object(self):
+        self.end_container('}')
+    def start_array(self):
+        self.start_container('[')
+    def end_array(self):
+        self.end_container(']')
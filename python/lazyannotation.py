@@ -0,0 +1,113 @@
+import copy
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class LazyAnnotation(dict):
+    """
+    Annotation dict (i.e. a <line>) that only adds its implicit info (see utils.add_implicit_info()) when something asks for one of the implicit keys, so if you only need, say, the genes or the naive sequence you don't pay for the qr seqs, functional info, mutation info, alignments, etc.
+    The germline-derived keys (naive seq, cdr3 length, codon positions, gl seqs...) are cheap and get added together; asking for any other implicit key adds everything.
+    Asking for the keys/items/values, iterating over it, comparing it, or copying/pickling it adds everything first, so apart from the timing it should look exactly like a line that had add_implicit_info() called on it.
+    NOTE plain dict operations that happen at the C level, e.g. dict(line) or {}.update(line), only see keys that have already been added, so use materialize() first if you need them. Similarly, if you modify any of the non-implicit info (e.g. the seqs or deletions) you should call materialize() before doing so, since otherwise the implicit info will get calculated from the modified values.
+    """
+    germline_keys = set(['lengths', 'codon_positions', 'cdr3_length', 'naive_seq', 'regional_bounds'] + [r + '_gl_seq' for r in utils.regions])  # keys added by utils.add_germline_implicit_info()
+    indel_gap_keys = ['has_shm_indels', 'qr_gap_seqs', 'gl_gap_seqs']  # what new-style files have instead of 'indelfos' (they get converted [and removed] by indelutils.deal_with_indel_stuff(), so we hide them until then)
+    indel_keys = set(['indelfos'] + indel_gap_keys)
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, glfo, line, aligned_gl_seqs=None):
+        if line['v_gene'] == '':
+            raise Exception('can\'t add implicit info to line with failed annotation %s' % ':'.join(line['unique_ids']))
+        dict.__init__(self, line)
+        self.glfo = glfo
+        self.aligned_gl_seqs = aligned_gl_seqs
+        self.added_germline_info, self.added_sequence_info = False, False
+        self.indel_gap_info = {k : dict.pop(self, k) for k in self.indel_gap_keys if dict.__contains__(self, k)}
+        utils.re_sort_per_gene_support(self)  # cheap, and it modifies a non-implicit key, so we do it right away
+        if dict.__contains__(self, 'indelfos'):  # old-style file (or a line that's already been through indelutils), so the indel info needs to be reconstructed (or checked) right away
+            self.materialize()
+
+    # ----------------------------------------------------------------------------------------
+    def materialize(self, only_germline_info=False):  # add all the implicit info (or only the germline-derived part) that we haven't already added
+        if not self.added_germline_info:
+            self.added_germline_info = True  # set these *before* adding, since the add fcns check for keys in <self>
+            utils.add_germline_implicit_info(self.glfo, self)
+        if not only_germline_info and not self.added_sequence_info:
+            self.added_sequence_info = True
+            dict.update(self, self.indel_gap_info)
+            utils.add_sequence_implicit_info(self.glfo, self, aligned_gl_seqs=self.aligned_gl_seqs)
+        return self
+
+    # ----------------------------------------------------------------------------------------
+    def add_missing_key(self, key):  # if <key> is an implicit (or indel) key that we don't have yet, add the info that'll give it to us
+        if (key in utils.implicit_linekeys or key in self.indel_keys) and not dict.__contains__(self, key):
+            self.materialize(only_germline_info=key in self.germline_keys)
+
+    # ----------------------------------------------------------------------------------------
+    def __missing__(self, key):  # only gets called by self[key] if <key> isn't there yet
+        self.add_missing_key(key)
+        if not dict.__contains__(self, key):  # either it isn't an implicit key, or it couldn't be added (e.g. the indel info couldn't be reconstructed, which sets 'invalid' and stops, the same as add_implicit_info() does)
+            raise KeyError(key)
+        return dict.__getitem__(self, key)
+
+    # ----------------------------------------------------------------------------------------
+    def __contains__(self, key):
+        self.add_missing_key(key)
+        return dict.__contains__(self, key)
+
+    # ----------------------------------------------------------------------------------------
+    def has_key(self, key):
+        return key in self
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, key, default=None):
+        self.add_missing_key(key)
+        return dict.get(self, key, default)
+
+    # ----------------------------------------------------------------------------------------
+    def pop(self, key, *args):
+        self.add_missing_key(key)
+        return dict.pop(self, key, *args)
+
+    # ----------------------------------------------------------------------------------------
+    def setdefault(self, key, default=None):
+        self.add_missing_key(key)
+        return dict.setdefault(self, key, default)
+
+    # ----------------------------------------------------------------------------------------
+    # everything that looks at all the keys at once
+    def keys(self):
+        return dict.keys(self.materialize())
+    def values(self):
+        return dict.values(self.materialize())
+    def items(self):
+        return dict.items(self.materialize())
+    def iterkeys(self):
+        return dict.iterkeys(self.materialize())
+    def itervalues(self):
+        return dict.itervalues(self.materialize())
+    def iteritems(self):
+        return dict.iteritems(self.materialize())
+    def __iter__(self):
+        return dict.__iter__(self.materialize())
+    def __len__(self):
+        return dict.__len__(self.materialize())
+    def __eq__(self, other):
+        if isinstance(other, LazyAnnotation):
+            other.materialize()
+        return dict.__eq__(self.materialize(), other)
+    def __ne__(self, other):
+        return not self == other
+    def __repr__(self):
+        return dict.__repr__(self.materialize())
+
+    # ----------------------------------------------------------------------------------------
+    # copies (and pickles) are plain dicts with everything added (in particular, we don't want to deep copy the glfo)
+    def copy(self):
+        return dict(self.materialize())
+    def __copy__(self):
+        return self.copy()
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self.materialize()), memo)
+    def __reduce__(self):
+        return (dict, (dict(self.materialize()), ))
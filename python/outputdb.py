@@ -0,0 +1,90 @@
+import os
+import json
+import sqlite3
+
+# ----------------------------------------------------------------------------------------
+class OutputDB(object):
+    """
+    Sqlite version of a partis output file (i.e. the same info as a .yaml output file: version info, germline info, partitions, and events), with indexes so you can look up the annotations or clusters for particular uids without reading everything.
+    Tables:
+      - info: json-encoded version info and germline info
+      - partitions: one json-encoded partition line for each partition
+      - clusters: one row for each uid in each cluster in each partition, indexed by uid
+      - events: one json-encoded annotation (as written to .yaml files, i.e. without implicit info) for each event
+      - sequences: one row for each sequence in each event, indexed by uid
+    Use utils.write_annotations() and utils.read_output() (which call utils.write_db_output() and utils.read_db_output()) rather than using this directly.
+    """
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, fname, create=False):
+        self.fname = fname
+        if create:
+            if os.path.exists(fname):
+                os.remove(fname)
+        elif not os.path.exists(fname):
+            raise Exception('output db file %s doesn\'t exist' % fname)
+        self.conn = sqlite3.connect(fname)
+        self.conn.text_factory = str
+        if create:
+            with self.conn:
+                self.conn.execute('create table info (key text primary key, value text)')
+                self.conn.execute('create table partitions (ipart integer primary key, line text)')
+                self.conn.execute('create table clusters (uid text, ipart integer, icluster integer)')
+                self.conn.execute('create table events (ievent integer primary key, unique_ids text, line text)')
+                self.conn.execute('create table sequences (uid text, ievent integer, iseq integer)')
+
+    # ----------------------------------------------------------------------------------------
+    def write(self, version_info, glfo, partition_lines, events):  # <events>: iterable of (json-able) annotations, which we only go through once (so it can be an iterator)
+        with self.conn:  # one transaction
+            self.conn.executemany('insert into info values (?, ?)', [('version-info', json.dumps(version_info)), ('germline-info', json.dumps(glfo))])
+            for ipart, pline in enumerate(partition_lines):
+                self.conn.execute('insert into partitions values (?, ?)', (ipart, json.dumps(pline)))
+                self.conn.executemany('insert into clusters values (?, ?, ?)', ((uid, ipart, icluster) for icluster, cluster in enumerate(pline['partition']) for uid in cluster))
+            for ievent, line in enumerate(events):
+                self.conn.execute('insert into events values (?, ?, ?)', (ievent, ':'.join(line['unique_ids']), json.dumps(line)))
+                self.conn.executemany('insert into sequences values (?, ?, ?)', ((uid, ievent, iseq) for iseq, uid in enumerate(line['unique_ids'])))
+            self.conn.execute('create index cluster_uid_index on clusters (uid)')  # faster to add the indices after inserting everything
+            self.conn.execute('create index cluster_index on clusters (ipart, icluster)')
+            self.conn.execute('create index sequence_uid_index on sequences (uid)')
+
+    # ----------------------------------------------------------------------------------------
+    def get_info(self, key):
+        dbrow = self.conn.execute('select value from info where key = ?', [key]).fetchone()
+        if dbrow is None:
+            raise Exception('couldn\'t find \'%s\' in %s' % (key, self.fname))
+        return json.loads(dbrow[0])
+
+    # ----------------------------------------------------------------------------------------
+    def get_partition_lines(self):
+        return [json.loads(l) for l, in self.conn.execute('select line from partitions order by ipart')]
+
+    # ----------------------------------------------------------------------------------------
+    def get_event_indices(self, uids):  # indices of events that contain any of <uids>
+        ievents = set()
+        for uid in uids:
+            ievents |= set(i for i, in self.conn.execute('select ievent from sequences where uid = ?', [uid]))
+        return sorted(ievents)
+
+    # ----------------------------------------------------------------------------------------
+    def iter_events(self, uids=None):  # yield (in file order) all events, or if <uids> is set, only the ones that contain any of <uids>
+        if uids is None:
+            cursor = self.conn.execute('select line from events order by ievent')
+        else:
+            ievents = self.get_event_indices(uids)
+            cursor = (self.conn.execute('select line from events where ievent = ?', [i]).fetchone() for i in ievents)
+        for line, in cursor:
+            yield json.loads(line)
+
+    # ----------------------------------------------------------------------------------------
+    def get_clusters(self, uid, ipart=None):  # return the clusters containing <uid> in each partition (or only in partition <ipart>), as a dict keyed by partition index
+        query, vals = 'select ipart, icluster from clusters where uid = ?', [uid]
+        if ipart is not None:
+            query += ' and ipart = ?'
+            vals.append(ipart)
+        clusters = {}
+        for ip, icluster in self.conn.execute(query, vals).fetchall():
+            clusters[ip] = [u for u, in self.conn.execute('select uid from clusters where ipart = ? and icluster = ? order by rowid', [ip, icluster])]  # rowid order is the order we inserted them, i.e. the order in the cluster
+        return clusters
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        self.conn.close()
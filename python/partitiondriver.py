@@ -11,8 +11,11 @@ import csv
 csv.field_size_limit(sys.maxsize)  # make sure we can write very large csv fields
 import random
 from collections import OrderedDict
-from subprocess import Popen, check_call, PIPE, CalledProcessError, check_output
+from subprocess import Popen, check_call, PIPE, check_output
 import copy
+import hashlib
+import shutil
+import heapq
 import multiprocessing
 import operator
 import traceback
@@ -20,7 +23,9 @@ import traceback
 import utils
 import glutils
 import indelutils
+import hammingutils
 import treeutils
+import swinfostore
 from glomerator import Glomerator
 from clusterpath import ClusterPath
 from waterer import Waterer
@@ -31,6 +36,9 @@ from allelefinder import AlleleFinder
 from performanceplotter import PerformancePlotter
 from partitionplotter import PartitionPlotter
 from hist import Hist
+from bcrhampool import BcrhamPool
+from hmmcache import HmmCache
+from lazyannotation import LazyAnnotation
 import seqfileopener
 
 # ----------------------------------------------------------------------------------------
@@ -43,8 +51,14 @@ class PartitionDriver(object):
         self.simglfo = simglfo
         self.reco_info = reco_info
 
-        utils.prep_dir(self.args.workdir)
-        self.my_gldir = self.args.workdir + '/' + glutils.glfo_dir
+        self.previous_partition, self.previous_annotations = None, None  # with --previous-output, the best partition and cluster annotations from that file
+        self.new_uids = None  # ...the uids that aren't in it
+        self.set_aside_clusters = None  # ...and the previous clusters that aren't close enough to any new sequence to need rerunning
+        if self.args.previous_output is not None:  # has to happen before we set the sw cache path, since it adds the previous sequences to <self.input_info>
+            self.read_previous_output()
+
+        self.glfo_storedir = self.args.workdir + '/' + glutils.glfo_store_dir  # germline sets that we pass to subprocesses (ig-sw, vsearch, bcrham) are each written once to a subdir of this (see glutils.get_stored_gldir())
+        self.my_gldir = None  # set to the stored germline dir for the current glfo just before running bcrham
         if args.infname is not None:
             if self.args.sw_cachefname is None:
                 self.sw_cache_path = self.args.parameter_dir + '/sw-cache-' + repr(abs(hash(''.join(self.input_info.keys()))))  # remain suffix-agnostic
@@ -57,6 +71,9 @@ class PartitionDriver(object):
         self.timing_info = []  # it would be really nice to clean up both this and bcrham_proc_info
         self.istep = None  # stupid hack to get around network file system issues (see self.subworkidr()
         self.subworkdirs = []  # arg. same stupid hack
+        self.bcrham_pool = None  # persistent bcrham processes for the clustering loop (only if --persistent-bcrham-workers is set)
+        self.split_cost_exponent = 1.5  # exponent of cluster size in the estimated bcrham cost of each cluster (recalibrated after each multi-process step, see self.calibrate_split_cost())
+        self.split_proc_features = None  # cost features of the clusters that we sent to each process in the most recent split_input() call
 
         self.unseeded_seqs = None  # all the queries that we *didn't* cluster with the seed uid
         self.small_cluster_seqs = None  # all the queries that we removed after a few partition steps 'cause they were in small clusters
@@ -68,6 +85,15 @@ class PartitionDriver(object):
         self.hmm_cachefname = self.args.workdir + '/hmm_cached_info.csv'
         self.hmm_outfname = self.args.workdir + '/hmm_output.csv'
         self.cpath_progress_dir = '%s/cluster-path-progress' % self.args.workdir  # write the cluster paths for each clustering step to separate files in this dir
+        self.resume_statefname = self.args.workdir + '/resume-state.json'  # with --resume, the state of the clustering loop after the most recent step...
+        self.resume_cachefname = self.args.workdir + '/resume-hmm-cache.csv'  # ...and a copy of the hmm cache file from then
+        self.resume_state = None  # set if --resume is set and we find a clustering step to resume from
+
+        if self.args.resume:
+            self.prep_resume_workdir()
+        else:
+            utils.prep_dir(self.args.workdir)
+        self.hmm_cache = HmmCache(self.args.workdir + '/hmm_cache.db')  # indexed copy of everything in the hmm cache file, for lookups from python (bcrham still uses the csv)
 
         if self.args.outfname is not None:
             utils.prep_dir(dirname=None, fname=self.args.outfname, allow_other_files=True)
@@ -127,11 +153,12 @@ class PartitionDriver(object):
             lockfile = open(lockfname, 'w')
             if not os.path.exists(self.args.persistent_cachefname):
                 open(self.args.persistent_cachefname, 'w').close()
-            self.merge_files(infnames=[self.args.persistent_cachefname, self.hmm_cachefname], outfname=self.args.persistent_cachefname, dereplicate=True)
+            self.merge_files(infnames=[self.args.persistent_cachefname, self.hmm_cachefname], outfname=self.args.persistent_cachefname, dereplicate=True, dereplicate_key='unique_ids')  # a cluster's rows from different runs can differ in other columns (e.g. logprob), so we only keep the first one for each cluster
             lockfile.close()
             os.remove(lockfname)
         if os.path.exists(self.hmm_cachefname):
             os.remove(self.hmm_cachefname)
+        self.hmm_cache.close(remove=True)
 
         for subd in self.subworkdirs:
             if os.path.exists(subd):  # if there was only one proc for this step, it'll have already been removed
@@ -142,11 +169,110 @@ class PartitionDriver(object):
                 os.remove(cpfname)
             os.rmdir(self.cpath_progress_dir)
 
+        for fname in [self.resume_statefname, self.resume_cachefname]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+        glutils.remove_glfo_store(self.glfo_storedir, self.args.locus)
+
         try:
             os.rmdir(self.args.workdir)
         except OSError:
             raise Exception('workdir (%s) not empty: %s' % (self.args.workdir, ' '.join(os.listdir(self.args.workdir))))  # hm... you get weird recursive exceptions if you get here. Oh, well, it still works
 
+    # ----------------------------------------------------------------------------------------
+    def prep_resume_workdir(self):  # with --resume, look for the state from a previous (interrupted) run with the same --workdir, and remove everything else that run left in the workdir
+        if not os.path.exists(self.resume_statefname):  # nothing to resume from, so it had better be a new (or empty) workdir
+            utils.prep_dir(self.args.workdir)
+            self.write_resume_state({'istep' : None})  # mark the workdir as ours, so if we get interrupted before the first clustering step finishes, the next --resume run knows it's ok to clean it out
+            return
+
+        with open(self.resume_statefname) as statefile:
+            state = json.load(statefile)
+        files_to_keep = [self.resume_statefname]
+        if state['istep'] is not None:  # i.e. at least one clustering step finished
+            self.resume_state = state
+            files_to_keep += [self.resume_cachefname, self.cpath_progress_dir]
+            for cpfname in glob.glob(self.cpath_progress_dir + '/istep-*.csv'):  # remove progress files from steps that didn't finish (i.e. the one that got interrupted)
+                if int(os.path.basename(cpfname).replace('istep-', '').replace('.csv', '')) >= state['istep']:
+                    os.remove(cpfname)
+        n_removed = 0
+        for fname in [self.args.workdir + '/' + f for f in os.listdir(self.args.workdir)]:
+            if fname in files_to_keep:
+                continue
+            if os.path.isdir(fname):
+                shutil.rmtree(fname)
+            else:
+                os.remove(fname)
+            n_removed += 1
+        print '  --resume: %s (removed %d other files/dirs from %s)' % ('no finished clustering steps to resume from' if self.resume_state is None else 'will resume clustering at step %d' % self.resume_state['istep'], n_removed, self.args.workdir)
+
+    # ----------------------------------------------------------------------------------------
+    def write_resume_state(self, state):  # write to a tmp file and then move it, so there's always a complete state file if we get killed partway through
+        with open(self.resume_statefname + '.tmp', 'w') as statefile:
+            json.dump(state, statefile)
+        os.rename(self.resume_statefname + '.tmp', self.resume_statefname)
+
+    # ----------------------------------------------------------------------------------------
+    def checkpoint_clustering(self, n_procs, n_proc_list, cpath, initial_nseqs):  # save everything we need to restart the clustering loop at step self.istep with <n_procs> and <cpath>
+        if os.path.exists(self.hmm_cachefname):  # the cache file gets appended to (or rewritten, if n_procs is 1) during each step, so we need a copy from right now
+            shutil.copyfile(self.hmm_cachefname, self.resume_cachefname + '.tmp')
+            os.rename(self.resume_cachefname + '.tmp', self.resume_cachefname)
+        self.write_resume_state({'istep' : self.istep,
+                                 'n_procs' : n_procs,
+                                 'n_proc_list' : n_proc_list,
+                                 'initial_nseqs' : initial_nseqs,
+                                 'partition' : cpath.partitions[cpath.i_best_minus_x],
+                                 'unseeded_seqs' : self.unseeded_seqs,
+                                 'small_cluster_seqs' : self.small_cluster_seqs,
+                                 'split_cost_exponent' : self.split_cost_exponent})
+
+    # ----------------------------------------------------------------------------------------
+    def restore_clustering_checkpoint(self):
+        state = self.resume_state
+        def strlist(uids):  # json gives us unicode
+            return None if uids is None else [str(u) for u in uids]
+        partition = [strlist(cluster) for cluster in state['partition']]
+        missing_uids = set(uid for cluster in partition for uid in cluster) - set(self.sw_info['queries'])
+        if len(missing_uids) > 0:
+            raise Exception('%d uids in --resume state file %s aren\'t among the sw queries (e.g. %s), so it must be from a run on different input' % (len(missing_uids), self.resume_statefname, ' '.join(list(missing_uids)[:5])))
+        if os.path.exists(self.resume_cachefname):
+            shutil.copyfile(self.resume_cachefname, self.hmm_cachefname)
+            self.hmm_cache.add_csv(self.hmm_cachefname)
+        self.istep = state['istep']
+        self.unseeded_seqs = strlist(state['unseeded_seqs'])
+        self.small_cluster_seqs = strlist(state['small_cluster_seqs'])
+        self.split_cost_exponent = state['split_cost_exponent']
+        cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
+        cpath.add_partition(partition, -1., state['n_procs'])
+        print '  resuming at clustering step %d (previous steps used n_procs %s)' % (self.istep, ' '.join(str(n) for n in state['n_proc_list']))
+        return state['n_procs'], list(state['n_proc_list']), cpath, state['initial_nseqs']
+
+    # ----------------------------------------------------------------------------------------
+    def read_previous_output(self):  # read the partition and annotations from --previous-output, and add its sequences to <self.input_info> (so the input file only needs to contain the new ones)
+        _, annotation_list, cpath = utils.read_output(self.args.previous_output, glfo=self.glfo, lazy_implicit_info=True)  # we only end up using the annotations for clusters that don't change
+        if cpath is None or cpath.i_best is None:
+            raise Exception('no partitions in --previous-output %s' % self.args.previous_output)
+        self.previous_annotations = {':'.join(l['unique_ids']) : l for l in annotation_list if not l['invalid']}
+        previous_input_seqs = {uid : seq for line in self.previous_annotations.values() for uid, seq in zip(line['unique_ids'], line['input_seqs'])}
+
+        self.previous_partition = []
+        missing_uids = set()
+        for cluster in cpath.partitions[cpath.i_best]:
+            missing_uids |= set(cluster) - set(previous_input_seqs)
+            self.previous_partition.append([uid for uid in cluster if uid in previous_input_seqs])
+        self.previous_partition = [c for c in self.previous_partition if len(c) > 0]
+        if len(missing_uids) > 0:
+            print '  %s %d uid%s in the best partition from --previous-output don\'t have annotations, so skipping them: %s' % (utils.color('yellow', 'warning'), len(missing_uids), utils.plural(len(missing_uids)), ' '.join(missing_uids))
+
+        previous_uids = set(uid for cluster in self.previous_partition for uid in cluster)
+        self.new_uids = set(self.input_info) - previous_uids
+        for uid in previous_uids - set(self.input_info):  # NOTE if a previous uid is also in the input file, we use the input file's sequence
+            if self.reco_info is not None and uid not in self.reco_info:
+                raise Exception('uid %s from --previous-output isn\'t in the simulation info from the input file, so it has to be in the input file' % uid)
+            self.input_info[uid] = {'unique_ids' : [uid, ], 'seqs' : [previous_input_seqs[uid], ]}
+        print '  --previous-output: read %d clusters with %d sequences from %s (%d new sequences in input file)' % (len(self.previous_partition), len(previous_uids), self.args.previous_output, len(self.new_uids))
+
     # ----------------------------------------------------------------------------------------
     def deal_with_persistent_cachefile(self):
         if self.args.persistent_cachefname is None or not os.path.exists(self.args.persistent_cachefname):  # nothin' to do (ham'll initialize it)
@@ -168,6 +294,7 @@ class PartitionDriver(object):
                         writer.writerow(outrow)
             elif set(reader.fieldnames) == set(utils.partition_cachefile_headers):  # headers are ok, so can just copy straight over
                 check_call(['cp', self.args.persistent_cachefname, self.hmm_cachefname])
+                self.hmm_cache.add_csv(self.hmm_cachefname)
             else:
                 raise Exception('--persistent-cachefname %s has unexpected header list %s' % (self.args.persistent_cachefname, reader.fieldnames))
 
@@ -185,7 +312,7 @@ class PartitionDriver(object):
                           count_parameters=count_parameters,
                           parameter_out_dir=self.sw_param_dir if write_parameters else None,
                           plot_annotation_performance=self.args.plot_annotation_performance,
-                          duplicates=self.duplicates, pre_failed_queries=pre_failed_queries, aligned_gl_seqs=self.aligned_gl_seqs, vs_info=self.vs_info)
+                          duplicates=self.duplicates, pre_failed_queries=pre_failed_queries, aligned_gl_seqs=self.aligned_gl_seqs, vs_info=self.vs_info, seq_cachefname=self.args.sw_seq_cachefname)
 
         cachefname = self.sw_cache_path + ('.yaml' if self.args.sw_cachefname is None else utils.getsuffix(self.args.sw_cachefname))  # use yaml, unless csv was explicitly set on the command line
         if look_for_cachefile:
@@ -201,6 +328,8 @@ class PartitionDriver(object):
             waterer.run(cachefname if write_cachefile else None)
 
         self.sw_info = waterer.info
+        if self.args.compact_sw_info:
+            self.sw_info = swinfostore.compact_sw_info(waterer.info)
         for uid, dupes in waterer.duplicates.items():  # <waterer.duplicates> is <self.duplicates> OR'd into any new duplicates from this run
             self.duplicates[uid] = dupes
 
@@ -224,7 +353,7 @@ class PartitionDriver(object):
     # ----------------------------------------------------------------------------------------
     def set_vsearch_info(self, get_annotations=False):  # NOTE setting match:mismatch to optimized values from sw (i.e. 5:-4) results in much worse shm indel performance, so we leave it at the vsearch defaults ('2:-4')
         seqs = {sfo['unique_ids'][0] : sfo['seqs'][0] for sfo in self.input_info.values()}
-        self.vs_info = utils.run_vsearch('search', seqs, self.args.workdir + '/vsearch', threshold=0.3, glfo=self.glfo, print_time=True, vsearch_binary=self.args.vsearch_binary, get_annotations=get_annotations, no_indels=self.args.no_indels)
+        self.vs_info = utils.run_vsearch('search', seqs, self.args.workdir + '/vsearch', threshold=0.3, glfo=self.glfo, print_time=True, vsearch_binary=self.args.vsearch_binary, get_annotations=get_annotations, no_indels=self.args.no_indels, glfo_storedir=self.glfo_storedir)
 
     # ----------------------------------------------------------------------------------------
     def cache_parameters(self):
@@ -302,9 +431,12 @@ class PartitionDriver(object):
         n_queries_read = 0
         failed_query_strs = set()
         annotations = OrderedDict()
+        line_decoder = None
         for line in annotation_lines:
             if process_csv:
-                utils.process_input_line(line)
+                if line_decoder is None:
+                    line_decoder = utils.get_line_decoder(line.keys())
+                line_decoder(line)
             uidstr = ':'.join(line['unique_ids'])
             if ('invalid' in line and line['invalid']) or line['v_gene'] == '':  # first way is the new way, but we have to check the empty-v-gene way too for old files
                 failed_query_strs.add(uidstr)
@@ -314,8 +446,7 @@ class PartitionDriver(object):
                     continue
             if self.args.reco_ids is not None and line['reco_id'] not in self.args.reco_ids:
                 continue
-            utils.add_implicit_info(self.glfo, line)
-            annotations[uidstr] = line
+            annotations[uidstr] = LazyAnnotation(self.glfo, line)  # only adds implicit info as it's needed (e.g. plotting partitions doesn't need most of it)
 
             n_queries_read += 1
             if self.args.n_max_queries > 0 and n_queries_read >= self.args.n_max_queries:
@@ -420,7 +551,11 @@ class PartitionDriver(object):
         elif utils.getsuffix(outfname) == '.yaml':  # new way
             # NOTE replaces <self.glfo>, which is definitely what we want (that's the point of putting glfo in the yaml file), but it's still different behavior than if reading a csv
             assert self.glfo is None  # make sure bin/partis successfully figured out that we would be reading the glfo from the yaml output file
-            self.glfo, annotation_lines, cpath = utils.read_yaml_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id)  # add implicit info below, so we can skip some of 'em
+            self.glfo, annotation_lines, cpath = utils.read_yaml_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id, stream_annotations=True)  # add implicit info below, so we can skip some of 'em (and read them one at a time, so we only keep the ones we want in memory)
+        elif utils.getsuffix(outfname) == '.db':  # same as yaml, except if --queries is set we can look up the events that have them, rather than reading everything
+            assert self.glfo is None
+            queries = self.args.queries if not ignore_args_dot_queries else None  # NOTE n_max_queries, if set, is applied to the events *after* selecting by --queries (in parse_existing_annotations()), so we can't apply it here
+            self.glfo, annotation_lines, cpath = utils.read_db_output(outfname, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id, stream_annotations=True, queries=queries)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
@@ -456,9 +591,17 @@ class PartitionDriver(object):
         print 'hmm'
 
         # pre-cache hmm naive seq for each single query NOTE <self.current_action> is still 'partition' for this (so that we build the correct bcrham command line)
-        if self.args.persistent_cachefname is None or not os.path.exists(self.hmm_cachefname):  # if the default (no persistent cache file), or if a not-yet-existing persistent cache file was specified
-            print 'caching all %d naive sequences' % len(self.sw_info['queries'])  # this used to be a speed optimization, but now it's so we have better naive sequences for the pre-bcrham collapse
-            self.run_hmm('viterbi', self.sub_param_dir, n_procs=self.auto_nprocs(len(self.sw_info['queries'])), precache_all_naive_seqs=True)
+        if self.resume_state is not None:  # resuming a previous run's clustering loop, so we already have the naive seqs (in its hmm cache file)
+            print 'using cached naive sequences from --resume checkpoint'
+        elif self.args.persistent_cachefname is None or not os.path.exists(self.hmm_cachefname):  # if the default (no persistent cache file), or if a not-yet-existing persistent cache file was specified
+            precache_partition = None
+            if self.previous_partition is not None:  # only need naive seqs for the new sequences (bcrham calculates the ones for any previous clusters that it needs)
+                precache_partition = [[q] for q in self.sw_info['queries'] if q in self.new_uids]
+                if len(precache_partition) == 0:
+                    raise Exception('no new sequences (that passed smith-waterman) to add to the clusters from --previous-output')
+            n_precache_queries = len(self.sw_info['queries']) if precache_partition is None else len(precache_partition)
+            print 'caching all %d naive sequences' % n_precache_queries  # this used to be a speed optimization, but now it's so we have better naive sequences for the pre-bcrham collapse
+            self.run_hmm('viterbi', self.sub_param_dir, n_procs=self.auto_nprocs(n_precache_queries), precache_all_naive_seqs=True, partition=precache_partition)
 
         if self.args.naive_vsearch or self.args.naive_swarm:
             cpath = self.cluster_with_naive_vsearch_or_swarm(parameter_dir=self.sub_param_dir)
@@ -571,44 +714,41 @@ class PartitionDriver(object):
             print 'merging shared clusters'
             cpath.print_partitions()
 
-        # find every pair of clusters that has some overlap
-        cluster_groups = []
-        if debug:
-            print ' making cluster_groups'
+        # union-find over cluster indices: any two clusters that share a uid end up with the same root
+        parents = range(len(partition))
+        def find_root(iclust):
+            while parents[iclust] != iclust:
+                parents[iclust] = parents[parents[iclust]]  # path halving
+                iclust = parents[iclust]
+            return iclust
+        first_clusters = {}  # index of the first cluster in which we saw each uid
         for iclust in range(len(partition)):
-            for jclust in range(iclust + 1, len(partition)):
-                if len(set(partition[iclust]) & set(partition[jclust])) > 0:
-                    if debug:
-                        print '  %d %d' % (iclust, jclust)
-                    cluster_groups.append(set([iclust, jclust]))
-
-        # merge these pairs of clusters into groups
-        while True:
-            no_more_merges = True
-            for cp1, cp2 in itertools.combinations(cluster_groups, 2):
-                if len(cp1 & cp2) > 0:
+            for uid in partition[iclust]:
+                if uid not in first_clusters:
+                    first_clusters[uid] = iclust
+                    continue
+                iroot, jroot = find_root(first_clusters[uid]), find_root(iclust)
+                if iroot != jroot:
                     if debug:
-                        print '  merging %s and %s' % (cp1, cp2)
-                    cluster_groups.append(cp1 | cp2)
-                    cluster_groups.remove(cp1)
-                    cluster_groups.remove(cp2)
-                    no_more_merges = False
-                    break  # we've modified it now, so we have to go back and remake the iterator
-            if no_more_merges:
-                break
+                        print '  merging %d and %d (share %s)' % (iroot, jroot, uid)
+                    parents[max(iroot, jroot)] = min(iroot, jroot)  # keep the root as the lowest index, so the merged clusters come out in a reproducible order
+
+        cluster_groups = OrderedDict()  # root index : list of indices of the clusters in its group
+        for iclust in range(len(partition)):
+            iroot = find_root(iclust)
+            if iroot not in cluster_groups:
+                cluster_groups[iroot] = []
+            cluster_groups[iroot].append(iclust)
+        cluster_groups = [cgroup for cgroup in cluster_groups.values() if len(cgroup) > 1]
 
-        # actually merge the groups of clusters
+        # actually merge the groups of clusters (clusters that weren't merged stay where they were, and the merged ones go on the end)
         new_clusters = []
         for cgroup in cluster_groups:
-            new_clusters.append(list(set([uid for iclust in cgroup for uid in partition[iclust]])))
+            new_clusters.append(list(OrderedDict.fromkeys([uid for iclust in cgroup for uid in partition[iclust]])))  # remove duplicates, but keep the order
         if debug:
-            print ' removing'
-        for iclust in sorted([i for cgroup in cluster_groups for i in cgroup], reverse=True):
-            if debug:
-                print '    %d' % iclust
-            partition.pop(iclust)
-        for nclust in new_clusters:
-            partition.append(nclust)
+            print ' removing %s' % ' '.join(str(i) for cgroup in cluster_groups for i in cgroup)
+        merged_iclusts = set([i for cgroup in cluster_groups for i in cgroup])
+        partition[:] = [partition[iclust] for iclust in range(len(partition)) if iclust not in merged_iclusts] + new_clusters  # modify in place, since it's <cpath>'s partition
 
         if debug:
             cpath.print_partitions()
@@ -635,8 +775,12 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def init_cpath(self, n_procs):
-        initial_nseqs = len(self.sw_info['queries'])  # NOTE um, maybe I should change this to the number of clusters, now that we're doing some preclustering here?
-        initial_nsets = utils.collapse_naive_seqs(self.synth_sw_info(self.sw_info['queries']), split_by_cdr3=True, debug=True)
+        if self.previous_partition is None:
+            initial_nseqs = len(self.sw_info['queries'])  # NOTE um, maybe I should change this to the number of clusters, now that we're doing some preclustering here?
+            initial_nsets = utils.collapse_naive_seqs(self.synth_sw_info(self.sw_info['queries']), split_by_cdr3=True, debug=True)
+        else:
+            initial_nsets = self.get_incremental_initial_partition()
+            initial_nseqs = sum(len(c) for c in initial_nsets)
         cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
         cpath.add_partition(initial_nsets, logprob=0., n_procs=n_procs)  # NOTE sw info excludes failed sequences (and maybe also sequences with different cdr3 length)
         os.makedirs(self.cpath_progress_dir)
@@ -644,6 +788,39 @@ class PartitionDriver(object):
             cpath.print_partitions(abbreviate=self.args.abbreviate, reco_info=self.reco_info)
         return cpath, initial_nseqs
 
+    # ----------------------------------------------------------------------------------------
+    def get_incremental_initial_partition(self):  # with --previous-output: the new sequences (collapsed by naive seq) plus any previous clusters that they could merge with, while setting aside the rest of the previous clusters
+        sw_queries = set(self.sw_info['queries'])
+        new_queries = [q for q in self.sw_info['queries'] if q in self.new_uids]
+        previous_clusters = [[uid for uid in cluster if uid in sw_queries] for cluster in self.previous_partition]  # remove any that failed (or were removed as duplicates) in sw this time
+        previous_clusters = utils.split_clusters_by_cdr3([c for c in previous_clusters if len(c) > 0], self.sw_info, warn=True)
+
+        new_naive_seqs = {}  # new naive seqs for each (cdr3 length, naive seq length)
+        for uid, naive_seq in self.get_cached_hmm_naive_seqs(new_queries).items():
+            lkey = (self.sw_info[uid]['cdr3_length'], len(naive_seq))
+            if lkey not in new_naive_seqs:
+                new_naive_seqs[lkey] = set()
+            new_naive_seqs[lkey].add(naive_seq)
+        new_naive_seqs = {lkey : list(nseqs) for lkey, nseqs in new_naive_seqs.items()}
+
+        _, hfrac_hi = self.get_naive_hamming_bounds(parameter_dir=self.sub_param_dir)
+        def close_to_a_new_seq(cluster):  # bcrham never merges clusters whose naive seqs are farther apart than the upper bound, so if none of the cluster's sw naive seqs are within it of a new naive seq, we can leave the cluster out
+            for naive_seq in set(self.sw_info[uid]['naive_seq'] for uid in cluster):  # sw naive seqs are padded the same way as the hmm ones
+                lkey = (self.sw_info[cluster[0]]['cdr3_length'], len(naive_seq))
+                if lkey in new_naive_seqs and min(hammingutils.hamming_fractions(naive_seq, new_naive_seqs[lkey])) < hfrac_hi:
+                    return True
+            return False
+
+        candidate_clusters, self.set_aside_clusters = [], []
+        for cluster in previous_clusters:
+            if close_to_a_new_seq(cluster):
+                candidate_clusters.append(cluster)
+            else:
+                self.set_aside_clusters.append(cluster)
+        new_nsets = utils.collapse_naive_seqs(self.synth_sw_info(new_queries), split_by_cdr3=True, debug=True)
+        print '    --previous-output: clustering %d new sequences with %d / %d previous clusters (setting aside the other %d, which are too far from any new sequence)' % (len(new_queries), len(candidate_clusters), len(previous_clusters), len(self.set_aside_clusters))
+        return candidate_clusters + new_nsets
+
     # ----------------------------------------------------------------------------------------
     def merge_cpaths_from_previous_steps(self, final_cpath, debug=False):
         if debug:
@@ -692,19 +869,31 @@ class PartitionDriver(object):
     # ----------------------------------------------------------------------------------------
     def cluster_with_bcrham(self):
         tmpstart = time.time()
-        n_procs = self.args.n_procs
-        cpath, initial_nseqs = self.init_cpath(n_procs)
-        n_proc_list = []
-        self.istep = 0
+        if self.resume_state is None:
+            n_procs = self.args.n_procs
+            cpath, initial_nseqs = self.init_cpath(n_procs)
+            n_proc_list = []
+            self.istep = 0
+        else:
+            n_procs, n_proc_list, cpath, initial_nseqs = self.restore_clustering_checkpoint()
         start = time.time()
-        while n_procs > 0:
-            print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
-            cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # note that this annihilates the old <cpath>, which is a memory optimization (but we write all of them to the cpath progress dir)
-            n_proc_list.append(n_procs)
-            if self.are_we_finished_clustering(n_procs, cpath):
-                break
-            n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
-            self.istep += 1
+        if self.args.persistent_bcrham_workers and self.args.batch_system is None:  # glfo and hmm dir are the same for every step, so each bcrham only needs to read them once
+            self.bcrham_pool = BcrhamPool(self.args.workdir, debug='print' if self.args.debug else None)
+        try:
+            while n_procs > 0:
+                print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
+                cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # note that this annihilates the old <cpath>, which is a memory optimization (but we write all of them to the cpath progress dir)
+                n_proc_list.append(n_procs)
+                if self.are_we_finished_clustering(n_procs, cpath):
+                    break
+                n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
+                self.istep += 1
+                if self.args.resume:
+                    self.checkpoint_clustering(n_procs, n_proc_list, cpath, initial_nseqs)
+        finally:
+            if self.bcrham_pool is not None:
+                self.bcrham_pool.close()
+                self.bcrham_pool = None
 
         if self.args.max_cluster_size is not None:
             print '   --max-cluster-size (partitiondriver): merging shared clusters'
@@ -712,6 +901,10 @@ class PartitionDriver(object):
 
         cpath = self.merge_cpaths_from_previous_steps(cpath)
 
+        if self.set_aside_clusters is not None:  # add the previous clusters that we didn't need to rerun back into every partition
+            for ip in range(len(cpath.partitions)):
+                cpath.partitions[ip] = cpath.partitions[ip] + [list(c) for c in self.set_aside_clusters]
+
         print '      loop time: %.1f' % (time.time()-start)
         return cpath
 
@@ -788,13 +981,24 @@ class PartitionDriver(object):
             return
         action_cache = self.current_action  # hackey, but probably not worth trying (more) to improve
         self.current_action = 'annotate'
-        clusters_to_annotate = sorted(clusters_to_annotate, key=len, reverse=True)  # as opposed to in clusterpath, where we *don't* want to sort by size, it's nicer to have them sorted by size here, since then as you're scanning down a long list of cluster annotations you know once you get to the singletons you won't be missing something big
-        n_procs = min(self.args.n_procs, len(clusters_to_annotate))  # we want as many procs as possible, since the large clusters can take a long time (depending on if we're translating...), but in general we treat <self.args.n_procs> as the maximum allowable number of processes
-        print 'getting annotations for final partition%s' % extra_dbg_str
-        self.run_hmm('viterbi', self.sub_param_dir, n_procs=n_procs, partition=clusters_to_annotate, read_output=False)
-        if n_procs > 1:
-            self.merge_all_hmm_outputs(n_procs, precache_all_naive_seqs=False)
-        best_annotations, hmm_failures = self.read_annotation_output(self.hmm_outfname, count_parameters=self.args.count_parameters, parameter_out_dir=self.multi_hmm_param_dir if self.args.parameter_out_dir is None else self.args.parameter_out_dir)
+
+        previous_annotations = {}  # with --previous-output, reuse the annotations for any clusters that didn't change (unless we need all the sub cluster annotations)
+        if self.previous_annotations is not None and not self.args.calculate_alternative_naive_seqs:
+            cluster_strs = set(':'.join(c) for c in clusters_to_annotate)
+            previous_annotations = {uidstr : line for uidstr, line in self.previous_annotations.items() if uidstr in cluster_strs and all(line[r + '_gene'] in self.glfo['seqs'][r] for r in utils.regions)}
+            clusters_to_annotate = [c for c in clusters_to_annotate if ':'.join(c) not in previous_annotations]
+            print '    using %d unchanged cluster annotations from --previous-output' % len(previous_annotations)
+
+        best_annotations, hmm_failures = OrderedDict(), set()
+        if len(clusters_to_annotate) > 0:
+            clusters_to_annotate = sorted(clusters_to_annotate, key=len, reverse=True)  # as opposed to in clusterpath, where we *don't* want to sort by size, it's nicer to have them sorted by size here, since then as you're scanning down a long list of cluster annotations you know once you get to the singletons you won't be missing something big
+            n_procs = min(self.args.n_procs, len(clusters_to_annotate))  # we want as many procs as possible, since the large clusters can take a long time (depending on if we're translating...), but in general we treat <self.args.n_procs> as the maximum allowable number of processes
+            print 'getting annotations for final partition%s' % extra_dbg_str
+            self.run_hmm('viterbi', self.sub_param_dir, n_procs=n_procs, partition=clusters_to_annotate, read_output=False)
+            if n_procs > 1:
+                self.merge_all_hmm_outputs(n_procs, precache_all_naive_seqs=False)
+            best_annotations, hmm_failures = self.read_annotation_output(self.hmm_outfname, count_parameters=self.args.count_parameters, parameter_out_dir=self.multi_hmm_param_dir if self.args.parameter_out_dir is None else self.args.parameter_out_dir)
+        best_annotations.update(previous_annotations)
         if self.args.get_tree_metrics:
             self.calculate_tree_metrics(best_annotations, cpath=cpath)  # adds tree metrics to <annotations>
 
@@ -816,19 +1020,8 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def get_cached_hmm_naive_seqs(self, queries=None):
-        # would be nice to merge this with self.read_hmm_cachefile()
         expected_queries = self.sw_info['queries'] if queries is None else queries
-        cached_naive_seqs = {}
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                if ':' in line['unique_ids']:  # if it's a cache file left over from a previous partitioning, there'll be clusters in it, too
-                    continue
-                if line['unique_ids'] not in expected_queries:  # probably can only happen if self.args.persistent_cachefname is set
-                    continue
-                cached_naive_seqs[line['unique_ids']] = line['naive_seq']
-                if len(cached_naive_seqs) == len(expected_queries):  # already got everybody
-                    break
+        cached_naive_seqs = self.hmm_cache.naive_seqs(expected_queries)
 
         if set(cached_naive_seqs) != set(expected_queries):  # can happen if hmm can't find a path for a sequence for which sw *did* have an annotation (but in that case the annotation is almost certainly garbage)
             extra = set(cached_naive_seqs) - set(expected_queries)
@@ -929,7 +1122,7 @@ class PartitionDriver(object):
         cmd_str += ' --outfile ' + csv_outfname
         cmd_str += ' --locus ' + self.args.locus
         cmd_str += ' --random-seed ' + str(self.args.seed)
-        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (initial cache file is copied to each subdir)
+        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (each proc reads the main cache file, and writes to its own)
             cmd_str += ' --only-cache-new-vals'
 
         if self.args.dont_rescale_emissions:
@@ -1023,7 +1216,7 @@ class PartitionDriver(object):
         def get_cmd_str(iproc):  # all this does at this point is replace workdir with sub-workdir in hmm input, output, and cache file arguments
             strlist = cmd_str.split()
             for istr in range(len(strlist)):
-                if strlist[istr] == self.hmm_infname or strlist[istr] == self.hmm_cachefname or strlist[istr] == self.hmm_outfname:
+                if strlist[istr] == self.hmm_infname or strlist[istr] == self.hmm_outfname or (strlist[istr] == self.hmm_cachefname and strlist[istr - 1] == '--output-cachefname'):  # all the procs read the main cache file, but each writes its new values to its own file
                     strlist[istr] = strlist[istr].replace(self.args.workdir, self.subworkdir(iproc, n_procs))
             return ' '.join(strlist)
 
@@ -1037,7 +1230,10 @@ class PartitionDriver(object):
                    'outfname' : get_outfname(iproc),
                    'dbgfo' : self.bcrham_proc_info[iproc]}
                   for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
+        if self.bcrham_pool is not None:
+            self.bcrham_pool.run(cmdfos)
+        else:
+            utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
         self.print_partition_dbgfo()
 
         self.check_wait_times(time.time()-start)
@@ -1058,7 +1254,7 @@ class PartitionDriver(object):
             n_procs = self.args.n_procs
 
         self.prepare_for_hmm(algorithm, parameter_in_dir, partition, shuffle_input=shuffle_input)
-        glutils.write_glfo(self.my_gldir, self.glfo)
+        self.my_gldir = glutils.get_stored_gldir(self.glfo_storedir, self.glfo)  # only writes anything if the glfo changed since the last time
 
         cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=precache_all_naive_seqs, n_procs=n_procs)
 
@@ -1068,8 +1264,8 @@ class PartitionDriver(object):
         exec_start = time.time()
         self.execute(cmd_str, n_procs)
         exec_time = time.time() - exec_start
-
-        glutils.remove_glfo_files(self.my_gldir, self.args.locus)
+        if n_procs > 1:
+            self.calibrate_split_cost()
 
         cpath, annotations, hmm_failures = None, None, None
         if read_output:
@@ -1094,15 +1290,11 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def read_hmm_cachefile(self):
-        # would be nice to merge this with self.get_cached_hmm_naive_seqs()
         cachefo = {}
-        if not os.path.exists(self.hmm_cachefname):
-            return cachefo
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                utils.process_input_line(line)
-                cachefo[':'.join(line['unique_ids'])] = line
+        line_decoder = utils.get_line_decoder(['unique_ids'] + HmmCache.columns)
+        for line in self.hmm_cache.iterrows():
+            line_decoder(line)
+            cachefo[':'.join(line['unique_ids'])] = line
         return cachefo
 
     # ----------------------------------------------------------------------------------------
@@ -1256,6 +1448,50 @@ class PartitionDriver(object):
         assert len(self.sw_info[qry]['padlefts']) == 1
         return self.sw_info[qry]['padlefts'][0] * utils.ambiguous_bases[0] + self.reco_info[qry]['naive_seq'] + self.sw_info[qry]['padrights'][0] * utils.ambiguous_bases[0]
 
+    # ----------------------------------------------------------------------------------------
+    def split_cost_features(self, line):  # properties of a bcrham input line (i.e. cluster) that determine how long bcrham takes on it
+        return line['names'].count(':') + 1, len(line['seqs'].split(':')[0]), line['only_genes'].count(':') + 1  # n seqs, seq length, n genes
+
+    # ----------------------------------------------------------------------------------------
+    def estimate_split_cost(self, features):  # trellis size is proportional to seq length and number of genes, while the cluster size dependence is fit to previous steps
+        n_seqs, seq_len, n_genes = features
+        return n_seqs**self.split_cost_exponent * seq_len * n_genes
+
+    # ----------------------------------------------------------------------------------------
+    def assign_queries_to_procs(self, info, n_procs, debug=False):
+        """ Greedy longest-processing-time assignment of the lines in <info> to <n_procs> processes, so each process gets about the same estimated bcrham cost. Returns a list (over procs) of lists of indices in <info>. """
+        features = [self.split_cost_features(line) for line in info]
+        costs = [self.estimate_split_cost(f) for f in features]
+        iqueries_per_proc = [[] for _ in range(n_procs)]
+        proc_loads = [(0., iproc) for iproc in range(n_procs)]  # heap of (total cost, iproc)
+        for iquery in sorted(range(len(info)), key=lambda i: costs[i], reverse=True):  # sorted() is stable, so equal-cost lines (e.g. all the singletons) keep their shuffled order
+            load, iproc = heapq.heappop(proc_loads)
+            iqueries_per_proc[iproc].append(iquery)
+            heapq.heappush(proc_loads, (load + costs[iquery], iproc))
+        iqueries_per_proc = [sorted(iqlist) for iqlist in iqueries_per_proc]  # write each proc's lines in input order
+        self.split_proc_features = [[features[iq] for iq in iqlist] for iqlist in iqueries_per_proc]
+        if debug:
+            loads = [l for l, _ in proc_loads]
+            print '          estimated cost per proc: max/mean %.2f (exponent %.1f)' % (max(loads) / numpy.mean(loads) if sum(loads) > 0 else 1., self.split_cost_exponent)
+        return iqueries_per_proc
+
+    # ----------------------------------------------------------------------------------------
+    def calibrate_split_cost(self, min_time=1., debug=False):
+        """ Choose the cluster size exponent for the cost estimate that best matches the per-process bcrham times from the step that just finished. """
+        if self.split_proc_features is None or self.bcrham_proc_info is None or len(self.bcrham_proc_info) != len(self.split_proc_features):
+            return
+        times = [procinfo['time']['bcrham'] if 'time' in procinfo else None for procinfo in self.bcrham_proc_info]
+        iprocs = [iproc for iproc in range(len(times)) if times[iproc] is not None and times[iproc] > min_time and len(self.split_proc_features[iproc]) > 0]  # very short times are mostly overhead
+        if len(iprocs) < 3:
+            return
+        def log_ratio_spread(exponent):  # spread of the ratio between observed time and estimated cost (if the estimate were perfect, the ratio would be the same for all procs)
+            return numpy.std([math.log(times[iproc] / sum(n**exponent * l * g for n, l, g in self.split_proc_features[iproc])) for iproc in iprocs])
+        old_exponent = self.split_cost_exponent
+        self.split_cost_exponent = min([1., 1.5, 2., 2.5, 3.], key=log_ratio_spread)
+        self.split_proc_features = None
+        if debug or self.args.debug:
+            print '          split cost exponent: %.1f --> %.1f' % (old_exponent, self.split_cost_exponent)
+
     # ----------------------------------------------------------------------------------------
     def split_input(self, n_procs, infname):
 
@@ -1289,12 +1525,6 @@ class PartitionDriver(object):
             return open(self.subworkdir(siproc, n_procs) + '/' + os.path.basename(infname), mode)
         def get_writer(sub_outfile):
             return csv.DictWriter(sub_outfile, reader.fieldnames, delimiter=' ')
-        def copy_cache_files(n_procs):
-            cmdfos = [{'cmd_str' : 'cp ' + self.hmm_cachefname + ' ' + self.subworkdir(iproc, n_procs) + '/',
-                       'workdir' : self.subworkdir(iproc, n_procs),
-                       'outfname' : self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname)}
-                      for iproc in range(n_procs)]
-            utils.run_cmds(cmdfos)
 
         # initialize output/cache files
         for iproc in range(n_procs):
@@ -1302,9 +1532,8 @@ class PartitionDriver(object):
             sub_outfile = get_sub_outfile(iproc, 'w')
             get_writer(sub_outfile).writeheader()
             sub_outfile.close()  # can't leave 'em all open the whole time 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
-        if self.current_action == 'partition' and os.path.exists(self.hmm_cachefname):  # copy cachefile to this subdir (first clause is just for so when we're getting cluster annotations we don't copy over the cache files)
-            copy_cache_files(n_procs)
 
+        iqueries_per_proc = self.assign_queries_to_procs(info, n_procs, debug=self.args.debug)
         seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
         for iproc in range(n_procs):
             sub_outfile = get_sub_outfile(iproc, 'a')
@@ -1322,9 +1551,7 @@ class PartitionDriver(object):
                     writer.writerow(seeded_clusters[smallest_seed_cluster_str])
 
             # then loop over the non-seeded clusters
-            for iquery in range(len(info)):
-                if iquery % n_procs != iproc:
-                    continue
+            for iquery in iqueries_per_proc[iproc]:
                 writer.writerow(info[iquery])
             sub_outfile.close()
 
@@ -1338,69 +1565,93 @@ class PartitionDriver(object):
         self.merge_files(subfnames, fname, dereplicate=False)
 
     # ----------------------------------------------------------------------------------------
-    def merge_files(self, infnames, outfname, dereplicate):
+    def merge_files(self, infnames, outfname, dereplicate, dereplicate_key=None):
         """ 
-        Merge <infnames> into <outfname>.
-        NOTE that <outfname> is overwritten with the zero-length file if it exists, otherwise it is created.
+        Merge <infnames> into <outfname>, streaming the lines of each file (minus its header) onto the end of <outfname>.
+        NOTE that <outfname> is overwritten with the zero-length file if it exists and isn't in <infnames>, otherwise it is created (if it *is* in <infnames> we just append to it, and use its header).
         Some of <infnames> may not exist.
+        If <dereplicate> is set, skip rows that are already in <outfname> (or in an earlier input file), where rows are compared either in their entirety or, if <dereplicate_key> is set, by the value in that column (so the first row for each key wins).
         """
-        # check_call(['wc', ] + [fn for fn in infnames if fn != outfname])
-        # if os.path.exists(outfname):
-        #     check_call(['wc', outfname])
-        # else:
-        #     print '  outfname d.n.e.'
-
-        header = ''
-        outfile = None
-        one_real_file = False
-        if outfname not in infnames or not os.path.exists(outfname):  # if it *is* in <infnames> we assume we can just tack the other infnames onto the end of it and use <outfname>'s header
-            outfile = open(outfname, 'w')
-        for fname in infnames:
-            if not os.path.exists(fname) or os.stat(fname).st_size == 0:
-                continue
-            one_real_file = True
-            with open(fname) as headfile:
-                reader = csv.DictReader(headfile)
-                header = ','.join(reader.fieldnames)
-                if outfile is not None:
-                    writer = csv.DictWriter(outfile, reader.fieldnames)
-                    writer.writeheader()
-            break  # kinda weird to do it this way, but we just need one of the infiles to get the header info (and some may be zero length)
-        if outfile is not None:
-            outfile.close()
-        if not one_real_file:
-            print '    nothing to merge into %s' % outfname
-            return
-
-        assert header != ''
-
         non_out_infnames = [fn for fn in infnames if fn != outfname]
         if len(non_out_infnames) == 0:
             raise Exception('merge_files() called with <infnames> consisting only of <outfname>')
-        cmd = 'cat ' + ' '.join(non_out_infnames) + ' | grep -v \'' + header + '\''
-        cmd += ' >>' + outfname
-        try:
-            check_call(cmd, shell=True)
-        except CalledProcessError:
+        real_infnames = [fn for fn in non_out_infnames if os.path.exists(fn) and os.stat(fn).st_size > 0]
+
+        append = outfname in infnames and os.path.exists(outfname) and os.stat(outfname).st_size > 0
+        if not append and len(real_infnames) == 0:
+            open(outfname, 'w').close()
+        if len(real_infnames) == 0:
             print '    nothing to merge into %s' % outfname
-            # raise Exception('only read headers from %s', ' '.join([fn for fn in infnames if fn != outfname]))
+            self.remove_merged_files(non_out_infnames)
+            return
 
-        if dereplicate:
-            tmpfname = outfname + '.tmp'
-            check_call('echo ' + header + ' >' + tmpfname, shell=True)
-            check_call('grep -v \'' + header + '\' ' + outfname + ' | sort | uniq >>' + tmpfname, shell=True)  # NOTE there can be multiple lines with the same uid string, but this is ok -- the c++ handles it
-            check_call(['mv', tmpfname, outfname])
+        def get_key_index(header):  # index of the <dereplicate_key> column (or None, if we're comparing entire rows)
+            if dereplicate_key is None:
+                return None
+            columns = next(csv.reader([header]))
+            if dereplicate_key not in columns:
+                raise Exception('dereplicate key \'%s\' not among columns in header of %s: %s' % (dereplicate_key, outfname, ' '.join(columns)))
+            return columns.index(dereplicate_key)
+        def rowkey(line):  # NOTE only called if we're dereplicating
+            keystr = line if ikey is None else next(csv.reader([line]))[ikey]
+            return hashlib.md5(keystr).digest()  # don't want to keep every entire row (or key, which can be a lot of uids) in memory
+
+        header, ikey = None, None
+        seen_keys = set()
+        if append:
+            with open(outfname) as outfile:
+                header = outfile.readline()
+                if dereplicate:
+                    ikey = get_key_index(header)
+                    for line in outfile:
+                        seen_keys.add(rowkey(line))
+
+        n_rows, n_bytes, n_duplicates = 0, 0, 0
+        with open(outfname, 'a' if append else 'w') as outfile:
+            for fname in real_infnames:
+                with open(fname) as infile:
+                    this_header = infile.readline()
+                    if header is None:
+                        header = this_header
+                        outfile.write(header)
+                        if dereplicate:
+                            ikey = get_key_index(header)
+                    elif this_header != header:
+                        raise Exception('inconsistent headers when merging %s into %s:\n    %s    %s' % (fname, outfname, this_header, header))
+                    for line in infile:
+                        if line[-1] != '\n':  # last line in file with no trailing newline
+                            line += '\n'
+                        if dereplicate:
+                            key = rowkey(line)
+                            if key in seen_keys:
+                                n_duplicates += 1
+                                continue
+                            seen_keys.add(key)
+                        outfile.write(line)
+                        n_rows += 1
+                        n_bytes += len(line)
+
+        print '        merged %d rows (%.1f MB) from %d file%s into %s%s' % (n_rows, n_bytes / 1.e6, len(real_infnames), utils.plural(len(real_infnames)), os.path.basename(outfname), (' (skipped %d duplicates)' % n_duplicates) if dereplicate else '')
+        self.remove_merged_files(non_out_infnames)
 
-        for infname in infnames:
-            if infname != outfname:
-                os.remove(infname)
+    # ----------------------------------------------------------------------------------------
+    def remove_merged_files(self, fnames):
+        for fname in fnames:
+            if os.path.exists(fname):
+                os.remove(fname)
 
     # ----------------------------------------------------------------------------------------
     def merge_all_hmm_outputs(self, n_procs, precache_all_naive_seqs):
         """ Merge any/all output files from subsidiary bcrham processes """
         cpath = None  # it would be nice to figure out a cleaner way to do this
         if self.current_action == 'partition':  # merge partitions from several files
-            if n_procs > 1:
+            if n_procs == 1:  # bcrham rewrote the whole cache file
+                self.hmm_cache.add_csv(self.hmm_cachefname)
+            else:
+                for iproc in range(n_procs):
+                    sub_cachefname = self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname)
+                    if os.path.exists(sub_cachefname):
+                        self.hmm_cache.add_csv(sub_cachefname)
                 self.merge_subprocess_files(self.hmm_cachefname, n_procs, include_outfile=True)  # sub cache files only have new info
 
             if not precache_all_naive_seqs:
@@ -1542,6 +1793,7 @@ class PartitionDriver(object):
                     'unique_ids' : ':'.join([qn for qn in query_name_list]),
                     'naive_seq' : self.get_padded_true_naive_seq(query_name_list[0])  # NOTE just using the first one... but a.t.m. I think I'll only run this fcn the first time through when they're all singletons, anyway
                 })
+        self.hmm_cache.add_csv(self.hmm_cachefname)
 
     # ----------------------------------------------------------------------------------------
     def write_to_single_input_file(self, fname, nsets, parameter_dir, shuffle_input=False):
@@ -1754,9 +2006,10 @@ class PartitionDriver(object):
         errorfo = {}
         with open(annotation_fname, 'r') as hmm_csv_outfile:
             reader = csv.DictReader(hmm_csv_outfile)
+            line_decoder = utils.get_line_decoder(reader.fieldnames)
             for padded_line in reader:  # line coming from hmm output is N-padded such that all the seqs are the same length
 
-                utils.process_input_line(padded_line)
+                line_decoder(padded_line)
                 n_lines_read += 1
 
                 failed = self.check_did_bcrham_fail(padded_line, errorfo)
@@ -1952,7 +2205,7 @@ class PartitionDriver(object):
                 cpath.write(self.args.outfname, self.args.is_data, partition_lines=partition_lines)  # don't need to pass in reco_info/true_partition since we passed them when we got the partition lines
             annotation_fname = self.args.outfname if cpath is None else self.args.cluster_annotation_fname
             utils.write_annotations(annotation_fname, self.glfo, annotation_list, headers, failed_queries=failed_queries)
-        elif utils.getsuffix(self.args.outfname) == '.yaml':
+        elif utils.getsuffix(self.args.outfname) in ['.yaml', '.db']:
             utils.write_annotations(self.args.outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=self.args.write_full_yaml_output)
         else:
             raise Exception('unhandled annotation file suffix %s' % self.args.outfname)
@@ -0,0 +1,187 @@
+import math
+import numpy
+import scipy.sparse
+import scipy.special
+
+import utils
+
+# partition accuracy/similarity metrics computed from sparse contingency matrices (i.e. the matrix of overlaps between the clusters in two partitions), so they're all roughly linear in the number of sequences
+# NOTE the partition conventions are the same as in the rest of partis: a partition is a list of clusters, each of which is a list of uids, and a uid can (e.g. with seed_unique_id) occasionally appear more than once
+
+# ----------------------------------------------------------------------------------------
+def encode_partition(partition, uid_codes=None):
+    """
+    Return integer arrays with one entry for each uid entry in <partition>: the uid's code and the index of its cluster.
+    Uids are added to <uid_codes> (a dict of {uid : code}) if they're not already there.
+    """
+    if uid_codes is None:
+        uid_codes = {}
+    ucodes = numpy.zeros(sum(len(c) for c in partition), dtype=numpy.int64)
+    iclusts = numpy.repeat(numpy.arange(len(partition), dtype=numpy.int64), [len(c) for c in partition])
+    ientry = 0
+    for cluster in partition:
+        for uid in cluster:
+            if uid not in uid_codes:
+                uid_codes[uid] = len(uid_codes)
+            ucodes[ientry] = uid_codes[uid]
+            ientry += 1
+    return ucodes, iclusts
+
+# ----------------------------------------------------------------------------------------
+def get_memberships(ucodes, iclusts, n_uids):
+    """
+    Return the distinct (uid code, cluster index) pairs in a partition encoded by encode_partition() (sorted by uid code, then cluster index), and for each uid code, the number of clusters it appears in and the index of its first pair.
+    I.e. the vectorized version of utils.get_cluster_ids().
+    """
+    n_clusters = iclusts.max() + 1 if len(iclusts) > 0 else 1
+    pairs = numpy.unique(ucodes * n_clusters + iclusts)
+    mem_ucodes, mem_iclusts = pairs // n_clusters, pairs % n_clusters
+    n_clusts_per_uid = numpy.bincount(mem_ucodes, minlength=n_uids)
+    first_pair = numpy.concatenate([[0], numpy.cumsum(n_clusts_per_uid)[:-1]])
+    return mem_ucodes, mem_iclusts, n_clusts_per_uid, first_pair
+
+# ----------------------------------------------------------------------------------------
+def contingency_matrix(rows, cols, shape=None):  # sparse matrix whose ij^th entry is the number of (row, col) pairs equal to (i, j)
+    return scipy.sparse.coo_matrix((numpy.ones(len(rows), dtype=numpy.int64), (rows, cols)), shape=shape).tocsr()  # conversion to csr sums the duplicate entries
+
+# ----------------------------------------------------------------------------------------
+def lookup(smatrix, rows, cols):  # entries of sparse matrix <smatrix> at (<rows>[i], <cols>[i]) for each i, as a flat array
+    if len(rows) == 0:
+        return numpy.zeros(0)
+    return numpy.asarray(smatrix[rows, cols]).ravel()
+
+# ----------------------------------------------------------------------------------------
+def ccfs(partition, true_partition, reco_info, seed_unique_id=None, debug=False):
+    """
+    Contingency matrix version of utils.new_ccfs_that_need_better_names() (see that fcn for the calling conventions), with the same results (apart from floating point summation order).
+    Purity uses the overlaps between the inferred clusters and reco ids, while completeness uses the overlaps between the true and inferred clusters.
+    """
+    uid_codes = {}
+    p_ucodes, p_iclusts = encode_partition(partition, uid_codes=uid_codes)
+    n_part_uids = len(uid_codes)
+    t_ucodes, t_iclusts = encode_partition(true_partition, uid_codes=uid_codes)  # any uids that are only in <true_partition> get codes >= n_part_uids
+    n_uids = len(uid_codes)
+
+    mem_ucodes, mem_iclusts, n_clusts_per_uid, first_pair = get_memberships(p_ucodes, p_iclusts, n_uids)
+    first_iclust = numpy.full(n_uids, -1, dtype=numpy.int64)  # index of the first inferred cluster in which each uid appears (-1 if it's not in <partition>)
+    in_partition = n_clusts_per_uid > 0
+    first_iclust[in_partition] = mem_iclusts[first_pair[in_partition]]
+
+    if seed_unique_id is None:
+        ieval = numpy.arange(len(t_ucodes))  # indices of the true partition entries whose uids we average over
+    else:
+        ieval = numpy.flatnonzero(t_ucodes == uid_codes[seed_unique_id]) if seed_unique_id in uid_codes else numpy.zeros(0, dtype=numpy.int64)
+    eval_ucodes = t_ucodes[ieval]
+    if (eval_ucodes >= n_part_uids).any():
+        missing_uid = [u for u, c in uid_codes.items() if c == eval_ucodes[eval_ucodes >= n_part_uids][0]][0]
+        raise KeyError(missing_uid)  # same thing the loop version would raise
+    multi_ucodes = eval_ucodes[n_clusts_per_uid[eval_ucodes] != 1]
+    if len(multi_ucodes) > 0:  # see note in utils.new_ccfs_that_need_better_names()
+        if debug:
+            multi_uid = [u for u, c in uid_codes.items() if c == multi_ucodes[0]][0]
+            print '  %s found %s in multiple clusters while calculating ccfs (returning None, None)' % (utils.color('red', 'warning'), multi_uid)
+        return None, None
+    eval_iclusts = first_iclust[eval_ucodes]  # inferred cluster that we use for each evaluated uid
+
+    # purity: for each evaluated uid, fraction of its inferred cluster with the same reco id
+    reco_id_codes = {}
+    uid_reco_codes = numpy.zeros(n_part_uids, dtype=numpy.int64)
+    for uid, ucode in uid_codes.items():
+        if ucode < n_part_uids:
+            uid_reco_codes[ucode] = reco_id_codes.setdefault(reco_info[uid]['reco_id'], len(reco_id_codes))
+    reco_contingency = contingency_matrix(p_iclusts, uid_reco_codes[p_ucodes], shape=(len(partition), max(1, len(reco_id_codes))))
+    inferred_sizes = numpy.array([len(c) for c in partition], dtype=float)
+    clonal_fractions = lookup(reco_contingency, eval_iclusts, uid_reco_codes[eval_ucodes]) / inferred_sizes[eval_iclusts]
+
+    # completeness: for each evaluated uid, fraction of its true cluster that's in its inferred cluster (a true cluster entry counts toward each inferred cluster in which its uid appears)
+    t_n_clusts, t_first_pair = numpy.zeros(len(t_ucodes), dtype=numpy.int64), numpy.zeros(len(t_ucodes), dtype=numpy.int64)  # number of inferred clusters for each true entry's uid, and index of its first membership pair (both zero for uids that aren't in <partition>)
+    t_in_partition = t_ucodes < n_part_uids
+    t_n_clusts[t_in_partition] = n_clusts_per_uid[t_ucodes[t_in_partition]]
+    t_first_pair[t_in_partition] = first_pair[t_ucodes[t_in_partition]]
+    rows = numpy.repeat(t_iclusts, t_n_clusts)  # expand each true entry into one entry for each inferred cluster its uid is in
+    offsets = numpy.arange(len(rows)) - numpy.repeat(numpy.cumsum(t_n_clusts) - t_n_clusts, t_n_clusts)  # index of each expanded entry within its true entry's memberships
+    cols = mem_iclusts[numpy.repeat(t_first_pair, t_n_clusts) + offsets]
+    true_contingency = contingency_matrix(rows, cols, shape=(len(true_partition), len(partition)))
+    true_sizes = numpy.array([len(c) for c in true_partition], dtype=float)
+    fractions_present = lookup(true_contingency, t_iclusts[ieval], eval_iclusts) / true_sizes[t_iclusts[ieval]]
+
+    n_eval = len(ieval)
+    return float(clonal_fractions.sum()) / n_eval, float(fractions_present.sum()) / n_eval  # numpy does pairwise summation, so (unlike the old loop version) we don't need to worry about precision for large numbers of uids
+
+# ----------------------------------------------------------------------------------------
+def get_labels(partition_a, partition_b):
+    """
+    Return the cluster labels in <partition_a> and <partition_b> for each uid entry in <partition_a> (a uid's label in <partition_b> is its first cluster there).
+    Raises an exception if the partitions don't have the same uids.
+    """
+    uid_codes = {}
+    a_ucodes, a_iclusts = encode_partition(partition_a, uid_codes=uid_codes)
+    n_a_uids = len(uid_codes)
+    b_ucodes, b_iclusts = encode_partition(partition_b, uid_codes=uid_codes)
+    if len(uid_codes) > n_a_uids:
+        raise Exception('partition b has uids that aren\'t in partition a: %s' % ' '.join(u for u, c in uid_codes.items() if c >= n_a_uids))
+    _, mem_iclusts, n_clusts_per_uid, first_pair = get_memberships(b_ucodes, b_iclusts, n_a_uids)
+    if (n_clusts_per_uid == 0).any():
+        raise Exception('partition a has uids that aren\'t in partition b: %s' % ' '.join(u for u, c in uid_codes.items() if n_clusts_per_uid[c] == 0))
+    return a_iclusts, mem_iclusts[first_pair[a_ucodes]]
+
+# ----------------------------------------------------------------------------------------
+def expected_mutual_information(a_sizes, b_sizes, n_total):
+    """
+    Expected mutual information between random partitions with the given cluster sizes (i.e. with contingency matrix row sums <a_sizes> and column sums <b_sizes>, under the hypergeometric model).
+    Each term only depends on the pair of cluster sizes, so we loop over the distinct sizes (of which there are at most sqrt(2 * <n_total>) for each partition) rather than over the pairs of clusters.
+    """
+    a_vals, a_counts = numpy.unique(a_sizes, return_counts=True)
+    b_vals, b_counts = numpy.unique(b_sizes, return_counts=True)
+    gln_n = scipy.special.gammaln(n_total + 1)
+    emi = 0.
+    for a_val, a_count in zip(a_vals, a_counts):
+        for b_val, b_count in zip(b_vals, b_counts):
+            nijs = numpy.arange(max(1, a_val + b_val - n_total), min(a_val, b_val) + 1, dtype=float)
+            if len(nijs) == 0:
+                continue
+            log_probs = (scipy.special.gammaln(a_val + 1) + scipy.special.gammaln(b_val + 1) + scipy.special.gammaln(n_total - a_val + 1) + scipy.special.gammaln(n_total - b_val + 1) - gln_n
+                         - scipy.special.gammaln(nijs + 1) - scipy.special.gammaln(a_val - nijs + 1) - scipy.special.gammaln(b_val - nijs + 1) - scipy.special.gammaln(n_total - a_val - b_val + nijs + 1))
+            terms = nijs / n_total * (numpy.log(n_total * nijs) - math.log(a_val * b_val)) * numpy.exp(log_probs)
+            emi += a_count * b_count * terms.sum()
+    return emi
+
+# ----------------------------------------------------------------------------------------
+def entropy(sizes, n_total):
+    probs = sizes[sizes > 0] / float(n_total)
+    return -float((probs * numpy.log(probs)).sum())
+
+# ----------------------------------------------------------------------------------------
+def adjusted_mutual_information(partition_a, partition_b):
+    """ Adjusted mutual information (with the arithmetic mean normalization, like sklearn.metrics.adjusted_mutual_info_score()) between <partition_a> and <partition_b> from their contingency matrix. """
+    a_labels, b_labels = get_labels(partition_a, partition_b)
+    contingency = contingency_matrix(a_labels, b_labels).tocoo()
+    a_sizes = numpy.asarray(contingency.sum(axis=1)).ravel()
+    b_sizes = numpy.asarray(contingency.sum(axis=0)).ravel()
+    a_sizes, b_sizes = a_sizes[a_sizes > 0], b_sizes[b_sizes > 0]  # empty clusters don't count
+    if len(a_sizes) == len(b_sizes) and len(a_sizes) in [0, 1]:  # both partitions have only one cluster (or no uids): they're identical, but the formula is undefined
+        return 1.
+    n_total = float(len(a_labels))
+    nijs = contingency.data.astype(float)
+    mutual_info = float((nijs / n_total * (numpy.log(nijs) + math.log(n_total) - numpy.log(a_sizes[contingency.row]) - numpy.log(b_sizes[contingency.col]))).sum())  # ok to index with row/col, since all rows and columns that have entries are nonzero
+    emi = expected_mutual_information(a_sizes, b_sizes, n_total)
+    denominator = 0.5 * (entropy(a_sizes, n_total) + entropy(b_sizes, n_total)) - emi
+    eps = numpy.finfo('float64').eps
+    denominator = min(denominator, -eps) if denominator < 0 else max(denominator, eps)
+    return (mutual_info - emi) / denominator
+
+# ----------------------------------------------------------------------------------------
+def intersection_sizes(a_clusters, b_clusters):
+    """ Return (dense) matrix whose ij^th entry is the number of uid entries in the i^th cluster in <a_clusters> that are also in the j^th cluster in <b_clusters> (i.e. the contingency matrix restricted to these clusters). """
+    b_cluster_indices = {}  # map from uid to indices of the clusters in <b_clusters> that contain it (almost always only one)
+    for jclust, cluster in enumerate(b_clusters):
+        for uid in cluster:
+            if jclust not in b_cluster_indices.setdefault(uid, []):
+                b_cluster_indices[uid].append(jclust)
+    rows, cols = [], []
+    for iclust, cluster in enumerate(a_clusters):
+        for uid in cluster:
+            for jclust in b_cluster_indices.get(uid, []):
+                rows.append(iclust)
+                cols.append(jclust)
+    return contingency_matrix(numpy.array(rows, dtype=numpy.int64), numpy.array(cols, dtype=numpy.int64), shape=(len(a_clusters), len(b_clusters))).toarray()
@@ -87,6 +87,14 @@ def process(args):
     if args.istartstop is not None:
         if args.istartstop[0] >= args.istartstop[1] or args.istartstop[0] < 0:
             raise Exception('invalid --istartstop specification: %d %d' % (args.istartstop[0], args.istartstop[1]))
+    if args.chunk_size is not None:
+        if args.chunk_size <= 0:
+            raise Exception('--chunk-size must be positive (got %d)' % args.chunk_size)
+        incompatible_args = [a for a in ['istartstop', 'n_random_queries', 'queries', 'reco_ids', 'seed_unique_id', 'queries_to_include_fname', 'presto_output', 'write_full_yaml_output', 'linearham', 'plotdir', 'abbreviate'] if args.__dict__[a] not in [None, False]]  # these either select sequences from the whole file (so won't work on a chunk at a time), write output that we don't know how to append chunk by chunk, or (--abbreviate) would reuse the same names in each chunk
+        if args.n_max_queries > 0:
+            incompatible_args.append('n_max_queries')
+        if len(incompatible_args) > 0:
+            raise Exception('--chunk-size can\'t be used with %s' % ' '.join('--' + a.replace('_', '-') for a in incompatible_args))
     args.n_max_per_region = utils.get_arg_list(args.n_max_per_region, intify=True)
     if len(args.n_max_per_region) != 3:
         raise Exception('n-max-per-region should be of the form \'x:y:z\', but I got ' + str(args.n_max_per_region))
@@ -182,10 +190,17 @@ def process(args):
         args.mutation_multiplier = 0.
 
     if args.workdir is None:  # set default here so we know whether it was set by hand or not
+        if args.resume:
+            raise Exception('--workdir has to be set with --resume (so that it\'s the same for each run)')
         args.workdir = get_workdir(args.batch_system)
     else:
         args.workdir = args.workdir.rstrip('/')
-    if os.path.exists(args.workdir):
+    if args.previous_output is not None:
+        if args.resume:
+            raise Exception('can\'t set both --previous-output and --resume')
+        if args.naive_vsearch or args.naive_swarm or args.seed_unique_id is not None:
+            raise Exception('--previous-output is only implemented for the default (non-seeded) clustering method')
+    if os.path.exists(args.workdir) and not args.resume:  # with --resume, partitiondriver checks that it's from a previous --resume run
         raise Exception('workdir %s already exists' % args.workdir)
 
     if args.batch_system == 'sge' and args.batch_options is not None:
@@ -193,12 +208,14 @@ def process(args):
             print '%s --batch-options contains \'-e\' or \'-o\', but we add these automatically since we need to be able to parse each job\'s stdout and stderr. You can control the directory under which they\'re written with --workdir (which is currently %s).' % (utils.color('red', 'warning'), args.workdir)
 
     if args.outfname is not None and not args.presto_output:
-        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml']:
+        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml', '.db']:
             raise Exception('unhandled --outfname suffix %s' % utils.getsuffix(args.outfname))
-        if utils.getsuffix(args.outfname) != '.yaml':
+        if utils.getsuffix(args.outfname) == '.csv':
             print '  %s --outfname uses deprecated file format %s. This will still work fine, but the new default .yaml format is much cleaner, and includes annotations, partitions, and germline info in the same file.' % (utils.color('yellow', 'note:'), utils.getsuffix(args.outfname))
-        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) == '.yaml':
-            raise Exception('have to use \'view-output\' action to view .yaml output files')
+        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) in ['.yaml', '.db']:
+            raise Exception('have to use \'view-output\' action to view %s output files' % utils.getsuffix(args.outfname))
+        if args.chunk_size is not None and utils.getsuffix(args.outfname) == '.db':
+            raise Exception('--chunk-size can\'t (yet) append to .db output files')
 
     if args.presto_output:
         if args.outfname is None:
@@ -0,0 +1,68 @@
+# ----------------------------------------------------------------------------------------
+class SeqContainmentIndex(object):
+    """
+    Index of a growing list of sequences, for quickly finding one that's equal to, contains, or is contained in a query sequence (without comparing the query to every sequence in the index).
+    We index each sequence by a sample of its k-mers: the ones whose hash is divisible by <sample_mod>.
+    Since this only depends on the k-mer, if one sequence is a substring of another, all of the shorter sequence's sampled k-mers are also sampled k-mers of the longer one. So:
+      - an indexed sequence containing the query has to contain every one of the query's sampled k-mers, so we only need to check the ones that contain its rarest sampled k-mer
+      - an indexed sequence contained in the query has all of its sampled k-mers in the query, so we index each sequence under its (at the time it was added) rarest sampled k-mer as an 'anchor', and only check the ones whose anchor is among the query's sampled k-mers
+    Sequences that are too short to have any sampled k-mers (very rare for realistic lengths) go in a list that we check one by one.
+    """
+    kmer_length = 20
+    sample_mod = 8
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self):
+        self.seqs = []  # indexed sequences (the index in this list is the sequence's id)
+        self.seq_ids = {}  # map from each sequence to its id (for exact matches)
+        self.kmer_ids = {}  # map from each sampled k-mer to the ids of the sequences that contain it
+        self.anchor_ids = {}  # map from sampled k-mer to the ids of the sequences for which it's the anchor
+        self.unsampled_ids = []  # ids of sequences without any sampled k-mers
+        self.last_kmers = None  # (seq, sampled k-mers) for the last seq we calculated them for
+
+    # ----------------------------------------------------------------------------------------
+    def sampled_kmers(self, seq):
+        if self.last_kmers is not None and self.last_kmers[0] == seq:  # we usually add a seq right after failing to find it, so this saves recalculating them
+            return self.last_kmers[1]
+        kmers = set([km for km in [seq[i : i + self.kmer_length] for i in xrange(len(seq) - self.kmer_length + 1)] if hash(km) % self.sample_mod == 0])
+        self.last_kmers = (seq, kmers)
+        return kmers
+
+    # ----------------------------------------------------------------------------------------
+    def add(self, seq):  # add <seq> to the index, returning its id
+        if seq in self.seq_ids:
+            return self.seq_ids[seq]
+        seq_id = len(self.seqs)
+        self.seqs.append(seq)
+        self.seq_ids[seq] = seq_id
+        kmers = self.sampled_kmers(seq)
+        if len(kmers) == 0:
+            self.unsampled_ids.append(seq_id)
+            return seq_id
+        anchor = min(kmers, key=lambda km: (len(self.kmer_ids.get(km, [])), km))  # rarest k-mer, breaking ties alphabetically so it doesn't depend on set ordering
+        self.anchor_ids.setdefault(anchor, []).append(seq_id)
+        for km in kmers:
+            self.kmer_ids.setdefault(km, []).append(seq_id)
+        return seq_id
+
+    # ----------------------------------------------------------------------------------------
+    def find(self, seq):
+        """ Return the id of an indexed sequence that's equal to <seq>, contains it, or is contained in it (if there's several, the first one added), or None if there isn't one. """
+        if seq in self.seq_ids:
+            return self.seq_ids[seq]
+
+        def contains_or_contained(seq_id):
+            iseq = self.seqs[seq_id]
+            return seq in iseq or iseq in seq
+
+        matches = [sid for sid in self.unsampled_ids if contains_or_contained(sid)]  # have to check these one by one
+        kmers = self.sampled_kmers(seq)
+        if len(kmers) == 0:  # have to check everybody for containing <seq> (whereas any indexed sequence contained in <seq> will be in <self.unsampled_ids>)
+            matches += [sid for sid in range(len(self.seqs)) if seq in self.seqs[sid]]
+        else:
+            postings = [self.kmer_ids.get(km, []) for km in kmers]
+            candidates = min(postings, key=len)  # sequences that contain <seq> have to be in all of these, so we only need to check the shortest one
+            matches += [sid for sid in candidates if seq in self.seqs[sid]]
+            candidates = set(sid for km in kmers for sid in self.anchor_ids.get(km, []))
+            matches += [sid for sid in candidates if self.seqs[sid] in seq]
+        return min(matches) if len(matches) > 0 else None
@@ -1,4 +1,5 @@
 import numpy
+import itertools
 import bz2
 import gzip
 import copy
@@ -134,22 +135,51 @@ def get_seqfile_info(x, is_data=False):
     raise Exception('renamed and changed returned vals (see below)')
 
 # ----------------------------------------------------------------------------------------
-def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=None, quiet=False, more_input_info=None):
-    # NOTE renamed this from get_seqfile_info() since I'm changing the return values, but I don't want to update the calls everywhere (e.g. in compareutils)
+def iter_csv_files(fnames, delimiter):  # yield the lines from each (maybe compressed) csv/tsv file in turn (each file has its own header)
+    for fname in fnames:
+        with utils.open_input_file(fname) as seqfile:
+            for line in csv.DictReader(seqfile, delimiter=delimiter):
+                yield line
+
+# ----------------------------------------------------------------------------------------
+def open_sequence_file(infname, n_max_queries=-1, args=None):  # return the suffix of <infname>, its germline info (None unless it's a .yaml file), and an iterator over its lines
+    # NOTE <infname> can be gzipped or bzipped (.gz or .bz2), and/or a glob pattern matching several files (e.g. 'shards/*.fa.gz'), which are read one after another (in sorted order) as if they were one file
     yaml_glfo = None
-    suffix = utils.getsuffix(infname)
+    infnames = utils.get_input_fnames(infname)
+    suffix = utils.get_input_suffix(infnames)
     if suffix in delimit_info:
-        seqfile = open(infname)  # closes on function exit. no, this isn't the best way to do this
-        reader = csv.DictReader(seqfile, delimiter=delimit_info[suffix])
-    elif suffix in ['.fa', '.fasta', '.fastx']:
-        reader = utils.read_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=False, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
+        reader = iter_csv_files(infnames, delimit_info[suffix])
+    elif suffix in ['.fa', '.fasta', '.fastx', '.fq', '.fastq']:
+        reader = utils.iter_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=False, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below (and use the iterator version so we don't read the whole file into memory, e.g. for --chunk-size)
                                   queries=(args.queries if (args is not None and not args.abbreviate) else None))  # NOTE also can't filter on args.queries here if we're also translating
     elif suffix == '.yaml':
-        yaml_glfo, reader, _ = utils.read_yaml_output(infname, n_max_queries=n_max_queries, synth_single_seqs=True, dont_add_implicit_info=True)  # not really sure that long term I want to synthesize single seq lines, but for backwards compatibility it's nice a.t.m.
-        if not is_data:
-            simglfo = yaml_glfo  # doesn't replace the contents, of course, which is why we return it
+        if infnames != [infname] or utils.getsuffix(infname) in utils.compressed_suffixes:
+            raise Exception('compressed and multi-file input isn\'t supported for .yaml files (got %s)' % infname)
+        yaml_glfo, reader, _ = utils.read_yaml_output(infname, n_max_queries=n_max_queries, synth_single_seqs=True, dont_add_implicit_info=True, stream_annotations=True)  # not really sure that long term I want to synthesize single seq lines, but for backwards compatibility it's nice a.t.m.
     else:
         raise Exception('unhandled file extension %s' % suffix)
+    return suffix, yaml_glfo, reader
+
+# ----------------------------------------------------------------------------------------
+def init_chunkfo(infname, args):  # info for reading <infname> --chunk-size lines at a time with repeated calls to read_sequence_file(), so we only open (and parse) the file once
+    suffix, yaml_glfo, reader = open_sequence_file(infname, args=args)
+    return {'suffix' : suffix, 'yaml_glfo' : yaml_glfo, 'reader' : reader,
+            'n_lines' : 0,  # number of lines we've read so far
+            'iname' : None,  # next line number to use as sequence id, if there isn't a name column
+            'previous_uids' : set(),  # uids from previous chunks (so we don't reuse them when renaming duplicates)
+            'finished' : False}  # set once we've read the whole file
+
+# ----------------------------------------------------------------------------------------
+def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=None, quiet=False, more_input_info=None, chunkfo=None):
+    # NOTE renamed this from get_seqfile_info() since I'm changing the return values, but I don't want to update the calls everywhere (e.g. in compareutils)
+    # NOTE if <chunkfo> is set (see init_chunkfo()), we read the next --chunk-size lines from the already-open file, rather than opening <infname> and reading the whole thing
+    if chunkfo is None:
+        suffix, yaml_glfo, reader = open_sequence_file(infname, n_max_queries=n_max_queries, args=args)
+    else:
+        suffix, yaml_glfo = chunkfo['suffix'], chunkfo['yaml_glfo']
+        reader = itertools.islice(chunkfo['reader'], args.chunk_size)  # NOTE islice() stops after <chunk_size> lines without pulling the next one, so the next chunk starts where this one stopped
+    if yaml_glfo is not None and not is_data:
+        simglfo = yaml_glfo  # doesn't replace the contents, of course, which is why we return it
 
     input_info = OrderedDict()
     reco_info = None
@@ -159,8 +189,11 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
     n_queries_added = 0
     found_seed = False
     potential_names, used_names = None, None  # for abbreviating
-    iname = None  # line number -- used as sequence id if there isn't a name column in the file
+    iname = None if chunkfo is None else chunkfo['iname']  # line number -- used as sequence id if there isn't a name column in the file
     iline = -1
+    line_decoder, decoder_keys = None, None  # built from the first line's keys (after any renaming), and the keys it was built from
+    def already_read(tuid):  # NOTE with --chunk-size, also checks previous chunks
+        return tuid in input_info or (chunkfo is not None and tuid in chunkfo['previous_uids'])
     for line in reader:
         iline += 1
         if args is not None:
@@ -176,23 +209,26 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
                 line['input_seqs'] = line[args.seq_column]
                 if args.seq_column != 'seqs':  # stupid god damn weird backwards compatibility edge case bullshit
                     del line[args.seq_column]
-        if iname is None and 'unique_ids' not in line and 'unique_id' not in line:
-            print '  %s: couldn\'t find a name (unique id) column, so using line number as the sequence label (you can set the name column with --name-column)' % (utils.color('yellow', 'warning'))
-            iname = 0
-        if iname is not None:
+        if 'unique_ids' not in line and 'unique_id' not in line:  # NOTE checked for each line, since lines from different csv files (with a glob <infname>) can have different headers
+            if iname is None:
+                print '  %s: couldn\'t find a name (unique id) column, so using line number as the sequence label (you can set the name column with --name-column)' % (utils.color('yellow', 'warning'))
+                iname = 0
             line['unique_ids'] = '%09d' % iname
             iname += 1
         if 'input_seqs' not in line and 'seq' not in line:
             raise Exception('couldn\'t find a sequence column in %s (you can set this with --seq-column)' % infname)
         if suffix != '.yaml':
-            utils.process_input_line(line)
+            if line_decoder is None or set(line) != decoder_keys:  # rebuild it if the keys change (lines from different csv files can have different headers)
+                decoder_keys = set(line)
+                line_decoder = utils.get_line_decoder(line.keys())
+            line_decoder(line)
         if len(line['unique_ids']) > 1:
             raise Exception('can\'t yet handle multi-seq csv input files')
         uid = line['unique_ids'][0]
-        if uid in input_info:
+        if already_read(uid):
             new_uid = uid
             iid = 2
-            while new_uid in input_info:
+            while already_read(new_uid):
                 new_uid = uid + '-' + str(iid)
                 iid += 1
             print '  %s uid %s already read from input file %s, so replacing with new uid %s' % (utils.color('yellow', 'warning'), uid, infname, new_uid)
@@ -238,6 +274,12 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
                 print '  --n-max-queries: stopped after reading %d queries from input file' % len(input_info)
             break
 
+    if chunkfo is not None:
+        chunkfo['n_lines'] += iline + 1
+        chunkfo['iname'] = iname
+        chunkfo['previous_uids'] |= set(input_info)
+        chunkfo['finished'] = iline + 1 < args.chunk_size  # if we read a whole chunk, there may or may not be any more lines (if there aren't, the next chunk is empty)
+
     if more_input_info is not None:  # if you use this on simulation, the extra queries that aren't in <reco_info> may end up breaking something down the line (but I don't imagine this really getting used on simulation)
         if len(set(more_input_info) & set(input_info)) > 0:
             print '  %s found %d queries in both --infname and --queries-to-include-fname (note that we don\'t check here that they correspond to the same sequence): %s' % (utils.color('red', 'note:'), len(set(more_input_info) & set(input_info)), ' '.join(set(more_input_info) & set(input_info)))  # not necessarily a problem, but you probably *shouldn't* have sequences floating around in two different files
@@ -248,7 +290,7 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
         read_input_metafo(args.input_metafname, input_info.values(), debug=True)
     post_process(input_info, reco_info, args, infname, found_seed, is_data, iline)
 
-    if len(input_info) == 0:
+    if len(input_info) == 0 and chunkfo is None:  # with --chunk-size, the last chunk is empty if the number of sequences is a multiple of the chunk size
         raise Exception('didn\'t read any sequences from %s' % infname)
 
     return input_info, reco_info, yaml_glfo
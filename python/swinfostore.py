@@ -0,0 +1,282 @@
+import copy
+import numpy
+
+import utils
+import indelutils
+
+# ----------------------------------------------------------------------------------------
+# how each key in a (single-sequence) sw annotation gets stored in SwInfoStore (keys that aren't in here are stored as-is in a list)
+column_kinds = {}
+for key in [e + '_del' for e in utils.all_erosions] + ['cdr3_length']:
+    column_kinds[key] = 'int'
+column_kinds['invalid'] = 'bool'
+for key in [r + '_gene' for r in utils.regions] + [b + '_insertion' for b in utils.all_boundaries] + ['naive_seq'] + [r + '_gl_seq' for r in utils.regions]:
+    column_kinds[key] = 'str'
+for key in ['unique_ids', 'seqs', 'input_seqs', 'indel_reversed_seqs', 'cdr3_seqs'] + [r + '_qr_seqs' for r in utils.regions] + ['aligned_' + r + '_seqs' for r in utils.regions]:
+    column_kinds[key] = 'seq-str'
+for key in ['padlefts', 'padrights', 'n_mutations']:
+    column_kinds[key] = 'seq-int'
+column_kinds['mut_freqs'] = 'seq-float'
+for key in ['in_frames', 'stops', 'mutated_invariants']:
+    column_kinds[key] = 'seq-bool'
+for key in ['k_v', 'k_d', 'lengths', 'codon_positions', 'regional_bounds']:
+    column_kinds[key] = 'int-dict'
+column_kinds['all_matches'] = 'gene-lists'
+column_kinds['indelfos'] = 'indelfos'
+column_kinds['duplicates'] = 'duplicates'
+
+int_dict_subkeys = {  # (sub)keys of the 'int-dict' columns, and the number of ints for each one
+    'k_v' : (('min', 'best', 'max'), 1),
+    'k_d' : (('min', 'best', 'max'), 1),
+    'lengths' : (tuple(utils.regions), 1),
+    'codon_positions' : (('v', 'j'), 1),
+    'regional_bounds' : (tuple(utils.regions), 2),
+}
+
+empty_indelfo = indelutils.get_empty_indel()  # only for comparison, so don't modify it
+
+class EncodingError(Exception):  # value doesn't fit in its column (e.g. a per-seq list that has more than one entry), so it goes in the overflow dict instead
+    pass
+
+# ----------------------------------------------------------------------------------------
+class SwInfoStore(object):
+    """
+    Columnar version of the per-query annotations in a smith-waterman info dict (i.e. Waterer.info, aka PartitionDriver.sw_info), which otherwise has a whole dict (with a bunch of nested dicts and lists) for each query.
+    Numbers are stored in numpy arrays, strings are interned (so e.g. identical 'seqs', 'input_seqs', and 'indel_reversed_seqs' only get stored once), and lists of genes and duplicates are shared among queries that have the same ones.
+    Use compact_sw_info() to convert an sw info dict. Each query's annotation is then an SwQueryView, which looks like the original dict.
+    NOTE values are rebuilt each time you access them, so if you want to change something you have to assign to the view (e.g. swfo['padlefts'] = [3]) rather than modifying the value in place (e.g. swfo['padlefts'][0] = 3 doesn't do anything).
+    """
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, lines):
+        self.n_rows = len(lines)
+        self.columns = {}
+        self.overflow = {}  # values that don't fit in their column, keyed by (irow, key)
+        self.keysets = {}  # each distinct set of keys gets stored once, and shared among the rows that have it
+        self.shared_tuples = {}  # ditto for gene lists and duplicates
+        self.row_keys = [self.get_keyset(line) for line in lines]
+        for key in set(k for line in lines for k in line):  # fill one column at a time, since it's much faster than using set_value()
+            self.add_column(key)
+            column = self.columns[key]
+            irows, stored_vals = [], []
+            for irow, line in enumerate(lines):
+                if key not in line:
+                    continue
+                try:
+                    stored_vals.append(self.encode(key, line[key]))
+                    irows.append(irow)
+                except EncodingError:
+                    self.overflow[(irow, key)] = copy.deepcopy(line[key])
+            if type(column) == list:
+                for irow, sval in zip(irows, stored_vals):
+                    column[irow] = sval
+            elif len(irows) > 0:
+                column[irows] = stored_vals
+
+    # ----------------------------------------------------------------------------------------
+    def get_keyset(self, keys):
+        keyset = frozenset(keys)
+        return self.keysets.setdefault(keyset, keyset)
+
+    # ----------------------------------------------------------------------------------------
+    def share(self, tup):
+        return self.shared_tuples.setdefault(tup, tup)
+
+    # ----------------------------------------------------------------------------------------
+    def add_column(self, key):
+        kind = column_kinds.get(key, 'object')
+        if kind in ['int', 'seq-int']:
+            self.columns[key] = numpy.zeros(self.n_rows, dtype=numpy.int32)
+        elif kind in ['bool', 'seq-bool']:
+            self.columns[key] = numpy.zeros(self.n_rows, dtype=bool)
+        elif kind == 'seq-float':
+            self.columns[key] = numpy.zeros(self.n_rows, dtype=numpy.float64)
+        elif kind == 'int-dict':
+            subkeys, width = int_dict_subkeys[key]
+            self.columns[key] = numpy.zeros((self.n_rows, len(subkeys) * width), dtype=numpy.int32)
+        else:
+            self.columns[key] = [None for _ in range(self.n_rows)]
+
+    # ----------------------------------------------------------------------------------------
+    def encode(self, key, val):  # convert <val> to what we store in its column (raises EncodingError if it doesn't fit)
+        kind = column_kinds.get(key, 'object')
+        if kind in ['int', 'bool']:
+            if type(val) not in [int, bool]:
+                raise EncodingError()
+            return val
+        elif kind == 'str':
+            return intern(val) if type(val) == str else val
+        elif kind in ['seq-str', 'seq-int', 'seq-float', 'seq-bool', 'indelfos', 'duplicates']:  # per-seq lists, which should have just the one entry
+            if type(val) != list or len(val) != 1:
+                raise EncodingError()
+            val = val[0]
+            if kind == 'seq-str':
+                return intern(val) if type(val) == str else val
+            elif kind == 'seq-int' or kind == 'seq-bool':
+                if type(val) not in [int, bool]:
+                    raise EncodingError()
+                return val
+            elif kind == 'seq-float':
+                if type(val) != float:
+                    raise EncodingError()
+                return val
+            elif kind == 'indelfos':  # almost all of them are empty, so we just store None
+                return None if val == empty_indelfo else val
+            elif kind == 'duplicates':
+                return self.share(tuple(intern(u) if type(u) == str else u for u in val))
+        elif kind == 'int-dict':
+            subkeys, width = int_dict_subkeys[key]
+            if type(val) != dict or set(val) != set(subkeys):
+                raise EncodingError()
+            ints = [val[s] for s in subkeys] if width == 1 else [i for s in subkeys for i in val[s]]
+            if len(ints) != len(subkeys) * width or any(type(i) != int for i in ints):
+                raise EncodingError()
+            return ints
+        elif kind == 'gene-lists':
+            if type(val) != dict:
+                raise EncodingError()
+            return self.share(tuple((r, self.share(tuple(intern(g) if type(g) == str else g for g in val[r]))) for r in sorted(val)))
+        else:
+            return val
+
+    # ----------------------------------------------------------------------------------------
+    def decode(self, key, stored):  # inverse of encode()
+        kind = column_kinds.get(key, 'object')
+        if kind == 'int':
+            return int(stored)
+        elif kind == 'bool':
+            return bool(stored)
+        elif kind == 'seq-str':
+            return [stored]
+        elif kind == 'seq-int':
+            return [int(stored)]
+        elif kind == 'seq-float':
+            return [float(stored)]
+        elif kind == 'seq-bool':
+            return [bool(stored)]
+        elif kind == 'indelfos':
+            return [indelutils.get_empty_indel() if stored is None else stored]
+        elif kind == 'duplicates':
+            return [list(stored)]
+        elif kind == 'int-dict':
+            subkeys, width = int_dict_subkeys[key]
+            if width == 1:
+                return {s : int(i) for s, i in zip(subkeys, stored)}
+            else:
+                return {s : tuple(int(i) for i in stored[isub * width : (isub + 1) * width]) for isub, s in enumerate(subkeys)}
+        elif kind == 'gene-lists':
+            return {r : list(genes) for r, genes in stored}
+        else:
+            return stored
+
+    # ----------------------------------------------------------------------------------------
+    def get_value(self, irow, key):
+        if key not in self.row_keys[irow]:
+            raise KeyError(key)
+        if (irow, key) in self.overflow:
+            return copy.deepcopy(self.overflow[(irow, key)])  # deep copy so it behaves the same as the values we rebuild
+        return self.decode(key, self.columns[key][irow])
+
+    # ----------------------------------------------------------------------------------------
+    def set_value(self, irow, key, val):
+        if key not in self.columns:
+            self.add_column(key)
+        if key not in self.row_keys[irow]:
+            self.row_keys[irow] = self.get_keyset(self.row_keys[irow] | set([key]))
+        self.overflow.pop((irow, key), None)
+        try:
+            self.columns[key][irow] = self.encode(key, val)
+        except EncodingError:
+            self.overflow[(irow, key)] = copy.deepcopy(val)
+
+    # ----------------------------------------------------------------------------------------
+    def delete_value(self, irow, key):
+        if key not in self.row_keys[irow]:
+            raise KeyError(key)
+        self.row_keys[irow] = self.get_keyset(self.row_keys[irow] - set([key]))
+        self.overflow.pop((irow, key), None)
+        if type(self.columns[key]) == list:  # don't hang on to the old value
+            self.columns[key][irow] = None
+
+# ----------------------------------------------------------------------------------------
+class SwQueryView(object):
+    """ Dict-like view of one query's annotation in an SwInfoStore (copies and pickles are plain dicts). """
+    __slots__ = ['store', 'irow']  # there's one of these for each query, so keep 'em small
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, store, irow):
+        self.store = store
+        self.irow = irow
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, key):
+        return self.store.get_value(self.irow, key)
+    def __setitem__(self, key, val):
+        self.store.set_value(self.irow, key, val)
+    def __delitem__(self, key):
+        self.store.delete_value(self.irow, key)
+    def __contains__(self, key):
+        return key in self.store.row_keys[self.irow]
+    def has_key(self, key):
+        return key in self
+    def __iter__(self):
+        return iter(self.store.row_keys[self.irow])
+    def __len__(self):
+        return len(self.store.row_keys[self.irow])
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+    def keys(self):
+        return list(self.store.row_keys[self.irow])
+    def values(self):
+        return [self[k] for k in self.keys()]
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+    def iterkeys(self):
+        return iter(self.keys())
+    def itervalues(self):
+        return iter(self.values())
+    def iteritems(self):
+        return iter(self.items())
+    def pop(self, key, *args):
+        if key not in self and len(args) > 0:
+            return args[0]
+        val = self[key]
+        del self[key]
+        return val
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+    def update(self, other):
+        for key, val in other.items():
+            self[key] = val
+
+    # ----------------------------------------------------------------------------------------
+    def copy(self):
+        return dict(self.items())
+    def __copy__(self):
+        return self.copy()
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.copy(), memo)
+    def __reduce__(self):
+        return (dict, (self.copy(), ))
+    def __eq__(self, other):
+        if isinstance(other, SwQueryView):
+            other = other.copy()
+        return self.copy() == other
+    def __ne__(self, other):
+        return not self == other
+    __hash__ = None  # mutable, like a dict
+    def __repr__(self):
+        return repr(self.copy())
+
+# ----------------------------------------------------------------------------------------
+def compact_sw_info(sw_info):
+    """ Return a copy of <sw_info> in which the per-query annotations are replaced by views into a (much smaller) SwInfoStore. The other entries ('queries', 'indels', etc.) are the same objects as in <sw_info>. """
+    queries = [q for q in sw_info if q in sw_info['passed-queries']]
+    store = SwInfoStore([sw_info[q] for q in queries])
+    compact_info = {k : v for k, v in sw_info.items() if k not in sw_info['passed-queries']}
+    for irow, query in enumerate(queries):
+        compact_info[query] = SwQueryView(store, irow)
+    return compact_info
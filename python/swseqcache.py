@@ -0,0 +1,58 @@
+import json
+import hashlib
+import sqlite3
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class SwSeqCache(object):
+    """ Per-sequence smith-waterman cache: each annotation is stored under a hash of the input sequence, the germline set, and the arguments that affect sw, so adding or reordering input sequences only means running sw on the new ones.
+    Since the germline set is in the key, one file can be shared among parameter dirs (and several processes can write to it at once). """
+    sw_arg_names = ['locus', 'gap_open_penalty', 'no_indel_gap_open_penalty', 'n_max_per_region', 'max_vj_mut_freq', 'is_data', 'dont_remove_framework_insertions', 'skip_unproductive', 'linearham']  # NOTE if you add something that affects the sw annotations, add it here (it'll invalidate existing cache entries, but that's the point)
+
+    # ----------------------------------------------------------------------------------------
+    def __init__(self, fname, glfo, args, use_vsearch):
+        self.fname = fname
+        self.conn = sqlite3.connect(fname, timeout=600)  # if another process is writing, wait for it rather than failing
+        self.conn.text_factory = str
+        self.conn.execute('create table if not exists annotations (key text primary key, line text)')
+        self.conn.commit()
+
+        glfo_strs = [glfo['locus']]
+        for region in utils.getregions(glfo['locus']):
+            glfo_strs += ['%s:%s' % (g, s) for g, s in sorted(glfo['seqs'][region].items())]
+            if utils.cdn(glfo, region) is not None:
+                glfo_strs += ['%s:%d' % (g, p) for g, p in sorted(utils.cdn_positions(glfo, region).items())]
+        arg_strs = ['%s:%s' % (a, getattr(args, a)) for a in self.sw_arg_names] + ['vsearch:%s' % use_vsearch]
+        self.base_hash = hashlib.md5(' '.join(glfo_strs + arg_strs)).hexdigest()  # everything but the sequence
+        self.n_hits, self.n_added = 0, 0
+
+    # ----------------------------------------------------------------------------------------
+    def get_key(self, seq):
+        return hashlib.md5(self.base_hash + seq).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, uid_seqs):  # <uid_seqs>: dict of {uid : input seq}, returns dict of {uid : cached line} for the ones we have (lines need to have implicit info added)
+        cached_lines = {}
+        for uid, seq in uid_seqs.items():
+            dbrow = self.conn.execute('select line from annotations where key = ?', [self.get_key(seq)]).fetchone()
+            if dbrow is None:
+                continue
+            line = json.loads(dbrow[0])
+            line['unique_ids'] = [uid]  # might've been cached with a different uid
+            line['duplicates'] = [[]]  # duplicates get redetermined after we're done
+            utils.transfer_indel_reversed_seqs(line)
+            cached_lines[uid] = line
+        self.n_hits += len(cached_lines)
+        return cached_lines
+
+    # ----------------------------------------------------------------------------------------
+    def add(self, uid_seqs, lines, headers, glfo):  # <uid_seqs>: input seq for each uid in <lines>, since that's what they're keyed by (the seqs in the lines may be trimmed, or have indels reversed)
+        with self.conn:  # one transaction
+            for line in lines:
+                self.conn.execute('insert or replace into annotations values (?, ?)', [self.get_key(uid_seqs[line['unique_ids'][0]]), json.dumps(utils.get_yamlfo_for_output(line, headers, glfo=glfo))])
+        self.n_added += len(lines)
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        self.conn.close()
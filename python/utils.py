@@ -13,19 +13,30 @@ import itertools
 import ast
 import math
 import glob
+import re
 from collections import Counter
 from collections import OrderedDict
 import csv
 import subprocess
+import select
+import signal
+import fcntl
+import errno
 import multiprocessing
 import copy
 import traceback
-import json
+import gzip
+import bz2
+import io
 import types
 import collections
 import operator
 
 import indelutils
+import hammingutils
+import jsonstream
+import outputdb
+import partitionmetrics
 import clusterpath
 
 # ----------------------------------------------------------------------------------------
@@ -79,6 +90,7 @@ def region_pairs():
 import seqfileopener
 import glutils
 import prutils
+import lazyannotation
 
 #----------------------------------------------------------------------------------------
 # NOTE I also have an eps defined in hmmwriter. Simplicity is the hobgoblin of... no, wait, that's just plain ol' stupid to have two <eps>s defined
@@ -284,6 +296,30 @@ def get_list_of_str_list(strlist):
         return []
     return [[] if substr == '' else substr.split(':') for substr in strlist]
 
+# ----------------------------------------------------------------------------------------
+# faster versions of ast.literal_eval() for the formats that str() gives for the most common literal columns (anything that doesn't exactly match the expected format gets passed to ast.literal_eval())
+int_dict_entry = r"'\w+': -?\d+"
+int_dict_regex = re.compile(r'\{(?:%s(?:, %s)*)?\}$' % (int_dict_entry, int_dict_entry))  # e.g. k_v: {'max': 300, 'best': 299, 'min': 299}
+def get_int_dict(dictstr):
+    if int_dict_regex.match(dictstr) is None:
+        return ast.literal_eval(dictstr)
+    return {key : int(val) for key, val in re.findall(r"'(\w+)': (-?\d+)", dictstr)}
+
+str_list_item = r"'[^'\\\[\]]*'"
+str_list_dict_entry = r"'\w+': \[(?:%s(?:, %s)*)?\]" % (str_list_item, str_list_item)
+str_list_dict_regex = re.compile(r'\{(?:%s(?:, %s)*)?\}$' % (str_list_dict_entry, str_list_dict_entry))  # e.g. all_matches: {'j': ['IGHJ4*02', 'IGHJ4*01'], 'd': ['IGHD2-21*02'], 'v': ['IGHV3-23*01']}
+def get_str_list_dict(dictstr):
+    if str_list_dict_regex.match(dictstr) is None:
+        return ast.literal_eval(dictstr)
+    return {key : re.findall(r"'([^']*)'", liststr) for key, liststr in re.findall(r"'(\w+)': \[([^\]]*)\]", dictstr)}
+
+empty_indelfo_str = str(indelutils.get_empty_indel())
+def get_indelfo_list(liststr):  # the vast majority are empty, and the rest go to ast.literal_eval()
+    n_empty = liststr.count(empty_indelfo_str)
+    if n_empty == 0 or liststr != '[' + ', '.join([empty_indelfo_str for _ in range(n_empty)]) + ']':
+        return ast.literal_eval(liststr)
+    return [indelutils.get_empty_indel() for _ in range(n_empty)]
+
 # keep track of all the *@*@$!ing different keys that happen in the <line>/<hmminfo>/whatever dictionaries
 linekeys = {}
 # I think 'per_family' is pretty incomplete at this point, but I also think it isn't being used
@@ -383,6 +419,13 @@ for region in regions:
     conversion_fcns[region + '_per_gene_support'] = get_str_float_pair_dict
 conversion_fcns['duplicates'] = get_list_of_str_list
 
+fast_conversion_fcns = {  # used instead of ast.literal_eval() in the decoders from get_line_decoder()
+    'k_v' : get_int_dict,
+    'k_d' : get_int_dict,
+    'all_matches' : get_str_list_dict,
+    'indelfos' : get_indelfo_list,
+}
+
 # ----------------------------------------------------------------------------------------
 def synthesize_single_seq_line(line, iseq):
     """ without modifying <line>, make a copy of it corresponding to a single-sequence event with the <iseq>th sequence """
@@ -1210,7 +1253,7 @@ def add_linearham_info(sw_info, line):
 
     # rank the query sequences according to their consensus sequence distances
     cons_seq = ''.join([Counter(site_bases).most_common()[0][0] for site_bases in zip(*line['indel_reversed_seqs'])])
-    dists_to_cons = {line['unique_ids'][i] : hamming_distance(cons_seq, line['indel_reversed_seqs'][i]) for i in range(len(line['unique_ids']))}
+    dists_to_cons = dict(zip(line['unique_ids'], hammingutils.hamming_distances(cons_seq, line['indel_reversed_seqs'])))
 
     # loop over the ranked query sequences and update the flexbounds/relpos dicts
     while len(dists_to_cons) > 0:
@@ -1320,19 +1363,7 @@ def add_linearham_info(sw_info, line):
     return 'ok'
 
 # ----------------------------------------------------------------------------------------
-def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, reset_indel_genes=False):  # should turn on <check_line_keys> for a bit if you change anything
-    """ Add to <line> a bunch of things that are initially only implicit. """
-    if line['v_gene'] == '':
-        raise Exception('can\'t add implicit info to line with failed annotation:\n%s' % (''.join(['  %+20s  %s\n' % (k, v) for k, v in line.items()])))
-
-    if check_line_keys:
-        initial_keys = set(line)
-        # first make sure there aren't any unauthorized keys
-        if len(initial_keys - all_linekeys) > 0:
-            raise Exception('unexpected keys: \'%s\'' % '\' \''.join(initial_keys - all_linekeys))
-        # then keep track of the keys we got to start with
-        pre_existing_implicit_info = {ek : copy.deepcopy(line[ek]) for ek in implicit_linekeys if ek in line}
-
+def add_germline_implicit_info(glfo, line):  # first part of add_implicit_info(): the things that only depend on the germline genes, deletions, and insertions (i.e. not on the sequences [other than checking lengths])
     for region in regions:  # backwards compatibility with old simulation files should be removed when you're no longer running on them
         if line[region + '_gene'] not in glfo['seqs'][region]:
             alternate_name = glutils.convert_to_duplicate_name(glfo, line[region + '_gene'])
@@ -1378,11 +1409,16 @@ def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, r
     end['j'] = start['j'] + len(line['j_gl_seq'])
     line['regional_bounds'] = {r : (start[r], end[r]) for r in regions}
 
+# ----------------------------------------------------------------------------------------
+def add_sequence_implicit_info(glfo, line, aligned_gl_seqs=None, reset_indel_genes=False):  # second part of add_implicit_info(): indel, qr seq, functional, mutation, and alignment info (needs the info from add_germline_implicit_info()). Returns False if we couldn't reconstruct the indel info (in which case <line> is just set to invalid)
+    start = {r : line['regional_bounds'][r][0] for r in regions}
+    end = {r : line['regional_bounds'][r][1] for r in regions}
+
     try:
         indelutils.deal_with_indel_stuff(line, reset_indel_genes=reset_indel_genes)
     except indelutils.IndelfoReconstructionError:  # I don't like this here, but see note in the one place it can be raised
         line['invalid'] = True
-        return
+        return False
 
     input_codon_positions = [indelutils.get_codon_positions_with_indels_reinstated(line, iseq, line['codon_positions']) for iseq in range(len(line['seqs']))]
     if 'indel_reversed_seqs' not in line:  # everywhere internally, we refer to 'indel_reversed_seqs' as simply 'seqs'. For interaction with outside entities, however (i.e. writing files) we use the more explicit 'indel_reversed_seqs'
@@ -1393,9 +1429,9 @@ def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, r
 
     add_functional_info(glfo['locus'], line, input_codon_positions)
 
-    hfracfo = [hamming_fraction(line['naive_seq'], mature_seq, also_return_distance=True) for mature_seq in line['seqs']]
-    line['mut_freqs'] = [hfrac for hfrac, _ in hfracfo]
-    line['n_mutations'] = [n_mutations for _, n_mutations in hfracfo]
+    n_mutations, lengths = hammingutils.hamming_distances(line['naive_seq'], line['seqs'], return_len_excluding_ambig=True)
+    line['mut_freqs'] = [float(f) for f in hammingutils.get_fractions(n_mutations, lengths)]  # convert from numpy types, since json can't write numpy ints
+    line['n_mutations'] = [int(n) for n in n_mutations]
 
     # set validity (alignment addition [below] can also set invalid)  # it would be nice to clean up this checking stuff
     line['invalid'] = False
@@ -1415,6 +1451,25 @@ def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, r
     else:
         add_alignments(glfo, aligned_gl_seqs, line)
 
+    return True
+
+# ----------------------------------------------------------------------------------------
+def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, reset_indel_genes=False):  # should turn on <check_line_keys> for a bit if you change anything
+    """ Add to <line> a bunch of things that are initially only implicit. """
+    if line['v_gene'] == '':
+        raise Exception('can\'t add implicit info to line with failed annotation:\n%s' % (''.join(['  %+20s  %s\n' % (k, v) for k, v in line.items()])))
+
+    if check_line_keys:
+        initial_keys = set(line)
+        # first make sure there aren't any unauthorized keys
+        if len(initial_keys - all_linekeys) > 0:
+            raise Exception('unexpected keys: \'%s\'' % '\' \''.join(initial_keys - all_linekeys))
+        # then keep track of the keys we got to start with
+        pre_existing_implicit_info = {ek : copy.deepcopy(line[ek]) for ek in implicit_linekeys if ek in line}
+
+    add_germline_implicit_info(glfo, line)
+    if not add_sequence_implicit_info(glfo, line, aligned_gl_seqs=aligned_gl_seqs, reset_indel_genes=reset_indel_genes):
+        return
     re_sort_per_gene_support(line)  # in case it was read from json.dump()'d file
 
     if check_line_keys:
@@ -2068,6 +2123,67 @@ def process_input_line(info, skip_literal_eval=False):
         if len(info[key]) != len(info['unique_ids']):
             raise Exception('list length %d for %s not the same as for unique_ids %d\n  contents: %s' % (len(info[key]), key, len(info['unique_ids']), info[key]))
 
+# ----------------------------------------------------------------------------------------
+def get_line_decoder(headers, skip_literal_eval=False):
+    """
+    Return a function that does the same thing as process_input_line() to a line (e.g. a row from a csv.DictReader) with keys <headers>, but faster:
+    all the per-key decisions (which conversion fcn, whether it's a list, etc.) are made once here rather than for every line, and the most common ast.literal_eval() columns use the parsers in <fast_conversion_fcns>.
+    """
+    headers = set(headers)
+    if 'seq' in headers:  # old simulation files need the renaming in process_input_line(), and there's no reason to optimize them
+        return lambda info: process_input_line(info, skip_literal_eval=skip_literal_eval)
+
+    converters = []  # list of (key, fcn) pairs for the columns that need converting
+    for key in headers:
+        convert_fcn = conversion_fcns.get(key, pass_fcn)
+        if skip_literal_eval and convert_fcn is ast.literal_eval:
+            continue
+        convert_fcn = fast_conversion_fcns.get(key, convert_fcn)
+        if key in io_column_configs['lists']:
+            if convert_fcn is pass_fcn:
+                converters.append((key, lambda val: val.split(':')))
+            else:
+                converters.append((key, lambda val, cfcn=convert_fcn: [cfcn(v) for v in val.split(':')]))
+        elif key in io_column_configs['lists-of-lists']:
+            converters.append((key, lambda val, cfcn=convert_fcn: cfcn(val.split(';'))))
+        elif convert_fcn is not pass_fcn:
+            converters.append((key, convert_fcn))
+
+    check_v_gene = 'v_gene' in headers
+    transfer_seqs = 'indel_reversed_seqs' in headers and 'input_seqs' in headers  # see process_input_line()
+    copy_seqs = not transfer_seqs and 'seqs' in headers
+    list_keys = [k for k in headers if k in io_column_configs['lists']]
+    if transfer_seqs and 'seqs' not in list_keys:
+        list_keys.append('seqs')
+    if copy_seqs and 'indel_reversed_seqs' not in list_keys:
+        list_keys.append('indel_reversed_seqs')
+    list_of_list_keys = [k for k in headers if k in io_column_configs['lists-of-lists']]
+
+    def decode(info):
+        if check_v_gene and info['v_gene'] == '':
+            return
+        for key, cfcn in converters:
+            if info[key] != '':  # empty ones get handled below, once we know how many seqs there are
+                info[key] = cfcn(info[key])
+        if transfer_seqs:
+            if info['indel_reversed_seqs'] == '':
+                info['indel_reversed_seqs'] = ['' for _ in range(len(info['unique_ids']))]
+            transfer_indel_reversed_seqs(info)
+        elif copy_seqs:
+            info['indel_reversed_seqs'] = info['seqs']
+        if len(list_keys) > 0:
+            n_seqs = len(info['unique_ids'])
+            for key in list_keys:
+                if info[key] == '':
+                    info[key] = ['' for _ in range(n_seqs)]
+                elif len(info[key]) != n_seqs:
+                    raise Exception('list length %d for %s not the same as for unique_ids %d\n  contents: %s' % (len(info[key]), key, n_seqs, info[key]))
+        for key in list_of_list_keys:
+            if info[key] == '':
+                info[key] = [[] for _ in range(len(info['unique_ids']))]
+
+    return decode
+
 # ----------------------------------------------------------------------------------------
 def add_extra_column(key, info, outfo, glfo=None, definitely_add_all_columns_for_csv=False):
     if key == 'cdr3_seqs':
@@ -2534,7 +2650,7 @@ def run_proc_functions(procs, n_procs=None, debug=False):  # <procs> is a list o
             break
 
 # ----------------------------------------------------------------------------------------
-def run_cmd(cmdfo, batch_system=None, batch_options=None, shell=False):
+def run_cmd(cmdfo, batch_system=None, batch_options=None, shell=False, pipe_output=False):  # if <pipe_output>, stdout/stderr go to pipes (proc.stdout/proc.stderr) that the caller has to read, rather than to files in the logdir
     cmd_str = cmdfo['cmd_str']  # don't want to modify the str in <cmdfo>
     # print cmd_str
     # sys.exit()
@@ -2564,34 +2680,180 @@ def run_cmd(cmdfo, batch_system=None, batch_options=None, shell=False):
         os.makedirs(cmdfo['logdir'])
 
     # print cmd_str
-    proc = subprocess.Popen(cmd_str if shell else cmd_str.split(),
-                            stdout=None if fout is None else open(fout, 'w'),
-                            stderr=None if ferr is None else open(ferr, 'w'),
-                            env=cmdfo['env'], shell=shell)
+    if pipe_output and fout is not None:
+        stdout, stderr = subprocess.PIPE, subprocess.PIPE
+    else:
+        stdout = None if fout is None else open(fout, 'w')
+        stderr = None if ferr is None else open(ferr, 'w')
+    proc = subprocess.Popen(cmd_str if shell else cmd_str.split(), stdout=stdout, stderr=stderr, env=cmdfo['env'], shell=shell)
     return proc
 
 # ----------------------------------------------------------------------------------------
-def run_cmds(cmdfos, sleep=True, batch_system=None, batch_options=None, batch_config_fname=None, debug=None, ignore_stderr=False, n_max_tries=None, clean_on_success=False, shell=False):  # set sleep to False if your commands are going to run really really really quickly
+def start_sigchld_wakeup():
+    """ Arrange for a byte to be written to a pipe whenever a child process exits, so run_cmds() can block in select/poll until something actually happens (rather than polling every process in a loop).
+    Returns None if we can't install signal handlers (only possible in the main thread), in which case the caller has to fall back to timed polling. """
+    rfd, wfd = os.pipe()
+    for fd in (rfd, wfd):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)  # set_wakeup_fd() requires a non-blocking fd
+    try:
+        old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)  # the handler doesn't need to do anything, since the point is just the byte that python writes to <wfd> when the signal arrives
+    except ValueError:  # not in main thread
+        os.close(rfd)
+        os.close(wfd)
+        return None
+    signal.siginterrupt(signal.SIGCHLD, False)  # restart interrupted system calls (e.g. reads in subprocess) rather than raising EINTR all over the place
+    old_wakeup_fd = signal.set_wakeup_fd(wfd)
+    return {'rfd' : rfd, 'wfd' : wfd, 'old_handler' : old_handler, 'old_wakeup_fd' : old_wakeup_fd}
+
+# ----------------------------------------------------------------------------------------
+def stop_sigchld_wakeup(wakeupfo):
+    if wakeupfo is None:
+        return
+    signal.set_wakeup_fd(wakeupfo['old_wakeup_fd'])
+    signal.signal(signal.SIGCHLD, wakeupfo['old_handler'] if wakeupfo['old_handler'] is not None else signal.SIG_DFL)
+    os.close(wakeupfo['rfd'])
+    os.close(wakeupfo['wfd'])
+
+# ----------------------------------------------------------------------------------------
+def wait_for_fds(fds, timeout):  # block until one of <fds> is readable, or <timeout> seconds go by, and return the readable ones
+    try:
+        if hasattr(select, 'poll'):  # poll() doesn't have select()'s limit on fd values (FD_SETSIZE, usually 1024), which we'd hit with a few hundred procs
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+            return [fd for fd, _ in poller.poll(1000 * timeout)]
+        else:
+            ready_fds, _, _ = select.select(fds, [], [], timeout)
+            return ready_fds
+    except (select.error, OSError, IOError) as err:
+        if err.args[0] == errno.EINTR:  # interrupted by a signal (i.e. probably a child finished) before anything was readable
+            return []
+        raise
+
+# ----------------------------------------------------------------------------------------
+def read_available(fd):  # read whatever's available on non-blocking <fd>, returning None on eof
+    chunks = []
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                break
+            raise
+        if chunk == '':
+            return None if len(chunks) == 0 else ''.join(chunks)  # if we got something before the eof, the caller finds the eof on the next call
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+# ----------------------------------------------------------------------------------------
+def run_cmds(cmdfos, sleep=True, batch_system=None, batch_options=None, batch_config_fname=None, debug=None, ignore_stderr=False, n_max_tries=None, clean_on_success=False, shell=False, n_max_procs=None, finish_fcn=None, get_new_cmdfos=None):  # set sleep to False if your commands are going to run really really really quickly
+    """ Run the commands in <cmdfos>, with at most <n_max_procs> running at once (default: all of them), waiting for them to finish and restarting failures up to <n_max_tries> times.
+    Rather than polling, we sleep until a child exits (we get a SIGCHLD) or writes to stdout/stderr, which (unless we're running on sge) we read through pipes as it arrives, and pass to process_out_err() (i.e. to the dbgfos) without going through files in the logdirs.
+    The wall time of each command's last try is set in cmdfo['run_time'].
+    If <finish_fcn> is set, it's called with iproc as soon as each command succeeds (e.g. to start processing its output while the others are still running).
+    If <get_new_cmdfos> is set, it's called each time through the loop, and returns either a (possibly empty) list of new cmdfos to run (which we append to <cmdfos> and start as procs become available), or None if there isn't anything outstanding that could lead to new commands. We don't return until it returns None and all the commands have finished.
+    NOTE if <n_max_procs> isn't set, it's the number of initial commands. """
     if n_max_tries is None:
         n_max_tries = 1 if batch_system is None else 3
+    if n_max_procs is None:
+        n_max_procs = max(1, len(cmdfos))
     prepare_cmds(cmdfos, batch_system=batch_system, batch_options=batch_options, batch_config_fname=batch_config_fname)
-    procs, n_tries = [], []
+    pipe_output = batch_system != 'sge'  # sge writes stdout/stderr to files itself (see run_cmd())
+    procs, n_tries = [None for _ in cmdfos], [0 for _ in cmdfos]
+    outstrs, start_times = [None for _ in cmdfos], [None for _ in cmdfos]  # outstrs: list of stdout and stderr chunks for each proc
+    fd_iprocs = {}  # maps each open stdout/stderr pipe to (iproc, strtype)
     per_proc_sleep_time = 0.01 / max(1, len(cmdfos))
-    for iproc in range(len(cmdfos)):
-        procs.append(run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell))
-        n_tries.append(1)
-        if sleep:
-            time.sleep(per_proc_sleep_time)
-    while procs.count(None) != len(procs):  # we set each proc to None when it finishes
-        for iproc in range(len(cmdfos)):
-            if procs[iproc] is None:  # already finished
-                continue
-            if procs[iproc].poll() is not None:  # it just finished
-                finish_process(iproc, procs, n_tries, cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc]['dbgfo'], batch_system=batch_system, batch_options=batch_options, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success, shell=shell)
-        sys.stdout.flush()
+    poll_time = 1. if batch_system is None else 5.  # max time to wait between checking on procs (i.e. if we miss a SIGCHLD [or can't get them], this is how long until we notice)
+    if get_new_cmdfos is not None:
+        poll_time = 0.1  # whatever's generating new commands doesn't wake us up, so check on it more often
+
+    def register(iproc):  # set up bookkeeping for a just-started (or restarted) proc
+        start_times[iproc] = time.time()
+        outstrs[iproc] = {'out' : [], 'err' : []}
+        if pipe_output:
+            for strtype, pipe in [('out', procs[iproc].stdout), ('err', procs[iproc].stderr)]:
+                fcntl.fcntl(pipe.fileno(), fcntl.F_SETFL, fcntl.fcntl(pipe.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK)
+                fd_iprocs[pipe.fileno()] = (iproc, strtype)
+    def close_pipe(fd):
+        iproc, strtype = fd_iprocs.pop(fd)
+        getattr(procs[iproc], 'std' + strtype).close()
+    def read_output(fd):  # returns True if there was anything to read
+        iproc, strtype = fd_iprocs[fd]
+        chunk = read_available(fd)
+        if chunk is None:  # eof
+            close_pipe(fd)
+            return False
+        outstrs[iproc][strtype].append(chunk)
+        return len(chunk) > 0
+    def start(iproc):
+        procs[iproc] = run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell, pipe_output=pipe_output)
+        n_tries[iproc] = 1
+        register(iproc)
         if sleep:
             time.sleep(per_proc_sleep_time)
 
+    def add_cmdfos(new_cmdfos):
+        prepare_cmds(new_cmdfos, batch_system=batch_system, batch_options=batch_options, batch_config_fname=batch_config_fname)
+        for cmdfo in new_cmdfos:
+            cmdfos.append(cmdfo)
+            for plist in [procs, outstrs, start_times]:
+                plist.append(None)
+            n_tries.append(0)
+            iprocs_to_start.insert(0, len(cmdfos) - 1)
+
+    iprocs_to_start = list(reversed(range(len(cmdfos))))  # reversed so we can pop() them in order
+    running = set()
+    waiting_for_new_cmds = get_new_cmdfos is not None
+    wakeupfo = start_sigchld_wakeup()  # has to be installed before starting procs, or we could miss a SIGCHLD
+    try:
+        while len(iprocs_to_start) > 0 or len(running) > 0 or waiting_for_new_cmds:
+            while len(iprocs_to_start) > 0 and len(running) < n_max_procs:
+                iproc = iprocs_to_start.pop()
+                start(iproc)
+                running.add(iproc)
+
+            ready_fds = wait_for_fds(list(fd_iprocs) + ([] if wakeupfo is None else [wakeupfo['rfd']]), poll_time if wakeupfo is not None else 0.1)
+            for fd in ready_fds:
+                if wakeupfo is not None and fd == wakeupfo['rfd']:
+                    read_available(fd)  # just clear out the wakeup bytes (there may be several, one for each SIGCHLD)
+                else:
+                    read_output(fd)
+
+            for iproc in sorted(running):
+                if procs[iproc].poll() is None:  # still running
+                    continue
+                run_time = time.time() - start_times[iproc]
+                for fd in [fd for fd, (ip, _) in fd_iprocs.items() if ip == iproc]:  # read anything left in its pipes
+                    while fd in fd_iprocs and len(wait_for_fds([fd], 0)) > 0 and read_output(fd):
+                        pass
+                    if fd in fd_iprocs:  # if a grandchild is still holding the pipe open, we just ignore it
+                        close_pipe(fd)
+                proc = procs[iproc]
+                finish_process(iproc, procs, n_tries, cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc]['dbgfo'], batch_system=batch_system, batch_options=batch_options, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success, shell=shell,
+                               outstrs=None if not pipe_output else {st : ''.join(outstrs[iproc][st]) for st in outstrs[iproc]}, pipe_output=pipe_output)
+                if procs[iproc] is None:  # finished
+                    cmdfos[iproc]['run_time'] = run_time
+                    running.remove(iproc)
+                    if finish_fcn is not None:
+                        finish_fcn(iproc)
+                elif procs[iproc] is not proc:  # restarted
+                    register(iproc)
+
+            if get_new_cmdfos is not None:
+                new_cmdfos = get_new_cmdfos()
+                waiting_for_new_cmds = new_cmdfos is not None
+                if new_cmdfos is not None:
+                    add_cmdfos(new_cmdfos)
+            sys.stdout.flush()
+    finally:
+        for iproc in running:  # if we're bailing because of an exception (e.g. a proc exceeded its max tries), don't leave the others running
+            if procs[iproc] is not None and procs[iproc].poll() is None:
+                procs[iproc].kill()
+                procs[iproc].wait()  # reap it, so it doesn't hang around as a zombie
+        for fd in list(fd_iprocs):  # close any pipes we were still reading from (otherwise they leak if we keep running after the exception, e.g. in a long-lived process with a bcrham or sam pool)
+            close_pipe(fd)
+        stop_sigchld_wakeup(wakeupfo)
+
 # ----------------------------------------------------------------------------------------
 def pad_lines(linestr, padwidth=8):
     lines = [padwidth * ' ' + l for l in linestr.split('\n')]
@@ -2628,14 +2890,14 @@ def get_slurm_node(errfname):
 
 # ----------------------------------------------------------------------------------------
 # deal with a process once it's finished (i.e. check if it failed, and restart if so)
-def finish_process(iproc, procs, n_tries, cmdfo, n_max_tries, dbgfo=None, batch_system=None, batch_options=None, debug=None, ignore_stderr=False, clean_on_success=False, shell=False):
-    procs[iproc].communicate()
+def finish_process(iproc, procs, n_tries, cmdfo, n_max_tries, dbgfo=None, batch_system=None, batch_options=None, debug=None, ignore_stderr=False, clean_on_success=False, shell=False, outstrs=None, pipe_output=False):  # <outstrs>: dict with the proc's stdout and stderr (if None, they're in files in the logdir)
+    procs[iproc].wait()
     if procs[iproc].returncode == 0:
         if not os.path.exists(cmdfo['outfname']):
             print '      proc %d succeeded but its output isn\'t there, so sleeping for a bit...' % iproc
             time.sleep(0.5)
         if os.path.exists(cmdfo['outfname']):
-            process_out_err(extra_str='' if len(procs) == 1 else str(iproc), dbgfo=dbgfo, logdir=cmdfo['logdir'], debug=debug, ignore_stderr=ignore_stderr)
+            process_out_err(extra_str='' if len(procs) == 1 else str(iproc), dbgfo=dbgfo, logdir=cmdfo['logdir'], debug=debug, ignore_stderr=ignore_stderr, out=None if outstrs is None else outstrs['out'], err=None if outstrs is None else outstrs['err'])
             procs[iproc] = None  # job succeeded
             if clean_on_success:  # this is newer than the rest of the fcn, so it's only actually used in one place, but it'd be nice if other places started using it eventually
                 if 'infname' in cmdfo and os.path.exists(cmdfo['infname']):
@@ -2652,6 +2914,10 @@ def finish_process(iproc, procs, n_tries, cmdfo, n_max_tries, dbgfo=None, batch_
         print 'succeded but output is missing'
     else:
         print 'failed with %d (output %s)' % (procs[iproc].returncode, 'exists' if os.path.exists(cmdfo['outfname']) else 'is missing')
+    if outstrs is not None:  # write piped stdout/stderr to the log files, so they're around for inspection (and for get_slurm_node())
+        for strtype in ['out', 'err']:
+            with open(cmdfo['logdir'] + '/' + strtype, 'w') as logfile:
+                logfile.write(outstrs[strtype])
     for strtype in ['out', 'err']:
         if os.path.exists(cmdfo['logdir'] + '/' + strtype) and os.stat(cmdfo['logdir'] + '/' + strtype).st_size > 0:
             print '        %s tail:           %s' % (strtype, cmdfo['logdir'] + '/' + strtype)
@@ -2677,7 +2943,7 @@ def finish_process(iproc, procs, n_tries, cmdfo, n_max_tries, dbgfo=None, batch_
 
     if n_tries[iproc] < n_max_tries:
         print '    restarting proc %d' % iproc
-        procs[iproc] = run_cmd(cmdfo, batch_system=batch_system, batch_options=batch_options, shell=shell)
+        procs[iproc] = run_cmd(cmdfo, batch_system=batch_system, batch_options=batch_options, shell=shell, pipe_output=pipe_output)
         n_tries[iproc] += 1
     else:
         failstr = 'exceeded max number of tries for cmd\n    %s\nlook for output in %s and %s' % (cmdfo['cmd_str'], cmdfo['workdir'], cmdfo['logdir'])
@@ -2685,10 +2951,9 @@ def finish_process(iproc, procs, n_tries, cmdfo, n_max_tries, dbgfo=None, batch_
         raise Exception(failstr)
 
 # ----------------------------------------------------------------------------------------
-def process_out_err(extra_str='', dbgfo=None, logdir=None, debug=None, ignore_stderr=False):
+def process_out_err(extra_str='', dbgfo=None, logdir=None, debug=None, ignore_stderr=False, out=None, err=None):  # pass stdout/stderr either as strings with <out> and <err>, or if they're None, in files <logdir>/{out,err}
     """ NOTE something in this chain seems to block or truncate or some such nonsense if you make it too big """
-    out, err = '', ''
-    if logdir is not None:
+    if out is None or err is None:
         def read_and_delete_file(fname):
             fstr = ''
             if os.stat(fname).st_size > 0:
@@ -2867,49 +3132,14 @@ def get_cluster_ids(uids, partition):
 
 # ----------------------------------------------------------------------------------------
 def new_ccfs_that_need_better_names(partition, true_partition, reco_info, seed_unique_id=None, debug=False):
+    """
+    Return the mean (over uids in <true_partition>, or only <seed_unique_id> if it's set) of the fraction of each uid's inferred cluster which is really clonal (purity), and of the fraction of its true clonemates in its inferred cluster (completeness).
+    Returns None, None if any of the uids is in more than one inferred cluster (this seems to only happen for earlier partitions (more than one proc) when seed_unique_id is set, since we pass seed_unique_id to all the subprocs. I.e. it's expected in these cases, and the ccfs don't make sense when a uid is in more than one cluster, since it's no longer a partition).
+    NOTE purity uses reco ids, which depend only on rearrangement parameters, i.e. two different rearrangement events with the same rearrangement parameters have the same reco id (see event.py)
+    """
     if seed_unique_id is None:
         check_intersection_and_complement(partition, true_partition)
-    reco_ids = {uid : reco_info[uid]['reco_id'] for cluster in partition for uid in cluster}  # just a teensy lil' optimization
-    uids = set([uid for cluster in partition for uid in cluster])
-    clids = get_cluster_ids(uids, partition)  # map of {uid : (index of cluster in <partition> in which that uid occurs)} (well, list of indices, in case there's duplicates)
-
-    def get_clonal_fraction(uid, inferred_cluster):
-        """ Return the fraction of seqs in <uid>'s inferred cluster which are really clonal. """
-        n_clonal = 0
-        for tmpid in inferred_cluster:  # NOTE this includes the case where tmpid equal to uid
-            if reco_ids[tmpid] == reco_ids[uid]:  # reminder (see event.py) reco ids depend only on rearrangement parameters, i.e. two different rearrangement events with the same rearrangement parameters have the same reco id
-                n_clonal += 1
-        return float(n_clonal) / len(inferred_cluster)
-
-    def get_fraction_present(inferred_cluster, true_cluster):
-        """ Return the fraction of the true clonemates in <true_cluster> which appear in <inferred_cluster>. """
-        n_present = 0
-        for tmpid in true_cluster:  # NOTE this includes the case where tmpid equal to uid
-            if tmpid in inferred_cluster:
-                n_present += 1
-        return float(n_present) / len(true_cluster)
-
-    mean_clonal_fraction, mean_fraction_present = 0., 0.
-    n_uids = 0
-    for true_cluster in true_partition:
-        if seed_unique_id is not None and seed_unique_id not in true_cluster:
-            continue
-        for uid in true_cluster:
-            if seed_unique_id is not None and uid != seed_unique_id:
-                continue
-            if len(clids[uid]) != 1:  # this seems to only happen for earlier partitions (more than one proc) when seed_unique_id is set, since we pass seed_unique_id to all the subprocs. I.e. it's expected in these cases, and the ccfs don't make sense when a uid is in more than one cluster, since it's no longer a partition, so just return None, None
-                if debug:
-                    print '  %s found %s in multiple clusters while calculating ccfs (returning None, None)' % (color('red', 'warning'), uid)
-                return None, None
-            inferred_cluster = partition[clids[uid][0]]  # we only look at the first cluster in which it appears
-            mean_clonal_fraction += get_clonal_fraction(uid, inferred_cluster)
-            mean_fraction_present += get_fraction_present(inferred_cluster, true_cluster)
-            n_uids += 1
-
-    if n_uids > 1e6:
-        raise Exception('you should start worrying about numerical precision if you\'re going to run on this many queries')
-
-    return mean_clonal_fraction / n_uids, mean_fraction_present / n_uids
+    return partitionmetrics.ccfs(partition, true_partition, reco_info, seed_unique_id=seed_unique_id, debug=debug)  # uses contingency matrices, rather than looping over each uid's inferred and true clusters
 
 # ----------------------------------------------------------------------------------------
 def correct_cluster_fractions(partition, true_partition, debug=False):
@@ -2964,13 +3194,6 @@ def correct_cluster_fractions(partition, true_partition, debug=False):
 # ----------------------------------------------------------------------------------------
 def partition_similarity_matrix(meth_a, meth_b, partition_a, partition_b, n_biggest_clusters, debug=False):
     """ Return matrix whose ij^th entry is the size of the intersection between <partition_a>'s i^th biggest cluster and <partition_b>'s j^th biggest """
-    def intersection_size(cl_1, cl_2):
-        isize = 0
-        for uid in cl_1:
-            if uid in cl_2:
-                isize += 1
-        return isize
-
     # n_biggest_clusters = 10
     def sort_within_clusters(part):
         for iclust in range(len(part)):
@@ -2983,18 +3206,19 @@ def partition_similarity_matrix(meth_a, meth_b, partition_a, partition_b, n_bigg
     a_clusters = sorted(sorted(partition_a), key=len, reverse=True)[ : n_biggest_clusters]  # i.e. the n biggest clusters
     b_clusters = sorted(sorted(partition_b), key=len, reverse=True)[ : n_biggest_clusters]
 
+    intersections = partitionmetrics.intersection_sizes(a_clusters, b_clusters)
     smatrix = []
     pair_info = []  # list of full pair info (e.g. [0.8, ick)
     max_pair_info = 5
-    for clust_a in a_clusters:
+    for iclust, clust_a in enumerate(a_clusters):
         # if debug:
         #     print clust_a
         smatrix.append([])
-        for clust_b in b_clusters:
+        for jclust, clust_b in enumerate(b_clusters):
             # norm_factor = 1.  # don't normalize
             norm_factor = 0.5 * (len(clust_a) + len(clust_b))  # mean size
             # norm_factor = min(len(clust_a), len(clust_b))  # smaller size
-            intersection = intersection_size(clust_a, clust_b)
+            intersection = int(intersections[iclust][jclust])
             isize = float(intersection) / norm_factor
             # if debug:
             #     print '    %.2f  %5d   %5d %5d' % (isize, intersection, len(clust_a), len(clust_b))
@@ -3070,9 +3294,7 @@ def get_cluster_list_for_sklearn(part_a, part_b):
 
 # ----------------------------------------------------------------------------------------
 def adjusted_mutual_information(partition_a, partition_b):
-    return -1.  # not using it any more, and it's really slow
-    # clusts_a, clusts_b = get_cluster_list_for_sklearn(partition_a, partition_b)
-    # return sklearn.metrics.cluster.adjusted_mutual_info_score(clusts_a, clusts_b)
+    return partitionmetrics.adjusted_mutual_information(partition_a, partition_b)  # from the contingency matrix, so it's no longer really slow (it used to use get_cluster_list_for_sklearn() + sklearn.metrics.cluster.adjusted_mutual_info_score())
 
 # ----------------------------------------------------------------------------------------
 def add_missing_uids_as_singletons_to_inferred_partition(partition_with_missing_uids, true_partition=None, all_ids=None, debug=True):
@@ -3480,9 +3702,11 @@ def write_fasta(fname, seqfos, name_key='name', seq_key='seq'):  # should have w
             seqfile.write('>%s\n%s\n' % (sfo[name_key], sfo[seq_key]))
 
 # ----------------------------------------------------------------------------------------
-def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):  # Bio.SeqIO takes too goddamn long to import
+def iter_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None):  # yields one sequence at a time, so you don't need to hold the whole file in memory (see read_fastx() for a list)
+    # <fname> can be gzipped or bzipped (.gz or .bz2), and/or a glob pattern (e.g. 'shards/*.fa.gz'), in which case we read the matching files one after another (in sorted order) as if they were one file
+    fnames = get_input_fnames(fname)
     if ftype is None:
-        suffix = getsuffix(fname)
+        suffix = get_input_suffix(fnames)
         if suffix == '.fa' or suffix == '.fasta':
             ftype = 'fa'
         elif suffix == '.fq' or suffix == '.fastq':
@@ -3490,90 +3714,88 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
         else:
             raise Exception('unhandled file type: %s' % suffix)
 
-    finfo = []
-    iline = -1  # index of the query/seq that we're currently reading in the fasta
-    n_fasta_queries = 0  # number of queries so far added to <finfo> (I guess I could just use len(finfo) at this point)
+    iline = -1  # index of the query/seq that we're currently reading in the fasta (continues across files)
+    n_fasta_queries = 0  # number of queries so far yielded
     missing_queries = set(queries) if queries is not None else None
     already_printed_forbidden_character_warning = False
-    with open(fname) as fastafile:
-        startpos = None
-        while True:
-            if startpos is not None:  # rewind since the last time through we had to look to see when the next header line appeared
-                fastafile.seek(startpos)
-            headline = fastafile.readline()
-            if not headline:
-                break
-            if headline.strip() == '':  # skip a blank line
-                headline = fastafile.readline()
-
-            if ftype == 'fa':
-                if headline[0] != '>':
-                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('>')
-
-                seqlines = []
-                nextline = fastafile.readline()
-                while True:
-                    if not nextline:
-                        break
-                    if nextline[0] == '>':
-                        break
-                    else:
-                        startpos = fastafile.tell()  # i.e. very line that doesn't begin with '>' increments <startpos>
-                    seqlines.append(nextline)
-                    nextline = fastafile.readline()
-                seqline = ''.join([l.strip() for l in seqlines]) if len(seqlines) > 0 else None
-            elif ftype == 'fq':
-                if headline[0] != '@':
-                    raise Exception('invalid fastq header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('@')
-
-                seqline = fastafile.readline()  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
-                plusline = fastafile.readline().strip()
-                if plusline[0] != '+':
-                    raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, plusline))
-                qualityline = fastafile.readline()
-            else:
-                raise Exception('unhandled ftype %s' % ftype)
+    for thisfname in fnames:
+        with open_input_file(thisfname) as fastafile:
+            nextline = fastafile.readline()  # we always read one line ahead (rather than rewinding, which is really slow for compressed files)
+            while True:
+                headline = nextline
+                if not headline:
+                    break
+                if headline.strip() == '':  # skip a blank line
+                    headline = fastafile.readline()
 
-            if not seqline:
-                break
+                if ftype == 'fa':
+                    if headline[0] != '>':
+                        raise Exception('invalid fasta header line in %s:\n    %s' % (thisfname, headline))
+                    headline = headline.lstrip('>')
 
-            iline += 1
-            if istartstop is not None:
-                if iline < istartstop[0]:
-                    continue
-                elif iline >= istartstop[1]:
-                    continue
+                    seqlines = []
+                    nextline = fastafile.readline()
+                    while nextline and nextline[0] != '>':
+                        seqlines.append(nextline)
+                        nextline = fastafile.readline()
+                    seqline = ''.join([l.strip() for l in seqlines]) if len(seqlines) > 0 else None
+                elif ftype == 'fq':
+                    if headline[0] != '@':
+                        raise Exception('invalid fastq header line in %s:\n    %s' % (thisfname, headline))
+                    headline = headline.lstrip('@')
+
+                    seqline = fastafile.readline()  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
+                    plusline = fastafile.readline().strip()
+                    if plusline[0] != '+':
+                        raise Exception('invalid fastq quality header in %s:\n    %s' % (thisfname, plusline))
+                    qualityline = fastafile.readline()
+                    nextline = fastafile.readline()
+                else:
+                    raise Exception('unhandled ftype %s' % ftype)
 
-            if not dont_split_infostrs:  # by default, we split by everything that could be a separator, which isn't really ideal, but we're reading way too many different kinds of fasta files at this point to change the default
-                infostrs = [s3.strip() for s1 in headline.split(' ') for s2 in s1.split('\t') for s3 in s2.split('|')]  # NOTE the uid is left untranslated in here
-                uid = infostrs[0]
-            else:  # otherwise we let the calling fcn handle all the infostr parsing
-                infostrs = headline
-                uid = infostrs
-            if sanitize and any(fc in uid for fc in forbidden_characters):
-                if not already_printed_forbidden_character_warning:
-                    print '  %s: found a forbidden character (one of %s) in sequence id \'%s\'. This means we\'ll be replacing each of these forbidden characters with a single letter from their name (in this case %s). If this will cause problems you should replace the characters with something else beforehand.' % (color('yellow', 'warning'), ' '.join(["'" + fc + "'" for fc in forbidden_characters]), uid, uid.translate(forbidden_character_translations))
-                    already_printed_forbidden_character_warning = True
-                uid = uid.translate(forbidden_character_translations)
-
-            if queries is not None:
-                if uid not in queries:
-                    continue
-                missing_queries.remove(uid)
+                if not seqline:  # stop reading this file (but keep going with the next one, if there's more than one)
+                    if nextline:  # i.e. not just the end of the file
+                        print '  %s no sequence for header \'%s\' in %s, so skipping the rest of the file' % (color('yellow', 'warning'), headline.strip(), thisfname)
+                    break
 
-            seqfo = {name_key : uid, seq_key : seqline.strip().upper()}
-            if add_info:
-                seqfo['infostrs'] = infostrs
-            finfo.append(seqfo)
+                iline += 1
+                if istartstop is not None:
+                    if iline < istartstop[0]:
+                        continue
+                    elif iline >= istartstop[1]:
+                        return
+
+                if not dont_split_infostrs:  # by default, we split by everything that could be a separator, which isn't really ideal, but we're reading way too many different kinds of fasta files at this point to change the default
+                    infostrs = [s3.strip() for s1 in headline.split(' ') for s2 in s1.split('\t') for s3 in s2.split('|')]  # NOTE the uid is left untranslated in here
+                    uid = infostrs[0]
+                else:  # otherwise we let the calling fcn handle all the infostr parsing
+                    infostrs = headline
+                    uid = infostrs
+                if sanitize and any(fc in uid for fc in forbidden_characters):
+                    if not already_printed_forbidden_character_warning:
+                        print '  %s: found a forbidden character (one of %s) in sequence id \'%s\'. This means we\'ll be replacing each of these forbidden characters with a single letter from their name (in this case %s). If this will cause problems you should replace the characters with something else beforehand.' % (color('yellow', 'warning'), ' '.join(["'" + fc + "'" for fc in forbidden_characters]), uid, uid.translate(forbidden_character_translations))
+                        already_printed_forbidden_character_warning = True
+                    uid = uid.translate(forbidden_character_translations)
+
+                if queries is not None:
+                    if uid not in queries:
+                        continue
+                    missing_queries.remove(uid)
 
-            n_fasta_queries += 1
-            if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
-                break
-            if queries is not None and len(missing_queries) == 0:
-                break
+                seqfo = {name_key : uid, seq_key : seqline.strip().upper()}
+                if add_info:
+                    seqfo['infostrs'] = infostrs
+                yield seqfo
+
+                n_fasta_queries += 1
+                if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
+                    return
+                if queries is not None and len(missing_queries) == 0:
+                    return
 
+# ----------------------------------------------------------------------------------------
+def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):  # Bio.SeqIO takes too goddamn long to import
+    finfo = list(iter_fastx(fname, name_key=name_key, seq_key=seq_key, add_info=add_info, dont_split_infostrs=dont_split_infostrs, sanitize=sanitize, queries=queries, n_max_queries=n_max_queries, istartstop=istartstop, ftype=ftype))
     if n_random_queries is not None:
         finfo = numpy.random.choice(finfo, n_random_queries, replace=False)
 
@@ -3611,6 +3833,40 @@ def getsuffix(fname):  # suffix, including the dot
         raise Exception('couldn\'t split %s into two pieces using dot' % fname)
     return os.path.splitext(fname)[1]
 
+# ----------------------------------------------------------------------------------------
+compressed_suffixes = ['.gz', '.bz2']  # input files with these suffixes get decompressed on the fly (see open_input_file())
+def get_uncompressed_suffix(fname):  # suffix of the file once it's decompressed, e.g. '.fa' for both x.fa and x.fa.gz
+    suffix = getsuffix(fname)
+    if suffix in compressed_suffixes:
+        suffix = getsuffix(fname[ : -len(suffix)])
+    return suffix
+
+# ----------------------------------------------------------------------------------------
+def open_input_file(fname):  # open <fname> for reading, decompressing on the fly if it's gzipped or bzipped
+    suffix = getsuffix(fname)
+    if suffix == '.gz':
+        return io.BufferedReader(gzip.GzipFile(fname), buffer_size=2**20)  # GzipFile.readline() is really slow on its own
+    elif suffix == '.bz2':
+        return bz2.BZ2File(fname, buffering=2**20)
+    else:
+        return open(fname)
+
+# ----------------------------------------------------------------------------------------
+def get_input_fnames(fname):  # if <fname> is a glob pattern, return the (sorted) list of files that match it, otherwise just <fname>
+    if not any(c in fname for c in '*?['):
+        return [fname]
+    fnames = sorted(glob.glob(fname))
+    if len(fnames) == 0:
+        raise Exception('no files match %s' % fname)
+    return fnames
+
+# ----------------------------------------------------------------------------------------
+def get_input_suffix(fnames):  # uncompressed suffix of the files in <fnames> (e.g. from get_input_fnames()), which have to all be the same
+    suffixes = set(get_uncompressed_suffix(fn) for fn in fnames)
+    if len(suffixes) > 1:
+        raise Exception('input files have different suffixes: %s' % ' '.join(sorted(suffixes)))
+    return suffixes.pop()
+
 # ----------------------------------------------------------------------------------------
 def insert_before_suffix(insert_str, fname):
     return fname.replace(getsuffix(fname), '%s%s' % (insert_str, getsuffix(fname)))
@@ -3718,7 +3974,7 @@ def read_vsearch_search_file(fname, userfields, seqs, glfo, region, get_annotati
     return {'gene-counts' : gene_counts, 'annotations' : annotations, 'failures' : failed_queries}
 
 # ----------------------------------------------------------------------------------------
-def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_indels=False, minseqlength=None, consensus_fname=None, msa_fname=None, glfo=None, print_time=False, vsearch_binary=None, get_annotations=False, expect_failure=False):  # '2:-4' is the default vsearch match:mismatch, but I'm setting it here in case vsearch changes it in the future
+def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_indels=False, minseqlength=None, consensus_fname=None, msa_fname=None, glfo=None, print_time=False, vsearch_binary=None, get_annotations=False, expect_failure=False, glfo_storedir=None):  # '2:-4' is the default vsearch match:mismatch, but I'm setting it here in case vsearch changes it in the future
     # single-pass, greedy, star-clustering algorithm with
     #  - add the target to the cluster if the pairwise identity with the centroid is higher than global threshold <--id>
     #  - pairwise identity definition <--iddef> defaults to: number of (matching columns) / (alignment length - terminal gaps)
@@ -3781,8 +4037,11 @@ def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_inde
         # cmd += ' --maxaccept 0 --maxreject 0'  # see note above
     elif action == 'search':
         outfname = workdir + '/aln-info.tsv'
-        dbdir = workdir + '/' + glutils.glfo_dir
-        glutils.write_glfo(dbdir, glfo)
+        if glfo_storedir is not None:  # use (or add) the germline dir for this glfo in a store dir that's shared with other steps (see glutils.get_stored_gldir())
+            dbdir = glutils.get_stored_gldir(glfo_storedir, glfo)
+        else:
+            dbdir = workdir + '/' + glutils.glfo_dir
+            glutils.write_glfo(dbdir, glfo)
         cmd += ' --usearch_global ' + infname
         cmd += ' --maxaccepts 5'  # it's sorted by number of k-mers in common, so this needs to be large enough that we'll almost definitely get the exact best gene match
         cmd += ' --db ' + glutils.get_fname(dbdir, glfo['locus'], region)
@@ -3806,7 +4065,8 @@ def run_vsearch(action, seqs, workdir, threshold, match_mismatch='2:-4', no_inde
         returnfo = read_vsearch_cluster_file(outfname)
     elif action == 'search':
         returnfo = read_vsearch_search_file(outfname, userfields, seqs, glfo, region, get_annotations=get_annotations)
-        glutils.remove_glfo_files(dbdir, glfo['locus'])
+        if glfo_storedir is None:
+            glutils.remove_glfo_files(dbdir, glfo['locus'])
         if sum(returnfo['gene-counts'].values()) == 0 and not expect_failure:
             print '%s vsearch couldn\'t align anything to input sequences (cmd below)   %s\n  %s' % (color('yellow', 'warning'), reverse_complement_warning(), cmd)
     else:
@@ -3977,6 +4237,8 @@ def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=F
         write_csv_annotations(fname, headers, annotation_list, synth_single_seqs=synth_single_seqs, glfo=glfo, failed_queries=failed_queries)
     elif getsuffix(fname) == '.yaml':
         write_yaml_output(fname, headers, glfo=glfo, annotation_list=annotation_list, synth_single_seqs=synth_single_seqs, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=use_pyyaml)
+    elif getsuffix(fname) == '.db':
+        write_db_output(fname, headers, glfo=glfo, annotation_list=annotation_list, failed_queries=failed_queries, partition_lines=partition_lines)
     else:
         raise Exception('unhandled file extension %s' % getsuffix(fname))
 
@@ -4018,43 +4280,101 @@ def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_sin
     if partition_lines is None:
         partition_lines = []
 
+    if failed_queries is None:
+        failed_queries = []
+
     version_info = {'partis-yaml' : 0.1}
-    yaml_annotations = [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list]
-    if failed_queries is not None:
-        yaml_annotations += failed_queries
-    yamldata = {'version-info' : version_info,
-                'germline-info' : glfo,
-                'partitions' : partition_lines,
-                'events' : yaml_annotations}
+    other_sections = [('version-info', version_info),  # NOTE keep the events last, so read_yaml_output() can read everything else without having to parse them
+                      ('germline-info', glfo),
+                      ('partitions', partition_lines)]
     with open(fname, 'w') as yamlfile:
         if use_pyyaml:  # slower, but easier to read by hand for debugging (use this instead of the json version to make more human-readable files)
-            yaml.dump(yamldata, yamlfile, width=400, Dumper=yaml.CDumper, default_flow_style=False, allow_unicode=False)  # set <allow_unicode> to false so the file isn't cluttered up with !!python.unicode stuff
+            yaml_annotations = [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list] + failed_queries
+            yaml.dump(dict(other_sections + [('events', yaml_annotations)]), yamlfile, width=400, Dumper=yaml.CDumper, default_flow_style=False, allow_unicode=False)  # set <allow_unicode> to false so the file isn't cluttered up with !!python.unicode stuff
         else:  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
-            json.dump(yamldata, yamlfile) #, sort_keys=True, indent=4)
+            writer = jsonstream.JsonStreamWriter(yamlfile)  # writes the events one at a time, so we never have a second copy of all of them (output is the same as json.dump() of the whole thing)
+            writer.start_object()
+            for key, val in other_sections:
+                writer.write_key(key)
+                writer.write_value(val)
+            writer.write_key('events')
+            writer.start_array()
+            for line in annotation_list:
+                writer.write_value(get_yamlfo_for_output(line, headers, glfo=glfo))
+            for failfo in failed_queries:
+                writer.write_value(failfo)
+            writer.end_array()
+            writer.end_object()
 
 # ----------------------------------------------------------------------------------------
-def parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info):
-    annotation_list = []
+def write_db_output(fname, headers, glfo=None, annotation_list=None, failed_queries=None, partition_lines=None):  # same info as write_yaml_output(), but in an indexed sqlite file (see outputdb.py)
+    if annotation_list is None:
+        annotation_list = []
+    if partition_lines is None:
+        partition_lines = []
+    if failed_queries is None:
+        failed_queries = []
+    events = itertools.chain((get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list), failed_queries)  # one at a time, like the yaml writer
+    outdb = outputdb.OutputDB(fname, create=True)
+    outdb.write({'partis-yaml' : 0.1}, glfo, partition_lines, events)
+    outdb.close()
+
+# ----------------------------------------------------------------------------------------
+def iter_yaml_annotations(glfo, events, n_max_queries, synth_single_seqs, dont_add_implicit_info, lazy_implicit_info=False):  # <events> can be a list or an iterator
     n_queries_read = 0
-    for line in yamlfo['events']:
+    for line in events:
         if not line['invalid']:
             transfer_indel_reversed_seqs(line)
-            if not dont_add_implicit_info:  # it's kind of slow, although most of the time you probably want all the extra info
+            if lazy_implicit_info and not dont_add_implicit_info:  # only add the implicit info that somebody actually asks for
+                line = lazyannotation.LazyAnnotation(glfo, line)
+            elif not dont_add_implicit_info:  # it's kind of slow, although most of the time you probably want all the extra info
                 add_implicit_info(glfo, line)  # don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
         if synth_single_seqs and len(line['unique_ids']) > 1:
             for iseq in range(len(line['unique_ids'])):
-                annotation_list.append(synthesize_single_seq_line(line, iseq))
+                yield synthesize_single_seq_line(line, iseq)
         else:
-            annotation_list.append(line)
+            yield line
 
         n_queries_read += len(line['unique_ids'])
         if n_max_queries > 0 and n_queries_read >= n_max_queries:
             break
 
-    return annotation_list
+# ----------------------------------------------------------------------------------------
+def read_json_output_sections(fname):
+    """
+    Read everything except the events (i.e. the annotations) from a json-style yaml output file, without parsing the events (as long as they're the last section, which they are for files written since we started putting them there).
+    Returns a dict with the sections, and the file offset at which the events start (or None, None if it isn't a json file, i.e. if it was written with full yaml).
+    """
+    reader = jsonstream.JsonStreamReader(fname)
+    if reader.peek() != '{':
+        reader.close()
+        return None, None
+    sections, events_offset = {}, None
+    other_keys = ['version-info', 'germline-info', 'partitions']
+    for key in reader.iter_object_keys():
+        if key == 'events':
+            events_offset = reader.tell()
+            if all(k in sections for k in other_keys):  # events are last, so we're done
+                break
+            reader.skip_value()  # older file with the events before some of the other sections, so we have to parse our way past them (but we only hold one event at a time in memory)
+        else:
+            sections[key] = reader.decode_value()
+    reader.close()
+    return sections, events_offset
+
+# ----------------------------------------------------------------------------------------
+def iter_json_events(fname, events_offset):  # yield each event from a json-style yaml output file, starting from <events_offset> (from read_json_output_sections())
+    reader = jsonstream.JsonStreamReader(fname)
+    try:
+        reader.seek(events_offset)
+        for event in reader.iter_array():
+            yield event
+    finally:  # also closes the file if the caller stops iterating early (once the generator gets garbage collected)
+        reader.close()
 
 # ----------------------------------------------------------------------------------------
-def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, glfo=None, debug=False):
+def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, lazy_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, glfo=None, debug=False):
+    """ if <lazy_implicit_info> is set, annotations are lazyannotation.LazyAnnotation objects, which only add implicit info when it's asked for """
     annotation_list = None
 
     if getsuffix(fname) == '.csv':
@@ -4070,9 +4390,13 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
             n_queries_read = 0
             annotation_list = []
             with open(fname) as csvfile:
-                for line in csv.DictReader(csvfile):
-                    process_input_line(line, skip_literal_eval=dont_add_implicit_info)  # NOTE kind of weird to equate implicit info adding and literal eval skipping... but in the end they're both mostly speed optimizations
-                    if not dont_add_implicit_info:
+                reader = csv.DictReader(csvfile)
+                line_decoder = get_line_decoder(reader.fieldnames, skip_literal_eval=dont_add_implicit_info)  # NOTE kind of weird to equate implicit info adding and literal eval skipping... but in the end they're both mostly speed optimizations
+                for line in reader:
+                    line_decoder(line)
+                    if lazy_implicit_info and not dont_add_implicit_info:
+                        line = lazyannotation.LazyAnnotation(glfo, line)
+                    elif not dont_add_implicit_info:
                         add_implicit_info(glfo, line)
                     annotation_list.append(line)
                     n_queries_read += 1
@@ -4080,29 +4404,39 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
                         break
 
     elif getsuffix(fname) == '.yaml':  # NOTE this replaces any <glfo> that was passed (well, only within the local name table of this fcn)
-        glfo, annotation_list, cpath = read_yaml_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs,
-                                                        dont_add_implicit_info=dont_add_implicit_info, seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
+        glfo, annotation_list, cpath = read_yaml_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs, dont_add_implicit_info=dont_add_implicit_info, lazy_implicit_info=lazy_implicit_info,
+                                                        seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
+    elif getsuffix(fname) == '.db':  # NOTE same as for yaml, this replaces any <glfo> that was passed
+        glfo, annotation_list, cpath = read_db_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs, dont_add_implicit_info=dont_add_implicit_info, lazy_implicit_info=lazy_implicit_info,
+                                                      seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
     else:
         raise Exception('unhandled file extension %s' % getsuffix(fname))
 
     return glfo, annotation_list, cpath
 
 # ----------------------------------------------------------------------------------------
-def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, debug=False):
-    with open(fname) as yamlfile:
-        try:
-            yamlfo = json.load(yamlfile)  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
-        except ValueError:  # I wish i could think of a better way to do this, but I can't
-            yamlfile.seek(0)
+def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, lazy_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, stream_annotations=False, debug=False):
+    """ if <stream_annotations> is set, the returned annotation list is instead an iterator that reads and yields one annotation at a time (for json files, i.e. unless it was written with --write-full-yaml-output, only one at a time is ever in memory) """
+    yamlfo, events_offset = read_json_output_sections(fname)  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
+    if yamlfo is None:  # not json, so it must be full yaml
+        with open(fname) as yamlfile:
             yamlfo = yaml.load(yamlfile, Loader=yaml.CLoader)  # use this instead of the json version to make more human-readable files
-        if debug:
-            print '  read yaml version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
+    if debug:
+        print '  read yaml version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
 
     glfo = yamlfo['germline-info']  # it would probably be good to run the glfo through the checks that glutils.read_glfo() does, but on the other hand since we're reading from our own yaml file, those have almost certainly already been done
 
     annotation_list = None
-    if not skip_annotations:  # may not really be worthwhile, but oh well
-        annotation_list = parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info)
+    if not skip_annotations:  # for json files, we don't even parse the events if we're skipping them
+        if 'events' in yamlfo:  # full yaml
+            events = yamlfo['events']
+        elif events_offset is not None:
+            events = iter_json_events(fname, events_offset)
+        else:
+            events = []
+        annotation_list = iter_yaml_annotations(glfo, events, n_max_queries, synth_single_seqs, dont_add_implicit_info, lazy_implicit_info=lazy_implicit_info)
+        if not stream_annotations:
+            annotation_list = list(annotation_list)
 
     partition_lines = yamlfo['partitions']
     if cpath is None:   # allowing the caller to pass in <cpath> is kind of awkward, but it's used for backward compatibility in clusterpath.readfile()
@@ -4112,6 +4446,43 @@ def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_
 
     return glfo, annotation_list, cpath
 
+# ----------------------------------------------------------------------------------------
+def iter_db_events(indb, uids=None):  # yield the events from <indb> (see outputdb.OutputDB.iter_events()), closing it when we're done
+    try:
+        for event in indb.iter_events(uids=uids):
+            yield event
+    finally:  # also closes the db if the caller stops iterating early (once the generator gets garbage collected)
+        indb.close()
+
+# ----------------------------------------------------------------------------------------
+def read_db_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, lazy_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, stream_annotations=False, queries=None, debug=False):
+    """
+    Read a sqlite output file (see outputdb.py), with the same arguments and return values as read_yaml_output().
+    If <queries> is set, we only read the annotations for events that contain at least one of the uids in <queries> (which are looked up in the file's index, so we don't have to read anything else).
+    """
+    indb = outputdb.OutputDB(fname)
+    if debug:
+        print '  read db version %s from %s' % (indb.get_info('version-info')['partis-yaml'], fname)
+    glfo = indb.get_info('germline-info')
+    partition_lines = indb.get_partition_lines()
+
+    annotation_list = None
+    if not skip_annotations:
+        events = iter_db_events(indb, uids=queries)  # closes <indb> once we've read all the events (so if we're streaming, it stays open until the caller's done with the iterator)
+        annotation_list = iter_yaml_annotations(glfo, events, n_max_queries, synth_single_seqs, dont_add_implicit_info, lazy_implicit_info=lazy_implicit_info)
+        if not stream_annotations:
+            annotation_list = list(annotation_list)
+
+    if cpath is None:  # see note in read_yaml_output()
+        cpath = clusterpath.ClusterPath(seed_unique_id=seed_unique_id)
+    if len(partition_lines) > 0:
+        cpath.readlines(partition_lines)
+
+    if annotation_list is None:  # otherwise iter_db_events() closes it
+        indb.close()
+
+    return glfo, annotation_list, cpath
+
 # ----------------------------------------------------------------------------------------
 def get_gene_counts_from_annotations(annotations, only_regions=None):
     gene_counts = {r : {} for r in (only_regions if only_regions is not None else regions)}
@@ -11,12 +11,15 @@ from collections import OrderedDict
 import csv
 import numpy
 import traceback
+import multiprocessing
 
 import utils
 import glutils
 import indelutils
 from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
+from swseqcache import SwSeqCache
+from seqcontainmentindex import SeqContainmentIndex
 import seqfileopener
 
 # best mismatch (with a match score of 5):
@@ -30,12 +33,22 @@ import seqfileopener
 # -: [...]
 # mfreq was I think the sequence-wide mfreq, but was close enough to the v value that it doesn't matter
 
+# ----------------------------------------------------------------------------------------
+pool_waterer = None  # the Waterer whose sam files the worker processes in a sam pool (see Waterer.get_sam_pool()) are reading (they get a copy of it when they're forked, so this has to be set before the pool is created)
+def summarize_sam_file_in_pool(outfname, indelfos):
+    return pool_waterer.summarize_sam_file(outfname, indelfos)
+
 # ----------------------------------------------------------------------------------------
 class Waterer(object):
     """ Run smith-waterman on the query sequences in <infname> """
+    base_infname = 'query-seqs.fa'
+    base_outfname = 'query-seqs.sam'
+    n_jobs_per_proc = 3  # split the queries into this many ig-sw jobs for each proc, so procs that finish early can pick up more work (rather than everybody waiting for the slowest one)
+    n_max_tries = 3  # max number of times we run ig-sw on each query (we rerun queries with indels)
+
     def __init__(self, args, glfo, input_info, simglfo, reco_info,
                  count_parameters=False, parameter_out_dir=None, plot_annotation_performance=False,
-                 duplicates=None, pre_failed_queries=None, aligned_gl_seqs=None, vs_info=None):
+                 duplicates=None, pre_failed_queries=None, aligned_gl_seqs=None, vs_info=None, seq_cachefname=None):
         self.args = args
         self.input_info = input_info  # NOTE do *not* modify this, since it's this original input info from partitiondriver
         self.reco_info = reco_info
@@ -80,8 +93,11 @@ class Waterer(object):
 
         self.skipped_unproductive_queries, self.kept_unproductive_queries = set(), set()
 
-        self.my_gldir = self.args.workdir + '/sw-' + glutils.glfo_dir
-        glutils.write_glfo(self.my_gldir, self.glfo)  # NOTE gets overwritten by read_cachefile()
+        self.seq_cache = None if seq_cachefname is None else SwSeqCache(seq_cachefname, self.glfo, self.args, self.vs_info is not None)  # per-sequence cache (as opposed to the cache file for the whole input file)
+        self.seq_cache_hits = set()  # queries whose info came from <self.seq_cache>
+
+        self.glfo_storedir = self.args.workdir + '/' + glutils.glfo_store_dir  # NOTE same as partitiondriver's, which removes it when it's done
+        self.my_gldir = glutils.get_stored_gldir(self.glfo_storedir, self.glfo)  # NOTE gets overwritten by read_cachefile()
 
         if not os.path.exists(self.args.ig_sw_binary):
             raise Exception('ig-sw binary d.n.e: %s' % self.args.ig_sw_binary)
@@ -89,30 +105,19 @@ class Waterer(object):
     # ----------------------------------------------------------------------------------------
     def run(self, cachefname=None):
         start = time.time()
-        base_infname = 'query-seqs.fa'
-        base_outfname = 'query-seqs.sam'
+
+        if self.seq_cache is not None:  # has to come before adding vsearch indels, since we don't want them for queries that are in the cache
+            self.read_seq_cache()
 
         if self.vs_info is not None:  # if we're reading a cache file, we should make sure to read the exact same info from there
             self.add_vs_indels()
 
-        itry = 0
-        while True:  # if we're not running vsearch, we still gotta run twice to get shm indeld sequences
-            mismatches, gap_opens, queries_for_each_proc = self.split_queries(self.args.n_procs)  # NOTE can tell us to run more than <self.args.n_procs> (we run at least one proc for each different mismatch score)
-            self.write_input_files(base_infname, queries_for_each_proc)
-
-            print '    running %d proc%s for %d seq%s' % (len(mismatches), utils.plural(len(mismatches)), len(self.remaining_queries), utils.plural(len(self.remaining_queries)))
-            sys.stdout.flush()
-            self.execute_commands(base_infname, base_outfname, mismatches, gap_opens)
-
-            processing_start = time.time()
-            self.read_output(base_outfname, len(mismatches))
-
-            if itry > 1 or len(self.indel_reruns) == 0:
-                break
-            itry += 1
+        self.ig_sw_time, self.processing_time = 0., 0.
+        if len(self.remaining_queries) > 0:  # if they were all in the per-sequence cache, we don't need to run at all
+            self.run_jobs(self.get_initial_jobs())
 
         self.finalize(cachefname)
-        print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, time.time() - processing_start, self.ig_sw_time)
+        print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, self.ig_sw_time, self.processing_time)  # NOTE processing is the time we spend in this process reading (or applying the results of) sam files, most of which happens while ig-sw is running
 
     # ----------------------------------------------------------------------------------------
     def clean_cache(self, cache_path):
@@ -137,32 +142,51 @@ class Waterer(object):
                 print '    %s didn\'t find a germline info dir along with sw cache file, but trying to read it anyway' % utils.color('red', 'warning')
             cachefile = open(cachefname)  # closes on function exit, and no this isn't a great way of doing it (but it needs to stay open for the loop over <reader>)
             reader = csv.DictReader(cachefile)
+            line_decoder = utils.get_line_decoder(reader.fieldnames)
         elif utils.getsuffix(cachefname) == '.yaml':  # new way
-            self.glfo, reader, _ = utils.read_yaml_output(cachefname, dont_add_implicit_info=True)  # add implicit info below, so we can skip some of 'em and use aligned gl seqs
+            self.glfo, reader, _ = utils.read_yaml_output(cachefname, dont_add_implicit_info=True, stream_annotations=True)  # add implicit info below, so we can skip some of 'em and use aligned gl seqs
         else:
             raise Exception('unhandled sw cache file suffix %s' % cachefname)
 
         for line in reader:  # NOTE failed queries are *not* written to the cache file -- they're assumed to be whatever's in input info that's missing
             if utils.getsuffix(cachefname) == '.csv':
-                utils.process_input_line(line)
+                line_decoder(line)
                 for key in [k for k in [r + '_per_gene_support' for r in utils.regions] if k in line]:  # new files shouldn't have this, but I think I need to leave it for reading older files
                     del line[key]
             assert len(line['unique_ids']) == 1  # would only fail if this was not actually an sw cache file, but it's still nice to check since so many places in waterer assume it's length 1
-            uid = line['unique_ids'][0]
-            if uid not in self.input_info:
+            if line['unique_ids'][0] not in self.input_info:
                 continue
-            utils.add_implicit_info(self.glfo, line, aligned_gl_seqs=self.aligned_gl_seqs)
-            if indelutils.has_indels(line['indelfos'][0]):
-                self.info['indels'][uid] = line['indelfos'][0]
-            self.add_to_info(line)
-            self.remaining_queries -= set(line['duplicates'][0])
-            self.duplicates[uid] = line['duplicates'][0]  # Note that <self.duplicates> is really just so partitiondriver can pass in previous duplicates, but then now that we have the information in two places we need to keep it synchronized (see similar code in self.remove_duplicate_sequences())
+            self.add_cached_line(line)
 
-        glutils.write_glfo(self.my_gldir, self.glfo)
+        self.my_gldir = glutils.get_stored_gldir(self.glfo_storedir, self.glfo)
 
         self.finalize(cachefname=None, just_read_cachefile=True)
         print '        water time: %.1f' % (time.time()-start)
 
+    # ----------------------------------------------------------------------------------------
+    def add_cached_line(self, line):  # add a line read from either sort of cache file
+        uid = line['unique_ids'][0]
+        utils.add_implicit_info(self.glfo, line, aligned_gl_seqs=self.aligned_gl_seqs)
+        if indelutils.has_indels(line['indelfos'][0]):
+            self.info['indels'][uid] = line['indelfos'][0]
+        self.add_to_info(line)
+        self.remaining_queries -= set(line['duplicates'][0])
+        self.duplicates[uid] = line['duplicates'][0]  # Note that <self.duplicates> is really just so partitiondriver can pass in previous duplicates, but then now that we have the information in two places we need to keep it synchronized (see similar code in self.remove_duplicate_sequences())
+
+    # ----------------------------------------------------------------------------------------
+    def read_seq_cache(self):
+        cached_lines = self.seq_cache.get({q : self.input_info[q]['seqs'][0] for q in self.remaining_queries})
+        for uid, line in cached_lines.items():
+            self.add_cached_line(line)  # also removes it from <self.remaining_queries>
+            self.seq_cache_hits.add(uid)
+        print '        read %d / %d queries from sw sequence cache %s' % (len(cached_lines), len(cached_lines) + len(self.remaining_queries), self.seq_cache.fname)
+
+    # ----------------------------------------------------------------------------------------
+    def write_seq_cache(self):
+        new_queries = [q for q in self.info['queries'] if q not in self.seq_cache_hits]
+        self.seq_cache.add({q : self.input_info[q]['seqs'][0] for q in new_queries}, [self.info[q] for q in new_queries], utils.sw_cache_headers, self.glfo)
+        print '        added %d queries to sw sequence cache %s' % (len(new_queries), self.seq_cache.fname)
+
     # ----------------------------------------------------------------------------------------
     def write_cachefile(self, cachefname):
         if self.args.write_trimmed_and_padded_seqs_to_sw_cachefname:  # hackey workaround: (in case you want to use trimmed/padded seqs for something, but shouldn't be used in general)
@@ -250,6 +274,10 @@ class Waterer(object):
         # want to do this *before* we pad sequences, so that when we read the cache file we're reading unpadded sequences and can pad them below
         if cachefname is not None:
             self.write_cachefile(cachefname)
+        if self.seq_cache is not None:
+            if not just_read_cachefile:
+                self.write_seq_cache()
+            self.seq_cache.close()
 
         self.pad_seqs_to_same_length()  # NOTE this uses all the gene matches (not just the best ones), so it has to come before we call pcounter.write(), since that fcn rewrites the germlines removing genes that weren't best matches. But NOTE also that I'm not sure what but that the padding actually *needs* all matches (rather than just all *best* matches)
 
@@ -262,7 +290,6 @@ class Waterer(object):
             if self.parameter_out_dir is not None and not self.args.dont_write_parameters:
                 pcounter.write(self.parameter_out_dir)
 
-        glutils.remove_glfo_files(self.my_gldir, self.args.locus)
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
@@ -278,30 +305,80 @@ class Waterer(object):
             print '    added %d vsearch indel%s%s' % (len(queries_with_indels), utils.plural(len(queries_with_indels)), (' (%s)' % ' '.join(queries_with_indels)) if len(queries_with_indels) < 100 else '')
 
     # ----------------------------------------------------------------------------------------
-    def subworkdir(self, iproc, n_procs):
-        if n_procs == 1:
-            return self.args.workdir
-        else:
-            return self.args.workdir + '/sw-' + str(iproc)
+    def job_workdir(self, ijob):
+        return self.args.workdir + '/sw-' + str(ijob)
+
+    # ----------------------------------------------------------------------------------------
+    def get_sam_pool(self, n_procs):  # pool of worker processes to read and summarize the sam files as each ig-sw process finishes (or None, if we should instead read them all at the end in this process)
+        if n_procs == 1 or self.debug:  # debug printing would get interleaved between workers
+            return None
+        if multiprocessing.cpu_count() * utils.memory_usage_fraction() > 0.8:  # already using a lot of memory, so don't to call multiprocessing, which will duplicate all the memory for each process
+            return None
+        global pool_waterer
+        pool_waterer = self
+        sam_pool = multiprocessing.Pool(min(n_procs, self.args.n_procs))
+        pool_waterer = None  # the workers have their copy, and we don't want to keep a reference to ourselves around
+        return sam_pool
 
     # ----------------------------------------------------------------------------------------
-    def execute_commands(self, base_infname, base_outfname, mismatches, gap_opens):
+    def get_job_cmdfo(self, ijob, job):  # write the input file for <job> and return its cmdfo
+        workdir = self.job_workdir(ijob)
+        utils.prep_dir(workdir)
+        self.write_input_file(workdir + '/' + self.base_infname, job['queries'])
+        return {'cmd_str' : self.get_ig_sw_cmd_str(workdir, self.base_infname, self.base_outfname, job['mismatch'], job['gap_open']),
+                # 'cmd_str' : self.get_vdjalign_cmd_str(workdir, self.base_infname, self.base_outfname, job['mismatch'], job['gap_open'])  xxx update this
+                'workdir' : workdir,
+                'outfname' : workdir + '/' + self.base_outfname}
+
+    # ----------------------------------------------------------------------------------------
+    def run_jobs(self, jobs):
+        """
+        Run ig-sw on each of <jobs> (list of dicts with the queries, mismatch, gap open, and try index for each job), with at most --n-procs running at once, so procs that finish early pick up the next job (rather than everybody waiting for the slowest one).
+        We summarize each job's output as soon as it finishes (in a pool of worker processes, if we can), and if any of its queries need to be rerun (because of indels) we add a new job for them right away.
+        """
+        print '    running %d job%s on %d proc%s for %d seq%s' % (len(jobs), utils.plural(len(jobs)), self.args.n_procs, utils.plural(self.args.n_procs), len(self.remaining_queries), utils.plural(len(self.remaining_queries)))
+        sys.stdout.flush()
         start = time.time()
-        def get_cmd_str(iproc):
-            return self.get_ig_sw_cmd_str(self.subworkdir(iproc, n_procs), base_infname, base_outfname, mismatches[iproc], gap_opens[iproc])
-            # return self.get_vdjalign_cmd_str(self.subworkdir(iproc, n_procs), base_infname, base_outfname, mismatches[iproc], gap_opens[iproc] xxx update this)
-
-        n_procs = len(mismatches)
-        cmdfos = [{'cmd_str' : get_cmd_str(iproc),
-                   'workdir' : self.subworkdir(iproc, n_procs),
-                   'outfname' : self.subworkdir(iproc, n_procs) + '/' + base_outfname}
-                  for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname)
-
-        for iproc in range(n_procs):
-            os.remove(self.subworkdir(iproc, n_procs) + '/' + base_infname)
+        finished_jobs = {}  # jobs whose ig-sw proc has finished, but whose output we haven't yet applied: maps job index to async result (or None, if we're reading the sam files in this process)
+        not_read = set()
+        sam_pool = self.get_sam_pool(self.args.n_procs)  # if we're using a pool, it has to be created before we start modifying things, since the workers get a copy of our current state
+
+        def finish_fcn(ijob):
+            if sam_pool is None:
+                finished_jobs[ijob] = None
+            else:
+                indelfos = {q : self.info['indels'][q] for q in jobs[ijob]['queries'] if q in self.info['indels']}  # the workers' copies of these are out of date for any queries that we're rerunning
+                finished_jobs[ijob] = sam_pool.apply_async(summarize_sam_file_in_pool, (self.job_workdir(ijob) + '/' + self.base_outfname, indelfos))
+
+        def get_new_cmdfos():
+            new_jobs = []
+            for ijob in sorted(finished_jobs):
+                if finished_jobs[ijob] is not None and not finished_jobs[ijob].ready():
+                    continue
+                new_jobs += self.process_job_output(ijob, jobs[ijob], finished_jobs.pop(ijob), not_read)
+            if len(new_jobs) == 0 and len(finished_jobs) == 0:  # nothing that could lead to new jobs (apart from procs that are still running, which run_cmds() knows about)
+                return None
+            new_cmdfos = []
+            for job in new_jobs:
+                jobs.append(job)
+                new_cmdfos.append(self.get_job_cmdfo(len(jobs) - 1, job))
+            return new_cmdfos
+
+        n_initial_jobs = len(jobs)
+        cmdfos = [self.get_job_cmdfo(ijob, job) for ijob, job in enumerate(jobs)]
+        try:
+            utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, n_max_procs=self.args.n_procs, finish_fcn=finish_fcn, get_new_cmdfos=get_new_cmdfos)
+        finally:
+            if sam_pool is not None:
+                sam_pool.terminate()  # all the results are in by now (unless there was an exception), so there's nothing to wait for
+                sam_pool.join()
+
+        if len(jobs) > n_initial_jobs:
+            print '      ran %d more job%s for indel reruns' % (len(jobs) - n_initial_jobs, utils.plural(len(jobs) - n_initial_jobs))
+        if len(not_read) > 0:  # ig-sw (now) doesn't write matches for cases in which cigar and read length differ, which means there are now queries for which it finds zero matches (well, it didn't seem to happen before... but not sure that it couldn't have)
+            print '\n%s didn\'t read %s from %s' % (utils.color('red', 'warning'), ' '.join(not_read), self.args.workdir)
         sys.stdout.flush()
-        self.ig_sw_time = time.time() - start
+        self.ig_sw_time = time.time() - start - self.processing_time
 
     # ----------------------------------------------------------------------------------------
     def split_queries_by_match_mismatch(self, input_queries, n_procs, debug=False):
@@ -348,58 +425,30 @@ class Waterer(object):
         return mismatches, queries_for_each_proc
 
     # ----------------------------------------------------------------------------------------
-    def get_gap_opens(self, mismatches, queries_for_each_proc):
-        failed_mismatches = {}
-        for mismatch, queries in zip(mismatches, queries_for_each_proc):
-            fqueries_in_this_mismatch = set(queries) & self.indel_reruns
-            for fquery in fqueries_in_this_mismatch:  # if it's destined for this proc, keep track of the match/mismatch info, and remove it from this proc's list
-                if mismatch not in failed_mismatches:  # reminder: more than one proc can have the same mismatch
-                    failed_mismatches[mismatch] = []
-                failed_mismatches[mismatch].append(fquery)
-                queries.remove(fquery)
-        assert set([q for qlist in failed_mismatches.values() for q in qlist]) == self.indel_reruns
-        self.indel_reruns.clear()
-
-        gap_opens = [self.gap_open_penalty for _ in mismatches]
-        for fmismatch, fqueries in failed_mismatches.items():
-            gap_opens += [self.args.no_indel_gap_open_penalty]
-            mismatches += [fmismatch]
-            queries_for_each_proc += [fqueries]
-            # print '  adding new iproc for %s with gap open %d mismatch %d' % (' '.join(fqueries), fmismatch, self.args.no_indel_gap_open_penalty)
-
-        return mismatches, gap_opens, queries_for_each_proc
-
-    # ----------------------------------------------------------------------------------------
-    def split_queries(self, n_procs):
+    def get_initial_jobs(self):
         input_queries = list(self.remaining_queries)
+        n_jobs = min(len(input_queries), self.n_jobs_per_proc * self.args.n_procs)
         if self.vs_info is None:
-            mismatches, queries_for_each_proc = self.split_queries_evenly_among_procs(input_queries, n_procs)
+            mismatches, queries_for_each_job = self.split_queries_evenly_among_procs(input_queries, n_jobs)
         else:
-            mismatches, queries_for_each_proc = self.split_queries_by_match_mismatch(input_queries, n_procs)
+            mismatches, queries_for_each_job = self.split_queries_by_match_mismatch(input_queries, n_jobs)  # NOTE can give us more than <n_jobs> (we need at least one job for each different mismatch score)
 
-        mismatches, gap_opens, queries_for_each_proc = self.get_gap_opens(mismatches, queries_for_each_proc)  # they're all the same unless we have some indel fails
-
-        missing_queries = self.remaining_queries - set([q for proc_queries in queries_for_each_proc for q in proc_queries])
+        missing_queries = self.remaining_queries - set([q for job_queries in queries_for_each_job for q in job_queries])
         if len(missing_queries) > 0:
             raise Exception('didn\'t write %s to %s' % (':'.join(missing_queries), self.args.workdir))
 
-        return mismatches, gap_opens, queries_for_each_proc
+        return [{'queries' : queries, 'mismatch' : mismatch, 'gap_open' : self.gap_open_penalty, 'itry' : 0} for mismatch, queries in zip(mismatches, queries_for_each_job)]
 
     # ----------------------------------------------------------------------------------------
-    def write_input_files(self, base_infname, queries_for_each_proc):
-        n_procs = len(queries_for_each_proc)
-        for iproc in range(n_procs):
-            workdir = self.subworkdir(iproc, n_procs)
-            if n_procs > 1:
-                utils.prep_dir(workdir)
-            with open(workdir + '/' + base_infname, 'w') as sub_infile:
-                for query_name in queries_for_each_proc[iproc]:
-                    if query_name in self.info['indels']:
-                        seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
-                    else:
-                        assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
-                        seq = self.input_info[query_name]['seqs'][0]
-                    sub_infile.write('>%s NUKES\n%s\n' % (query_name, seq))
+    def write_input_file(self, infname, queries):
+        with open(infname, 'w') as sub_infile:
+            for query_name in queries:
+                if query_name in self.info['indels']:
+                    seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+                else:
+                    assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
+                    seq = self.input_info[query_name]['seqs'][0]
+                sub_infile.write('>%s NUKES\n%s\n' % (query_name, seq))
 
     # # ----------------------------------------------------------------------------------------
     # def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname, mismatch):
@@ -470,36 +519,89 @@ class Waterer(object):
     #     print '        time to rewrite same file: %.2f' % (time.time() - start)
 
     # ----------------------------------------------------------------------------------------
-    def read_output(self, base_outfname, n_procs=1):
-        if self.debug:
-            print '%s' % utils.color('green', 'reading output')
+    def read_sam_file(self, outfname):  # yield the qinfo for each query in sam file <outfname>
+        # self.remove_length_discrepant_matches(outfname)
+        with contextlib.closing(pysam.Samfile(outfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
+            grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
+            for _, reads in grouped:  # loop over query sequences
+                try:
+                    readlist = list(reads)
+                except:  # should no longer happen (was a result of pysam barfing when ig-sw gave it cigar and query sequences that were different lengths, but now ig-sw should skip matches for which that's true) it would be better if ig-sw didn't make those matches to start with, but that would require understanding a lot more about ig-sw
+                    raise Exception('failed to convert sam reads')
+                yield self.read_query(sam.references, readlist)
 
-        queries_read_from_file = set()  # should be able to remove this, eventually
-        for iproc in range(n_procs):
-            outfname = self.subworkdir(iproc, n_procs) + '/' + base_outfname
-            # self.remove_length_discrepant_matches(outfname)
-            with contextlib.closing(pysam.Samfile(outfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
-                grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
-                for _, reads in grouped:  # loop over query sequences
-                    try:
-                        readlist = list(reads)
-                    except:  # should no longer happen (was a result of pysam barfing when ig-sw gave it cigar and query sequences that were different lengths, but now ig-sw should skip matches for which that's true) it would be better if ig-sw didn't make those matches to start with, but that would require understanding a lot more about ig-sw
-                        raise Exception('failed to convert sam reads')
-                    qinfo = self.read_query(sam.references, readlist)
-                    self.summarize_query(qinfo)  # returns before adding to <self.info> if it thinks we should rerun the query
-                    queries_read_from_file.add(qinfo['name'])
-
-        not_read = self.remaining_queries - queries_read_from_file
-        if len(not_read) > 0:  # ig-sw (now) doesn't write matches for cases in which cigar and read length differ, which means there are now queries for which it finds zero matches (well, it didn't seem to happen before... but not sure that it couldn't have)
-            print '\n%s didn\'t read %s from %s' % (utils.color('red', 'warning'), ' '.join(not_read), self.args.workdir)
+    # ----------------------------------------------------------------------------------------
+    def summarize_sam_file(self, outfname, indelfos):
+        """
+        Read and summarize each query in <outfname> (in a worker process, so the changes to our copy of <self> don't propagate back to the main process), returning for each query (in file order) the info that apply_query_result() needs to make the same changes in the main process.
+        <indelfos> is the main process's current indel info for the queries in this file, since our copy is out of date for queries that we're rerunning.
+        NOTE this relies on summarize_query() only changing things for the query it's summarizing (so the queries in different sam files are independent).
+        """
+        results = []
+        for qinfo in self.read_sam_file(outfname):
+            qname = qinfo['name']
+            if qname in indelfos:  # bring our copy up to date for this query
+                self.info['indels'][qname] = indelfos[qname]
+            elif qname in self.info['indels']:
+                del self.info['indels'][qname]
+            self.indel_reruns.discard(qname)  # in case we summarized an earlier try for this query
+            self.summarize_query(qinfo)
+            results.append({
+                'name' : qname,
+                'infoline' : self.info[qname] if qname in self.info['passed-queries'] else None,
+                'indelfo' : self.info['indels'].get(qname),
+                'indel_rerun' : qname in self.indel_reruns,
+                'skipped_unproductive' : qname in self.skipped_unproductive_queries,
+            })
+        return results
 
-        for iproc in range(n_procs):
-            workdir = self.subworkdir(iproc, n_procs)
-            os.remove(workdir + '/' + base_outfname)
-            if n_procs > 1:  # still need the top-level workdir
-                os.rmdir(workdir)
+    # ----------------------------------------------------------------------------------------
+    def apply_query_result(self, qresult):  # make the changes to <self> that summarize_query() made for this query in a worker process (see summarize_sam_file())
+        qname = qresult['name']
+        if qresult['indelfo'] is not None:
+            self.info['indels'][qname] = qresult['indelfo']
+        elif qname in self.info['indels']:  # combine_indels() removes vsearch indels
+            del self.info['indels'][qname]
+        if qresult['indel_rerun']:
+            self.indel_reruns.add(qname)
+        if qresult['skipped_unproductive']:
+            self.skipped_unproductive_queries.add(qname)
+            self.remaining_queries.remove(qname)
+        if qresult['infoline'] is not None:
+            self.add_to_info(qresult['infoline'])
 
-        sys.stdout.flush()
+    # ----------------------------------------------------------------------------------------
+    def process_job_output(self, ijob, job, async_result, not_read):
+        """
+        Read and summarize the sam file for <job> (or if <async_result> is set, apply the results from the worker process that already did that), adding any queries that weren't in the file to <not_read>.
+        Returns a list with a new job for any of its queries that need to be rerun (or an empty list, if there aren't any).
+        """
+        start = time.time()
+        if self.debug:
+            print '%s' % utils.color('green', 'reading output for job %d' % ijob)
+
+        workdir = self.job_workdir(ijob)
+        queries_read_from_file = set()  # should be able to remove this, eventually
+        if async_result is not None:
+            for qresult in async_result.get():
+                self.apply_query_result(qresult)
+                queries_read_from_file.add(qresult['name'])
+        else:
+            for qinfo in self.read_sam_file(workdir + '/' + self.base_outfname):
+                self.summarize_query(qinfo)  # returns before adding to <self.info> if it thinks we should rerun the query
+                queries_read_from_file.add(qinfo['name'])
+        not_read |= set(job['queries']) - queries_read_from_file
+
+        for fname in [self.base_infname, self.base_outfname]:
+            os.remove(workdir + '/' + fname)
+        os.rmdir(workdir)
+
+        rerun_queries = [q for q in job['queries'] if q in self.indel_reruns]  # queries that either failed during indel handling, or had successful indel handling (other failures would just fail again, so there's no point in rerunning them)
+        self.processing_time += time.time() - start
+        if len(rerun_queries) == 0 or job['itry'] + 1 >= self.n_max_tries:
+            return []
+        self.indel_reruns -= set(rerun_queries)
+        return [{'queries' : rerun_queries, 'mismatch' : job['mismatch'], 'gap_open' : self.args.no_indel_gap_open_penalty, 'itry' : job['itry'] + 1}]  # super large gap open to prevent further indels
 
     # ----------------------------------------------------------------------------------------
     def remove_query(self, query):
@@ -1227,18 +1329,27 @@ class Waterer(object):
         # ----------------------------------------------------------------------------------------
         def get_key_seq(uid):  # return the sequence which will serve as the key for <uid>
             seq = getseq(uid)
-            if not self.args.also_remove_duplicate_sequences_with_different_lengths:  # this is probably significantly slower, otherwise I might make it the default
+            if not self.args.also_remove_duplicate_sequences_with_different_lengths:
                 return seq
             else:
-                for kseq, kuids in seqs_to_keep.items():
-                    if self.info[kuids[0]]['cdr3_length'] != self.info[uid]['cdr3_length']:
-                        continue
-                    if seq in kseq or kseq in seq:  # note that this keeps the first one we happen to come across -- it'd be better to keep the longest one, but this is fine for now
+                cdr3_length = self.info[uid]['cdr3_length']
+                if cdr3_length in seq_indices:
+                    seq_id = seq_indices[cdr3_length].find(seq)  # note that this keeps the first kept seq that matches -- it'd be better to keep the longest one, but this is fine for now
+                    if seq_id is not None:
+                        kseq = seq_indices[cdr3_length].seqs[seq_id]
                         if debug:
-                            print '      using keyseq from %s instead of %s' % (kuids, uid)
+                            print '      using keyseq from %s instead of %s' % (seqs_to_keep[kseq], uid)
                         return kseq
                 return seq  # if we fall through, it didn't match anybody
         # ----------------------------------------------------------------------------------------
+        def add_key_seq(keyseq, uid):  # add a new key sequence, with <uid> as its first uid
+            seqs_to_keep[keyseq] = [uid]
+            if self.args.also_remove_duplicate_sequences_with_different_lengths:
+                cdr3_length = self.info[uid]['cdr3_length']
+                if cdr3_length not in seq_indices:
+                    seq_indices[cdr3_length] = SeqContainmentIndex()
+                seq_indices[cdr3_length].add(keyseq)
+        # ----------------------------------------------------------------------------------------
         def get_pre_kept_queries():
             pre_kept_uids = set()
             if self.args.seed_unique_id is not None:
@@ -1254,14 +1365,16 @@ class Waterer(object):
             return pre_kept_uids
 
         seqs_to_keep = {}  # seq : [uids that correspond to seq]
+        seq_indices = {}  # for each cdr3 length, index of the key seqs in <seqs_to_keep> with that cdr3 length (only used if we're also removing sub/super string duplicates)
 
         # handle any pre-kept queries, just adding any duplicates to the appropriate list in <seqs_to_keep> *without* actually removing the duplicates
         pre_kept_uids = get_pre_kept_queries()
         for utpk in pre_kept_uids:
             keyseq = get_key_seq(utpk)
-            if keyseq not in seqs_to_keep:  # it's kind of weird to have duplicates in the pre-kept sequences, but it probably just means the user specified some duplicate sequences with --queries or --queries-to-include
-                seqs_to_keep[keyseq] = []
-            seqs_to_keep[keyseq].append(utpk)
+            if keyseq in seqs_to_keep:  # it's kind of weird to have duplicates in the pre-kept sequences, but it probably just means the user specified some duplicate sequences with --queries or --queries-to-include
+                seqs_to_keep[keyseq].append(utpk)
+            else:
+                add_key_seq(keyseq, utpk)
         if debug and len(pre_kept_uids) > 0:
             print '  pre-keeping %d uids: %s' % (len(pre_kept_uids), ' '.join(pre_kept_uids))
             if len(seqs_to_keep) < len(pre_kept_uids):
@@ -1275,7 +1388,7 @@ class Waterer(object):
                 self.remove_query(uid)
                 removed_queries.add(uid)
             else:
-                seqs_to_keep[keyseq] = [uid]
+                add_key_seq(keyseq, uid)
 
         for seq, uids in seqs_to_keep.items():
             kept_uid = uids[0]
@@ -1288,37 +1401,45 @@ class Waterer(object):
             print '      removed %d / %d = %.2f duplicate sequences after trimming framework insertions (leaving %d)' % (len(removed_queries), len(removed_queries) + len(self.info['queries']), len(removed_queries) / float(len(removed_queries) + len(self.info['queries'])), len(self.info['queries']))
 
     # ----------------------------------------------------------------------------------------
-    def get_padding_parameters(self, debug=False):
+    def get_padding_arrays(self):  # arrays (over self.info['queries']) of the per-query info that we need for padding
+        swfos = [self.info[q] for q in self.info['queries']]
+        return {
+            'cdr3_length' : numpy.array([swfo['cdr3_length'] for swfo in swfos], dtype=int),
+            'cpos' : numpy.array([swfo['codon_positions']['v'] for swfo in swfos], dtype=int),  # cyst position in query sequence (as opposed to gl_cpos, which is in germline allele)
+            'seq_len' : numpy.array([len(swfo['seqs'][0]) for swfo in swfos], dtype=int),
+            'fvstuff' : numpy.array([max(0, len(swfo['fv_insertion']) - swfo['v_5p_del']) for swfo in swfos], dtype=int),  # we always want to pad out to the entire germline sequence, so don't let this go negative
+            'j_3p_del' : numpy.array([swfo['j_3p_del'] for swfo in swfos], dtype=int),
+        }
+
+    # ----------------------------------------------------------------------------------------
+    def get_padding_parameters(self, debug=False, padarrays=None):
         padnames = ['gl_cpos', 'gl_cpos_to_j_end']
+        if padarrays is None:
+            padarrays = self.get_padding_arrays()
 
         def get_empty_maxima():
             return {pn : None for pn in padnames}
 
-        def check_set_maxima(name, val, cdr3):
-            if maxima[name] is None or val > maxima[name]:
-                maxima[name] = val
-            if cdr3 not in per_cdr3_maxima:
-                per_cdr3_maxima[cdr3] = get_empty_maxima()
-            if per_cdr3_maxima[cdr3][name] is None or val > per_cdr3_maxima[cdr3][name]:
-                per_cdr3_maxima[cdr3][name] = val
+        # find biggest cyst position among all gl matches (NOTE this pads more than it really needs to -- it only needs to be the max cpos over genes that have this cdr3 length)
+        # we use all matches for all sequences (up to n_max_per_region), because we want bcrham to be able to compare any sequence to any other (although, could probably use all *best* matches rather than all *all* UPDATE no, I kinda think not)
+        # Since we only store j_3p_del for the best match, we can't do the same for j. But j stuff doesn't vary too much, so it works ok.
+        values = {'gl_cpos' : None, 'gl_cpos_to_j_end' : None}
+        if len(self.info['all_matches']['v']) > 0:
+            values['gl_cpos'] = max(self.glfo['cyst-positions'][v_match] for v_match in self.info['all_matches']['v']) + padarrays['fvstuff']  # max over v matches of (cyst position + fvstuff) for each query
+        # jfstuff = max(0, len(swfo['jf_insertion']) - swfo['j_3p_del'])  # I'm not really sure why what this was for -- maybe I needed it when fwk insertion trimming was before/after this? -- in any case I'm pretty sure it's wrong to include it now
+        values['gl_cpos_to_j_end'] = padarrays['seq_len'] - padarrays['cpos'] + padarrays['j_3p_del']  # + jfstuff
 
         maxima = get_empty_maxima()
-        per_cdr3_maxima = {}
-        for query in self.info['queries']:
-            swfo = self.info[query]
-
-            # find biggest cyst position among all gl matches (NOTE this pads more than it really needs to -- it only needs to be the max cpos over genes that have this cdr3 length)
-            fvstuff = max(0, len(swfo['fv_insertion']) - swfo['v_5p_del'])  # we always want to pad out to the entire germline sequence, so don't let this go negative
-            # loop over all matches for all sequences (up to n_max_per_region), because we want bcrham to be able to compare any sequence to any other (although, could probably use all *best* matches rather than all *all* UPDATE no, I kinda think not)
-            for v_match in self.info['all_matches']['v']:
-                gl_cpos = self.glfo['cyst-positions'][v_match] + fvstuff
-                check_set_maxima('gl_cpos', gl_cpos, swfo['cdr3_length'])
-
-            # Since we only store j_3p_del for the best match, we can't loop over all of 'em. But j stuff doesn't vary too much, so it works ok.
-            cpos = swfo['codon_positions']['v']  # cyst position in query sequence (as opposed to gl_cpos, which is in germline allele)
-            # jfstuff = max(0, len(swfo['jf_insertion']) - swfo['j_3p_del'])  # I'm not really sure why what this was for -- maybe I needed it when fwk insertion trimming was before/after this? -- in any case I'm pretty sure it's wrong to include it now
-            gl_cpos_to_j_end = len(swfo['seqs'][0]) - cpos + swfo['j_3p_del']  # + jfstuff
-            check_set_maxima('gl_cpos_to_j_end', gl_cpos_to_j_end, swfo['cdr3_length'])
+        cdr3_lengths, icdr3s = numpy.unique(padarrays['cdr3_length'], return_inverse=True)
+        per_cdr3_maxima = {cdr3 : get_empty_maxima() for cdr3 in cdr3_lengths.tolist()}
+        for name in padnames:
+            if values[name] is None or len(values[name]) == 0:
+                continue
+            maxima[name] = int(values[name].max())
+            cdr3_maxima = numpy.full(len(cdr3_lengths), values[name].min(), dtype=int)
+            numpy.maximum.at(cdr3_maxima, icdr3s, values[name])  # max within each cdr3 length class
+            for cdr3, cmax in zip(cdr3_lengths.tolist(), cdr3_maxima.tolist()):
+                per_cdr3_maxima[cdr3][name] = cmax
 
         if debug:
             print '  maxima:',
@@ -1348,24 +1469,27 @@ class Waterer(object):
         if debug:
             print 'padding %d seqs to same length (%s cdr3 length classes)' % (len(self.info['queries']), 'within' if not cluster_different_cdr3_lengths else 'merging')
 
-        maxima, per_cdr3_maxima = self.get_padding_parameters(debug=debug)
+        padarrays = self.get_padding_arrays()
+        maxima, per_cdr3_maxima = self.get_padding_parameters(debug=debug, padarrays=padarrays)
+
+        # work out the left and right padding for every query at once
+        cpos = padarrays['cpos']
+        if cluster_different_cdr3_lengths:
+            padlefts = maxima['gl_cpos'] - cpos  # left padding: biggest germline cpos minus cpos in this sequence
+            padrights = maxima['gl_cpos_to_j_end'] - (padarrays['seq_len'] - cpos)
+        else:
+            padlefts = numpy.array([per_cdr3_maxima[c]['gl_cpos'] for c in padarrays['cdr3_length'].tolist()], dtype=int) - cpos  # left padding: biggest germline cpos (for this cdr3 length) minus cpos in this sequence
+            padrights = numpy.array([per_cdr3_maxima[c]['gl_cpos_to_j_end'] for c in padarrays['cdr3_length'].tolist()], dtype=int) - (padarrays['seq_len'] - cpos)
+        ibad = numpy.flatnonzero((padlefts < 0) | (padrights < 0))
+        if len(ibad) > 0:
+            raise Exception('bad padding %d %d for %s' % (padlefts[ibad[0]], padrights[ibad[0]], self.info['queries'][ibad[0]]))
 
         if debug:
             print '    left  right    uid'
-        for query in self.info['queries']:
+        for query, padleft, padright in zip(self.info['queries'], padlefts.tolist(), padrights.tolist()):  # tolist() so they're python ints (rather than numpy ints, which would end up in the output)
             swfo = self.info[query]
             assert len(swfo['seqs']) == 1
 
-            cpos = swfo['codon_positions']['v']
-            if cluster_different_cdr3_lengths:
-                padleft = maxima['gl_cpos'] - cpos  # left padding: biggest germline cpos minus cpos in this sequence
-                padright = maxima['gl_cpos_to_j_end'] - (len(swfo['seqs'][0]) - cpos)
-            else:
-                padleft = per_cdr3_maxima[swfo['cdr3_length']]['gl_cpos'] - cpos  # left padding: biggest germline cpos minus cpos in this sequence
-                padright = per_cdr3_maxima[swfo['cdr3_length']]['gl_cpos_to_j_end'] - (len(swfo['seqs'][0]) - cpos)
-            if padleft < 0 or padright < 0:
-                raise Exception('bad padding %d %d for %s' % (padleft, padright, query))
-
             leftstr = padleft * utils.ambiguous_bases[0]
             rightstr = padright * utils.ambiguous_bases[0]
             swfo['fv_insertion'] = leftstr + swfo['fv_insertion']